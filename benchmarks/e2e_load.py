@@ -0,0 +1,207 @@
+"""
+End-to-end load test of the bot.
+
+Runs the real dispatcher (routers, middlewares, FSM) in this process against a fake Telegram Bot API and a fake
+OpenAI API served from a second process, replays scripted user flows (see benchmarks.flows) for many concurrent
+users and prints throughput and p50/p95/p99 latency per flow and per step as JSON. A step is timed from the moment
+its update is fed to the dispatcher until its handler is done, including every call to the fake APIs.
+
+The bot reads its configuration from the environment as usual, e.g. TEXT_STREAMING=0 or SCHEDULER_MAX_QUEUE=1000.
+
+Usage:
+    python -m benchmarks.e2e_load --users 2000 --flows text text_to_speech vision --output results.json
+    python -m benchmarks.e2e_load --users 2000 --compare results.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+from typing import Any, Optional
+
+import aiohttp
+
+from benchmarks.fake_telegram import FAKE_TOKEN
+from benchmarks.flows import FLOWS
+
+
+def _run_fakes(options: dict[str, Any], port_queue: multiprocessing.Queue) -> None:
+    from benchmarks.fake_openai import FakeOpenAI
+    from benchmarks.fake_telegram import FakeTelegram
+
+    async def serve() -> None:
+        telegram = FakeTelegram(latency=options["telegram_latency"])
+        openai = FakeOpenAI(latency=options["openai_latency"], tokens=options["tokens"],
+                            token_interval=options["token_interval"], error_rate=options["error_rate"],
+                            error_status=options["error_status"])
+        await telegram.start()
+        await openai.start()
+        port_queue.put((telegram.base_url, openai.base_url))
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+def percentile(values: list[float], share: float) -> Optional[float]:
+    """
+    This function returns the nearest-rank percentile of the values, None when there are none.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(share * len(ordered)) - 1))]
+
+
+def summarize(latencies: list[float], elapsed: float) -> dict[str, Any]:
+    return {
+        "count": len(latencies),
+        "throughput": round(len(latencies) / elapsed, 2),
+        "p50": percentile(latencies, 0.50),
+        "p95": percentile(latencies, 0.95),
+        "p99": percentile(latencies, 0.99),
+    }
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args: argparse.Namespace, telegram_url: str) -> dict[str, Any]:
+    from bot.config import scheduler
+    from bot.dispatcher import create_bot, create_dispatcher
+
+    bot = create_bot()
+    dp = create_dispatcher()
+    await dp.emit_startup(bot=bot, dispatcher=dp)
+
+    flows = {name: {"latencies": [], "errors": 0, "steps": {step: [] for step, _ in FLOWS[name]}}
+             for name in args.flows}
+
+    async def user(index: int) -> None:
+        name = args.flows[index % len(args.flows)]
+        chat_id = 1_000_000 + index
+        result = flows[name]
+        if args.ramp:
+            await asyncio.sleep(args.ramp * index / args.users)
+        flow_started = time.perf_counter()
+        for step, build in FLOWS[name]:
+            step_started = time.perf_counter()
+            try:
+                await dp.feed_raw_update(bot, build(chat_id))
+            except Exception:
+                result["errors"] += 1
+                return
+            result["steps"][step].append(time.perf_counter() - step_started)
+            if args.think:
+                await asyncio.sleep(args.think)
+        result["latencies"].append(time.perf_counter() - flow_started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(user(index) for index in range(args.users)))
+    elapsed = time.perf_counter() - started
+
+    await dp.emit_shutdown(bot=bot, dispatcher=dp)
+    await bot.session.close()
+
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"{telegram_url}/stats") as response:
+            telegram_stats = await response.json()
+        async with session.get(f"{os.environ['OPENAI_BASE_URL'].rsplit('/v1', 1)[0]}/stats") as response:
+            openai_stats = await response.json()
+
+    return {
+        "commit": _git_commit(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare", "log_level")},
+        "elapsed": round(elapsed, 3),
+        "flows": {
+            name: {
+                **summarize(result["latencies"], elapsed),
+                "errors": result["errors"],
+                "steps": {step: summarize(latencies, elapsed) for step, latencies in result["steps"].items()},
+            }
+            for name, result in flows.items()
+        },
+        # Requests shed by the scheduler are answered with "busy" and still count as a completed step
+        "scheduler": scheduler.stats(),
+        "telegram": telegram_stats,
+        "openai": openai_stats,
+    }
+
+
+def compare(baseline: dict[str, Any], current: dict[str, Any]) -> str:
+    """
+    This function renders the change of throughput and latency percentiles of every flow against a baseline run.
+    """
+    lines = [f"{'flow':<16} {'metric':<10} {'baseline':>10} {'current':>10} {'change':>8}"]
+    for name, flow in current["flows"].items():
+        before = baseline.get("flows", {}).get(name)
+        if before is None:
+            continue
+        for metric in ("throughput", "p50", "p95", "p99"):
+            if not before[metric] or flow[metric] is None:
+                continue
+            change = (flow[metric] - before[metric]) / before[metric] * 100
+            lines.append(f"{name:<16} {metric:<10} {before[metric]:>10.3f} {flow[metric]:>10.3f} {change:>+7.1f}%")
+    return "\n".join(lines)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000, help="simulated users, all active at once")
+    parser.add_argument("--flows", nargs="+", choices=sorted(FLOWS), default=sorted(FLOWS),
+                        help="flows to replay, assigned to users round-robin")
+    parser.add_argument("--ramp", type=float, default=0.0, help="seconds over which the users start")
+    parser.add_argument("--think", type=float, default=0.0, help="seconds a user waits between two steps")
+    parser.add_argument("--openai-latency", type=float, default=0.5)
+    parser.add_argument("--tokens", type=int, default=20)
+    parser.add_argument("--token-interval", type=float, default=0.01)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of OpenAI requests that fail")
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument("--telegram-latency", type=float, default=0.0)
+    parser.add_argument("--log-level", default="ERROR")
+    parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare with")
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level)
+
+    context = multiprocessing.get_context("spawn")
+    port_queue = context.Queue()
+    fakes = context.Process(target=_run_fakes, args=(vars(args), port_queue), daemon=True)
+    fakes.start()
+    telegram_url, openai_url = port_queue.get()
+    os.environ.update(TOKEN_TELEGRAM=FAKE_TOKEN, TELEGRAM_API_URL=telegram_url, OPENAI_API="fake",
+                      OPENAI_BASE_URL=openai_url)
+    # The fake Bot API has no flood limits, so pacing the messages would only measure the limits (see
+    # benchmarks.outbound); OUTBOUND_SCHEDULER=1 turns it back on
+    os.environ.setdefault("OUTBOUND_SCHEDULER", "0")
+
+    # The bot runs on the event loop of its runtime profile, e.g. RUNTIME_PROFILE=fast
+    from bot.config import runtime
+    runtime.install()
+
+    try:
+        results = asyncio.run(run(args, telegram_url))
+    finally:
+        fakes.terminate()
+
+    rendered = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(rendered + "\n")
+    else:
+        print(rendered)
+    if args.compare:
+        with open(args.compare) as file:
+            print(compare(json.load(file), results), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+import asyncio
+import json
+import random
+import time
+from typing import Optional
+
+from aiohttp import web
+
+
+class FakeOpenAI:
+    """
+    This class is a local stand-in for the OpenAI HTTP API.
+
+    It answers the endpoints used by the bot after a configurable delay, and fails or stalls a configurable share of
+    the requests, so benchmarks can measure how the bot behaves under upstream latency and errors without touching the
+    real API.
+    """
+
+    def __init__(self, latency: float = 0.5, tokens: int = 5, token_interval: float = 0.0,
+                 error_rate: float = 0.0, error_status: int = 500, audio_rate: float = 0.0, speech_rate: float = 0.0,
+                 slow_rate: float = 0.0, slow_latency: float = 30.0, host: str = "127.0.0.1", port: int = 0):
+        """
+        This method initializes the FakeOpenAI class.
+
+        Args:
+            latency (float): The delay in seconds before each response (or the first streamed token) is sent.
+            tokens (int): The number of tokens in every chat completion.
+            token_interval (float): The delay in seconds between two generated tokens.
+            error_rate (float): The share of requests answered with an error instead of a result.
+            error_status (int): The HTTP status of the injected errors, e.g. 500 or 429.
+            audio_rate (float): The bytes of audio transcribed per second on top of the latency, 0 for none.
+            speech_rate (float): The characters of text spoken per second on top of the latency, 0 for none.
+            slow_rate (float): The share of requests that hang for ``slow_latency`` seconds more, the slow tail.
+            slow_latency (float): The extra delay in seconds of a slow request.
+            host (str): The host to bind to.
+            port (int): The port to bind to. 0 picks a free port.
+        """
+        self.latency = latency
+        self.tokens = tokens
+        self.token_interval = token_interval
+        self.host = host
+        self.port = port
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.audio_rate = audio_rate
+        self.speech_rate = speech_rate
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.requests = 0
+        self.errors = 0
+        self._runner = None
+
+        # Uploads up to the 25 MB the audio endpoints accept
+        self.app = web.Application(client_max_size=25 * 1024 * 1024)
+        self.app.router.add_post("/v1/chat/completions", self.chat_completions)
+        self.app.router.add_post("/v1/images/generations", self.images)
+        self.app.router.add_post("/v1/audio/speech", self.speech)
+        self.app.router.add_post("/v1/audio/translations", self.translations)
+        self.app.router.add_post("/v1/audio/transcriptions", self.translations)
+        self.app.router.add_get("/stats", self.stats)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}/v1"
+
+    async def start(self) -> None:
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        # Resolve the real port when a free one was requested
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def _delay(self) -> Optional[web.Response]:
+        # Returns the injected error response, if this request is to fail
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        if self.slow_rate and random.random() < self.slow_rate:
+            await asyncio.sleep(self.slow_latency)
+        if self.error_rate and random.random() < self.error_rate:
+            self.errors += 1
+            return web.json_response(
+                {"error": {"message": "Injected error", "type": "server_error", "param": None, "code": None}},
+                status=self.error_status,
+            )
+        return None
+
+    def _tokens(self) -> list[str]:
+        return [f"word{i} " for i in range(self.tokens)]
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        payload = await request.json()
+        if (error := await self._delay()) is not None:
+            return error
+        if payload.get("stream"):
+            return await self._stream_completion(request, payload)
+        await asyncio.sleep(self.token_interval * self.tokens)
+        return web.json_response({
+            "id": "chatcmpl-fake",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": payload["model"],
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": "".join(self._tokens())},
+                "finish_reason": "stop",
+            }],
+            "usage": {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15},
+        })
+
+    async def _stream_completion(self, request: web.Request, payload: dict) -> web.StreamResponse:
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for index, token in enumerate(self._tokens()):
+            if index:
+                await asyncio.sleep(self.token_interval)
+            chunk = {
+                "id": "chatcmpl-fake",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": payload["model"],
+                "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}],
+            }
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def images(self, request: web.Request) -> web.Response:
+        payload = await request.json()
+        if (error := await self._delay()) is not None:
+            return error
+        return web.json_response({
+            "created": int(time.time()),
+            "data": [{"url": "https://example.com/fake.png"} for _ in range(payload.get("n", 1))],
+        })
+
+    async def speech(self, request: web.Request) -> web.Response:
+        payload = await request.json()
+        if (error := await self._delay()) is not None:
+            return error
+        if self.speech_rate:
+            # Longer texts take longer to speak
+            await asyncio.sleep(len(payload.get("input", "")) / self.speech_rate)
+        return web.Response(body=b"\xff\xfb" + b"\x00" * 1024, content_type="audio/mpeg")
+
+    async def translations(self, request: web.Request) -> web.Response:
+        body = await request.read()
+        if (error := await self._delay()) is not None:
+            return error
+        if self.audio_rate:
+            # Longer recordings take longer to transcribe
+            await asyncio.sleep(len(body) / self.audio_rate)
+        return web.Response(text="This is a fake transcription.", content_type="text/plain")
+
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response({"requests": self.requests, "errors": self.errors})
@@ -0,0 +1,177 @@
+import asyncio
+import itertools
+import time
+from collections import Counter, deque
+from typing import Any
+
+from aiohttp import web
+
+# A token in the format aiogram accepts
+FAKE_TOKEN = "123456:FAKE-TOKEN"
+
+_update_ids = itertools.count(1)
+
+# Methods that count against the flood limits
+FLOOD_LIMITED = {"sendMessage", "editMessageText", "sendPhoto", "sendVoice", "sendMediaGroup", "deleteMessage"}
+
+
+def _user(chat_id: int) -> dict[str, Any]:
+    return {"id": chat_id, "is_bot": False, "first_name": f"User {chat_id}", "language_code": "en"}
+
+
+def _chat(chat_id: int) -> dict[str, Any]:
+    return {"id": chat_id, "type": "private", "first_name": f"User {chat_id}"}
+
+
+def message_update(chat_id: int, text: str, **fields: Any) -> dict[str, Any]:
+    """
+    This function builds a raw update with a private text message, as Telegram would post it.
+    """
+    message = {"message_id": next(_update_ids), "date": int(time.time()), "chat": _chat(chat_id),
+               "from": _user(chat_id), "text": text, **fields}
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": next(_update_ids), "message": message}
+
+
+def photo_update(chat_id: int, file_id: str = "photo", width: int = 1280, height: int = 960) -> dict[str, Any]:
+    """
+    This function builds a raw update with a private photo message, with the sizes Telegram generates for it.
+    """
+    sizes = [{"file_id": f"{file_id}-{side}", "file_unique_id": f"{file_id}-{side}", "width": side,
+              "height": side * height // width, "file_size": side * side // 10}
+             for side in (90, 320, 800) if side < width] + [
+        {"file_id": file_id, "file_unique_id": file_id, "width": width, "height": height,
+         "file_size": width * height // 10}]
+    message = {"message_id": next(_update_ids), "date": int(time.time()), "chat": _chat(chat_id),
+               "from": _user(chat_id), "photo": sizes}
+    return {"update_id": next(_update_ids), "message": message}
+
+
+def callback_update(chat_id: int, data: str) -> dict[str, Any]:
+    """
+    This function builds a raw update with an inline keyboard button press.
+    """
+    message = {"message_id": next(_update_ids), "date": int(time.time()), "chat": _chat(chat_id), "text": "menu"}
+    return {"update_id": next(_update_ids),
+            "callback_query": {"id": str(next(_update_ids)), "from": _user(chat_id), "chat_instance": "fake",
+                               "message": message, "data": data}}
+
+
+class FakeTelegram:
+    """
+    This class is a local stand-in for the Telegram Bot API.
+
+    It accepts every method the bot calls, answers with plausible objects after a configurable delay and counts the
+    calls, so benchmarks can run the real dispatcher without touching Telegram. Like Telegram, it can refuse messages
+    sent faster than a global or per-chat limit with a 429 "retry after" error.
+    """
+
+    def __init__(self, latency: float = 0.0, global_rate: int = 0, chat_rate: int = 0, host: str = "127.0.0.1",
+                 port: int = 0):
+        """
+        This method initializes the FakeTelegram class.
+
+        Args:
+            latency (float): The delay in seconds before each response is sent.
+            global_rate (int): The messages accepted in any second, 0 for no limit.
+            chat_rate (int): The messages accepted in any second for one chat, 0 for no limit.
+            host (str): The host to bind to.
+            port (int): The port to bind to. 0 picks a free port.
+        """
+        self.latency = latency
+        self.host = host
+        self.port = port
+        self.calls: Counter[str] = Counter()
+        self.sent: list[tuple[float, int, str]] = []
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.flood_errors = 0
+        # Times of the messages accepted in the last second, in total and per chat
+        self._recent: deque[float] = deque()
+        self._recent_chat: dict[int, deque[float]] = {}
+        self._message_ids = itertools.count(1)
+        self._runner = None
+
+        self.app = web.Application(client_max_size=64 * 1024 * 1024)
+        self.app.router.add_post("/bot{token}/{method}", self.method)
+        self.app.router.add_get("/file/bot{token}/{path:.*}", self.file)
+        self.app.router.add_get("/stats", self.stats)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self) -> None:
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    def _message(self, chat_id: int, **fields: Any) -> dict[str, Any]:
+        return {"message_id": next(self._message_ids), "date": int(time.time()), "chat": _chat(chat_id), **fields}
+
+    async def method(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        form = await request.post()
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        chat_id = int(form.get("chat_id", 0) or 0)
+        if method in FLOOD_LIMITED and (retry_after := self._flood(chat_id)):
+            self.flood_errors += 1
+            return web.json_response({"ok": False, "error_code": 429,
+                                      "description": f"Too Many Requests: retry after {retry_after}",
+                                      "parameters": {"retry_after": retry_after}}, status=429)
+        if method in ("sendMessage", "editMessageText"):
+            self.sent.append((time.monotonic(), chat_id, method))
+            result = self._message(chat_id, text=form.get("text", ""))
+        elif method == "sendPhoto":
+            self.sent.append((time.monotonic(), chat_id, method))
+            photo = {"file_id": f"photo{next(self._message_ids)}", "file_unique_id": "p", "width": 1024,
+                     "height": 1024, "file_size": 100_000}
+            result = self._message(chat_id, photo=[photo])
+        elif method == "sendVoice":
+            self.sent.append((time.monotonic(), chat_id, method))
+            voice = {"file_id": f"voice{next(self._message_ids)}", "file_unique_id": "v", "duration": 1,
+                     "file_size": 10_000}
+            result = self._message(chat_id, voice=voice)
+        elif method == "sendMediaGroup":
+            self.sent.append((time.monotonic(), chat_id, method))
+            result = [self._message(chat_id, photo=[{"file_id": "photo", "file_unique_id": "p", "width": 1,
+                                                      "height": 1}])]
+        elif method == "getMe":
+            result = {"id": 123456, "is_bot": True, "first_name": "Fake bot", "username": "fake_bot"}
+        elif method == "getFile":
+            file_id = form.get("file_id", "file")
+            result = {"file_id": file_id, "file_unique_id": file_id, "file_size": 1024, "file_path": f"{file_id}.bin"}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    def _flood(self, chat_id: int) -> int:
+        # Records a message and returns 0, or returns the seconds to wait when it is over a limit
+        now = time.monotonic()
+        chat = self._recent_chat.setdefault(chat_id, deque())
+        for recent in (self._recent, chat):
+            while recent and now - recent[0] >= 1:
+                recent.popleft()
+        if (self.global_rate and len(self._recent) >= self.global_rate) or \
+                (self.chat_rate and len(chat) >= self.chat_rate):
+            return 1
+        self._recent.append(now)
+        chat.append(now)
+        return 0
+
+    async def file(self, request: web.Request) -> web.Response:
+        self.calls["download"] += 1
+        return web.Response(body=b"\xff\xd8\xff" + b"\x00" * 1024)
+
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response({"calls": dict(self.calls), "sent": len(self.sent)})
@@ -0,0 +1,68 @@
+"""
+Time to the first voice message of a long text-to-speech request, spoken in one piece against in sentence chunks.
+
+Runs the text-to-speech job of the bot against a fake Telegram Bot API and a fake OpenAI server whose speech
+generation time grows with the length of the text, once with TTS_PIPELINE off and once on, and reports when the
+first voice message was sent and when the last one was.
+
+Usage:
+    python -m benchmarks.first_audio --chars 4000 --speech-rate 400
+"""
+import argparse
+import asyncio
+import os
+import time
+
+SENTENCE = "The quick brown fox jumps over the lazy dog while the benchmark keeps counting. "
+
+
+async def run(args: argparse.Namespace) -> None:
+    from benchmarks.fake_openai import FakeOpenAI
+    from benchmarks.fake_telegram import FAKE_TOKEN, FakeTelegram
+
+    telegram = FakeTelegram()
+    openai = FakeOpenAI(latency=args.latency, speech_rate=args.speech_rate)
+    await telegram.start()
+    await openai.start()
+    os.environ.update(TOKEN_TELEGRAM=FAKE_TOKEN, TELEGRAM_API_URL=telegram.base_url, OPENAI_API="fake",
+                      OPENAI_BASE_URL=openai.base_url)
+
+    from bot.config import close_client
+    from bot.dispatcher import create_bot
+    from bot.handlers.api import text_to_speech
+    from bot.utils.jobs import Job
+
+    prompt = (SENTENCE * (args.chars // len(SENTENCE) + 1))[:args.chars]
+    bot = create_bot()
+    results = {}
+    try:
+        for mode, pipeline in (("whole", False), ("pipelined", True)):
+            text_to_speech.TTS_PIPELINE = pipeline
+            telegram.sent.clear()
+            payload = {"prompt": f"{mode}: {prompt}", "model": "tts-1", "voice": "alloy", "key": mode,
+                       "wait_message_id": 1}
+            started = time.monotonic()
+            await text_to_speech.text_to_speech_job(bot, Job(id=0, kind="text_to_speech", chat_id=1,
+                                                             payload=payload, attempts=1))
+            sent = [at - started for at, _, method in telegram.sent if method == "sendVoice"]
+            results[mode] = (len(sent), sent[0], sent[-1])
+    finally:
+        await bot.session.close()
+        await close_client()
+        await telegram.stop()
+        await openai.stop()
+
+    for mode, (messages, first, last) in results.items():
+        print(f"{mode:<10} voice messages={messages:<3} first audio {first:.2f}s, last {last:.2f}s")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chars", type=int, default=4000, help="length of the text, the API takes up to 4096")
+    parser.add_argument("--latency", type=float, default=0.3, help="fixed delay of every speech request")
+    parser.add_argument("--speech-rate", type=float, default=400, help="characters the fake server speaks per second")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Time-to-first-visible-token for the text handler.
+
+Compares the blocking path (wait for ``generate_text``, then send the answer) with the streaming path
+(``stream_text`` fed into ``MessageStreamer``) against a fake OpenAI server that emits tokens at a fixed rate.
+
+Usage:
+    python -m benchmarks.first_token --tokens 400 --token-interval 0.02
+"""
+import argparse
+import asyncio
+import os
+import time
+
+
+class FakeMessage:
+    """
+    This class records the edits and messages that MessageStreamer would send to Telegram.
+    """
+
+    def __init__(self):
+        self.edits = 0
+        self.sent = 0
+
+    async def edit_text(self, text: str) -> None:
+        self.edits += 1
+
+    async def answer(self, text: str) -> "FakeMessage":
+        self.sent += 1
+        return self
+
+
+async def run(args: argparse.Namespace) -> None:
+    from benchmarks.fake_openai import FakeOpenAI
+
+    server = FakeOpenAI(latency=args.latency, tokens=args.tokens, token_interval=args.token_interval)
+    await server.start()
+    os.environ["OPENAI_API"] = "fake"
+    os.environ["OPENAI_BASE_URL"] = server.base_url
+
+    from bot.config import client
+    from bot.handlers.api.text import generate_text, stream_text
+    from bot.utils.message_stream import MessageStreamer
+
+    try:
+        started = time.perf_counter()
+        await generate_text(prompt="question", model="gpt-4")
+        blocking = time.perf_counter() - started
+
+        message = FakeMessage()
+        streamer = MessageStreamer(message, interval=args.interval)
+        started = time.perf_counter()
+        first_visible = time.monotonic()
+        async for chunk in stream_text(prompt="question", model="gpt-4"):
+            await streamer.feed(chunk)
+        await streamer.finish()
+        streaming_total = time.perf_counter() - started
+        streaming_first = streamer.first_visible - first_visible
+    finally:
+        await client.close()
+        await server.stop()
+
+    print(f"blocking:  first visible token {blocking:.3f}s")
+    print(f"streaming: first visible token {streaming_first:.3f}s, complete {streaming_total:.3f}s, "
+          f"edits={message.edits} messages={message.sent}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency", type=float, default=0.5, help="upstream delay before the first token")
+    parser.add_argument("--tokens", type=int, default=400)
+    parser.add_argument("--token-interval", type=float, default=0.02)
+    parser.add_argument("--interval", type=float, default=1.0, help="minimum delay between message edits")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
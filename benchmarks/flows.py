@@ -0,0 +1,33 @@
+from typing import Any, Callable
+
+from benchmarks.fake_telegram import callback_update, message_update, photo_update
+
+# A step builds the raw update a user sends, given the user's chat id
+Step = tuple[str, Callable[[int], dict[str, Any]]]
+
+# Scripted user flows, as a user clicks through the menus. Prompts contain the chat id, so the caches do not turn
+# a load test into a cache benchmark.
+FLOWS: dict[str, list[Step]] = {
+    "text": [
+        ("start", lambda chat_id: message_update(chat_id, "/start")),
+        ("menu", lambda chat_id: callback_update(chat_id, "text")),
+        ("model", lambda chat_id: callback_update(chat_id, "gpt-4o")),
+        ("prompt", lambda chat_id: message_update(chat_id, f"Tell me about load testing, user {chat_id}")),
+        ("follow_up", lambda chat_id: message_update(chat_id, "And how do I read a p99?")),
+    ],
+    "text_to_speech": [
+        ("start", lambda chat_id: message_update(chat_id, "/start")),
+        ("menu", lambda chat_id: callback_update(chat_id, "text_to_speech")),
+        ("model", lambda chat_id: callback_update(chat_id, "tts-1")),
+        ("voice", lambda chat_id: callback_update(chat_id, "alloy")),
+        ("prompt", lambda chat_id: message_update(chat_id, f"Hello from user {chat_id}")),
+    ],
+    "vision": [
+        ("start", lambda chat_id: message_update(chat_id, "/start")),
+        ("menu", lambda chat_id: callback_update(chat_id, "vision")),
+        ("model", lambda chat_id: callback_update(chat_id, "gpt_4_vision_preview")),
+        ("upload", lambda chat_id: callback_update(chat_id, "upload")),
+        ("photo", lambda chat_id: photo_update(chat_id, file_id=f"photo{chat_id}")),
+        ("prompt", lambda chat_id: message_update(chat_id, "What is in this picture?")),
+    ],
+}
@@ -0,0 +1,101 @@
+"""
+Handler CPU time per update of the menu handlers, rendering texts and keyboards on every update against the
+per-language cache of FluentDispenser.
+
+Every menu handler is called directly with a fake update whose answer/edit_text do nothing, so the time measured is
+the handler itself: formatting the texts and building the keyboard.
+
+Usage:
+    python -m benchmarks.menu_render --updates 20000
+"""
+import argparse
+import inspect
+import os
+import time
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Callable
+
+
+async def _noop(*_: Any, **__: Any) -> None:
+    pass
+
+
+def _handler(router, observer: str, name: str) -> Callable:
+    # Several handlers of a module share a name, so they are looked up on the router
+    return next(handler.callback for handler in getattr(router, observer).handlers if handler.callback.__name__ == name)
+
+
+def _menus() -> tuple[list[tuple[str, Callable, Any]], Any]:
+    from bot.handlers.api.image import router_image
+    from bot.handlers.api.speech_to_text import router_speech_to_text
+    from bot.handlers.api.text import router_text
+    from bot.handlers.api.text_to_speech import router_text_to_speech
+    from bot.handlers.api.vision import router_vision
+    from bot.handlers.start import router_start
+
+    message = SimpleNamespace(answer=_noop, from_user=SimpleNamespace(full_name="Load Test"))
+    call = SimpleNamespace(data="tts-1", message=SimpleNamespace(edit_text=_noop, answer=_noop))
+    state = SimpleNamespace(update_data=_noop, set_state=_noop)
+    return [
+        ("start", _handler(router_start, "message", "start"), message),
+        ("text", _handler(router_text, "callback_query", "text"), call),
+        ("image", _handler(router_image, "callback_query", "image"), call),
+        ("text_to_speech", _handler(router_text_to_speech, "callback_query", "text_to_speech"), call),
+        ("tts", _handler(router_text_to_speech, "callback_query", "tts"), call),
+        ("speech_to_text", _handler(router_speech_to_text, "callback_query", "speech_to_text"), call),
+        ("vision", _handler(router_vision, "callback_query", "vision"), call),
+        ("gpt_4_vision_preview", _handler(router_vision, "callback_query", "gpt_4_vision_preview"), call),
+    ], state
+
+
+def _run(handler: Callable, event: Any, kwargs: dict[str, Any]) -> None:
+    # The fakes never suspend, so the coroutine finishes on its first step without an event loop
+    try:
+        handler(event, **kwargs).send(None)
+    except StopIteration:
+        pass
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", type=int, default=20000, help="updates per handler")
+    parser.add_argument("--language", default="en")
+    args = parser.parse_args()
+    os.environ.setdefault("OPENAI_API", "fake")
+
+    from bot.utils.fluent_helper import FluentDispenser, MenuCache
+
+    class Uncached(MenuCache):
+        # Renders everything on every update, as the handlers did before the cache
+        def text(self, msg_id: str) -> str:
+            return self.l10n.format_value(msg_id)
+
+        def __call__(self, builder):
+            return builder(self.l10n)
+
+    dispenser = FluentDispenser(Path("bot/locales"), preload=True)
+    l10n = dispenser.get_language(args.language)
+    menus, state = _menus()
+    caches = {"uncached": Uncached(l10n), "cached": dispenser.get_menus(args.language)}
+
+    results = {name: {} for name, _, _ in menus}
+    for mode, cache in caches.items():
+        for name, handler, event in menus:
+            available = {"l10n": l10n, "menus": cache, "state": state}
+            kwargs = {key: value for key, value in available.items() if key in inspect.signature(handler).parameters}
+            for _ in range(100):
+                _run(handler, event, kwargs)
+            started = time.process_time()
+            for _ in range(args.updates):
+                _run(handler, event, kwargs)
+            results[name][mode] = (time.process_time() - started) / args.updates * 1e6
+
+    print(f"{'handler':<22} {'uncached':>12} {'cached':>12} {'speedup':>8}")
+    for name, times in results.items():
+        speedup = times["uncached"] / times["cached"]
+        print(f"{name:<22} {times['uncached']:>10.1f}us {times['cached']:>10.1f}us {speedup:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Per-update overhead of the metrics middlewares.
+
+Feeds the same message update through a dispatcher with a no-op handler, once bare and once with the update and
+handler metrics middlewares, and prints the extra time per update.
+
+Usage:
+    python -m benchmarks.metrics_overhead --updates 20000
+"""
+import argparse
+import asyncio
+import os
+import time
+
+
+def _dispatcher(with_metrics: bool):
+    from aiogram import Dispatcher, Router
+
+    from bot.middlewares.metrics import UpdateMetricsMiddleware, HandlerMetricsMiddleware
+
+    router = Router(name="router_bench")
+
+    @router.message()
+    async def handle(_) -> None:
+        pass
+
+    dp = Dispatcher()
+    dp.include_router(router)
+    if with_metrics:
+        dp.update.outer_middleware(UpdateMetricsMiddleware())
+        dp.message.middleware(HandlerMetricsMiddleware())
+    return dp
+
+
+async def _measure(with_metrics: bool, updates: int) -> float:
+    from aiogram import Bot
+    from aiogram.types import Update
+
+    from benchmarks.fake_telegram import FAKE_TOKEN, message_update
+
+    bot = Bot(token=FAKE_TOKEN)
+    dp = _dispatcher(with_metrics)
+    update = Update.model_validate(message_update(1, "hello"), context={"bot": bot})
+    for _ in range(1000):
+        await dp.feed_update(bot, update)
+
+    started = time.perf_counter()
+    for _ in range(updates):
+        await dp.feed_update(bot, update)
+    elapsed = time.perf_counter() - started
+    await bot.session.close()
+    return elapsed / updates * 1e6
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", type=int, default=20000)
+    args = parser.parse_args()
+    os.environ.setdefault("OPENAI_API", "fake")
+
+    bare = asyncio.run(_measure(False, args.updates))
+    metered = asyncio.run(_measure(True, args.updates))
+    print(f"bare={bare:.1f}us/update with_metrics={metered:.1f}us/update overhead={metered - bare:.1f}us/update")
+
+
+if __name__ == "__main__":
+    main()
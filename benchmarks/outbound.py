@@ -0,0 +1,133 @@
+"""
+Delivery of answers to many chats at once through Telegram's flood limits, with and without the outbound scheduler.
+
+Runs against a fake Telegram Bot API that refuses messages over a global and a per-chat limit with 429 "retry
+after" errors, as Telegram does. Every simulated user gets what a text answer costs: a "wait" message, a few
+streamed edits of it, the answer and the delete of the "wait" message. Without the scheduler every refused call is
+a failed handler; with it calls wait for their turn, answers go ahead of the noise and edits of the same message
+merge.
+
+A second part measures the delayed "wait" message: for answers quicker than PLACEHOLDER_DELAY neither the "wait"
+message nor its delete is sent.
+
+Usage:
+    python -m benchmarks.outbound --users 300 --global-rate 30 --chat-rate 3
+"""
+import argparse
+import asyncio
+import contextlib
+import os
+import time
+
+
+def _percentile(values: list[float], share: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * share))] if ordered else 0.0
+
+
+async def _answer(bot, chat_id: int, edits: int) -> float:
+    from aiogram.exceptions import TelegramBadRequest
+
+    from bot.utils.outbound import LOW, outbound_priority
+
+    started = time.perf_counter()
+    with outbound_priority(LOW):
+        wait = await bot.send_message(chat_id=chat_id, text="⏳")
+    for index in range(edits):
+        await bot.edit_message_text(text="word " * (index + 1), chat_id=chat_id, message_id=wait.message_id)
+        await asyncio.sleep(0.05)
+    await bot.send_message(chat_id=chat_id, text="answer")
+    answered = time.perf_counter() - started
+    with contextlib.suppress(TelegramBadRequest):
+        await bot.delete_message(chat_id=chat_id, message_id=wait.message_id)
+    return answered
+
+
+async def _run_users(bot, args: argparse.Namespace) -> tuple[int, list[float], float]:
+    from aiogram.exceptions import TelegramRetryAfter
+
+    failures = 0
+    latencies = []
+
+    async def user(chat_id: int) -> None:
+        nonlocal failures
+        try:
+            latencies.append(await _answer(bot, chat_id, args.edits))
+        except TelegramRetryAfter:
+            failures += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(user(chat_id) for chat_id in range(1, args.users + 1)))
+    return failures, latencies, time.perf_counter() - started
+
+
+async def _placeholders(telegram, bot, delay: float, answer_time: float, users: int) -> int:
+    from aiogram import types
+
+    from bot.utils.outbound import Placeholder
+
+    calls = sum(telegram.calls.values())
+
+    async def user(chat_id: int) -> None:
+        message = types.Message(message_id=1, date=int(time.time()),
+                                chat=types.Chat(id=chat_id, type="private")).as_(bot)
+        async with Placeholder(message, "⏳", delay=delay):
+            await asyncio.sleep(answer_time)
+        await bot.send_message(chat_id=chat_id, text="answer")
+
+    await asyncio.gather(*(user(chat_id) for chat_id in range(1, users + 1)))
+    return sum(telegram.calls.values()) - calls
+
+
+async def run(args: argparse.Namespace) -> None:
+    from benchmarks.fake_telegram import FAKE_TOKEN, FakeTelegram
+
+    telegram = FakeTelegram(latency=args.telegram_latency, global_rate=args.global_rate, chat_rate=args.chat_rate)
+    await telegram.start()
+    os.environ.update(TOKEN_TELEGRAM=FAKE_TOKEN, TELEGRAM_API_URL=telegram.base_url, OPENAI_API="fake")
+
+    from bot import dispatcher
+
+    try:
+        for name, enabled in (("direct", False), ("scheduled", True)):
+            dispatcher.OUTBOUND_SCHEDULER = enabled
+            bot = dispatcher.create_bot()
+            calls, floods = sum(telegram.calls.values()), telegram.flood_errors
+            try:
+                failures, latencies, total = await _run_users(bot, args)
+            finally:
+                await bot.session.close()
+            # Let the limits of the fake server forget this run
+            await asyncio.sleep(1)
+            print(f"{name:<9} users {args.users}: failed {failures}, 429 answers "
+                  f"{telegram.flood_errors - floods}, calls {sum(telegram.calls.values()) - calls}, answer p50 "
+                  f"{_percentile(latencies, 0.5):.2f}s p99 {_percentile(latencies, 0.99):.2f}s, all done in "
+                  f"{total:.2f}s")
+        print(f"scheduler: {dispatcher.outbound.stats()}")
+
+        bot = dispatcher.create_bot()
+        try:
+            for delay in (0.0, args.placeholder_delay):
+                calls = await _placeholders(telegram, bot, delay, args.answer_time, args.users)
+                print(f"placeholder delay {delay}s, answers in {args.answer_time}s: {calls} calls for "
+                      f"{args.users} answers")
+        finally:
+            await bot.session.close()
+    finally:
+        await telegram.stop()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=300)
+    parser.add_argument("--edits", type=int, default=3, help="streamed edits of every answer")
+    parser.add_argument("--global-rate", type=int, default=30, help="messages Telegram accepts per second")
+    parser.add_argument("--chat-rate", type=int, default=3, help="messages Telegram accepts per second in one chat")
+    parser.add_argument("--telegram-latency", type=float, default=0.02)
+    parser.add_argument("--placeholder-delay", type=float, default=0.5)
+    parser.add_argument("--answer-time", type=float, default=0.2, help="time an instant answer takes")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
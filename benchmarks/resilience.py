@@ -0,0 +1,96 @@
+"""
+Success rate and tail latency of text generations against a failing, sometimes hanging upstream, with and without
+the resilience layer.
+
+Runs against a fake OpenAI server that fails a share of the requests and stalls another share. The baseline makes a
+single attempt per call, as the handlers used to; the resilient run retries within the deadline and the retry
+budget and, with --hedge-after, races a second request against a slow one.
+
+Usage:
+    python -m benchmarks.resilience --calls 400 --error-rate 0.1 --slow-rate 0.05 --hedge-after 1
+"""
+import argparse
+import asyncio
+import os
+import time
+
+
+def _percentile(values: list[float], share: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * share))]
+
+
+async def _run_calls(args: argparse.Namespace, name: str) -> tuple[int, list[float]]:
+    from bot.handlers.api.text import generate_text
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    durations = []
+    failures = 0
+
+    async def one(index: int) -> None:
+        nonlocal failures
+        async with semaphore:
+            started = time.perf_counter()
+            answer = await generate_text(f"{name} question {index}", args.model)
+            durations.append(time.perf_counter() - started)
+            failures += answer.startswith("Error:")
+
+    await asyncio.gather(*(one(index) for index in range(args.calls)))
+    return failures, durations
+
+
+async def run(args: argparse.Namespace) -> None:
+    from benchmarks.fake_openai import FakeOpenAI
+
+    server = FakeOpenAI(latency=args.latency, error_rate=args.error_rate, error_status=args.error_status,
+                        slow_rate=args.slow_rate, slow_latency=args.slow_latency)
+    await server.start()
+    os.environ.update(OPENAI_API="fake", OPENAI_BASE_URL=server.base_url,
+                      OPENAI_ATTEMPT_TIMEOUT=str(args.slow_latency + args.latency + 1))
+
+    from bot.config import close_client, resilience
+    from bot.utils.resilience import Resilience
+
+    baseline = Resilience(max_attempts=1, deadline=resilience.deadline, attempt_timeout=resilience.attempt_timeout)
+    resilient = Resilience(
+        max_attempts=resilience.max_attempts,
+        deadline=resilience.deadline,
+        attempt_timeout=resilience.attempt_timeout,
+        retry_ratio=resilience.retry_ratio,
+        failure_threshold=resilience.failure_threshold,
+        reset_timeout=resilience.reset_timeout,
+        hedge_after={args.model: args.hedge_after} if args.hedge_after else None,
+    )
+    try:
+        for name, layer in (("single attempt", baseline), ("resilient", resilient)):
+            # The handlers use the shared instance, so swap its settings for this run
+            resilience.__dict__.update(layer.__dict__)
+            requests = server.requests
+            failures, durations = await _run_calls(args, name)
+            stats = resilience.stats().get(args.model, {})
+            print(f"{name:<15} ok {args.calls - failures}/{args.calls}, p50 {_percentile(durations, 0.5):.2f}s, "
+                  f"p99 {_percentile(durations, 0.99):.2f}s, max {max(durations):.2f}s, "
+                  f"{server.requests - requests} requests, retries {stats.get('retries', 0)}, "
+                  f"hedges {stats.get('hedges', 0)} ({stats.get('hedges_won', 0)} won), "
+                  f"rejected {stats.get('rejected', 0)}")
+    finally:
+        await close_client()
+        await server.stop()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=50, help="calls made at once")
+    parser.add_argument("--model", default="gpt-4o")
+    parser.add_argument("--latency", type=float, default=0.2, help="delay of every OpenAI request")
+    parser.add_argument("--error-rate", type=float, default=0.1, help="share of OpenAI requests that fail")
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument("--slow-rate", type=float, default=0.05, help="share of OpenAI requests that stall")
+    parser.add_argument("--slow-latency", type=float, default=10.0, help="extra delay of a stalled request")
+    parser.add_argument("--hedge-after", type=float, default=1.0, help="seconds before a hedge request, 0 for none")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""
+The "fast" runtime profile (RUNTIME_PROFILE=fast) against the default one.
+
+First times what the profiles do differently on their own: serializing a vision request with a photo of a few
+megabytes of base64, parsing a chat completion, parsing a getUpdates answer and serializing an inline keyboard, and
+running many short tasks on the event loop. Then runs the end-to-end load test (benchmarks.e2e_load) once per
+profile and prints the change of throughput and latency. Parts whose optional package (uvloop, orjson) is not
+installed are reported as skipped.
+
+Usage:
+    python -m benchmarks.runtime_profile --photo-mb 4 --users 500
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable
+
+
+def _best(function: Callable[[], object], number: int) -> float:
+    # The quickest of five rounds, in microseconds per call
+    rounds = []
+    for _ in range(5):
+        started = time.perf_counter()
+        for _ in range(number):
+            function()
+        rounds.append((time.perf_counter() - started) / number * 1e6)
+    return min(rounds)
+
+
+def _payloads(photo_mb: float) -> None:
+    import httpx
+
+    from benchmarks.fake_telegram import message_update
+    from bot.utils.runtime import Runtime, _FastJsonResponse
+
+    default, fast = Runtime("default"), Runtime("fast")
+    if not fast.orjson:
+        print("payloads: skipped, orjson is not installed")
+        return
+
+    photo = base64.b64encode(os.urandom(int(photo_mb * 1024 * 1024))).decode()
+    vision = {"model": "gpt-4o", "max_tokens": 300, "messages": [{"role": "user", "content": [
+        {"type": "text", "text": "Что изображено на этой фотографии?"},
+        {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{photo}", "detail": "high"}},
+    ]}]}
+    transport = httpx.AsyncHTTPTransport()
+    clients = {"default": default.openai_http_client(transport), "fast": fast.openai_http_client(transport)}
+    times = {name: _best(lambda: client.build_request("POST", "https://api.openai.com/v1/chat/completions",
+                                                       json=vision), 5)
+             for name, client in clients.items()}
+    sizes = {name: len(client.build_request("POST", "https://api.openai.com/v1/chat/completions", json=vision).content)
+             for name, client in clients.items()}
+    print(f"vision request, {photo_mb} MB photo: default {times['default'] / 1000:.2f}ms, fast "
+          f"{times['fast'] / 1000:.2f}ms ({times['default'] / times['fast']:.1f}x)")
+    print(f"  body: default {sizes['default']} bytes, fast {sizes['fast']} bytes")
+
+    completion = json.dumps({
+        "id": "chatcmpl-1", "object": "chat.completion", "created": 1, "model": "gpt-4o",
+        "choices": [{"index": 0, "finish_reason": "stop",
+                     "message": {"role": "assistant", "content": "Это кот, который спит на диване. " * 40}}],
+        "usage": {"prompt_tokens": 1200, "completion_tokens": 300, "total_tokens": 1500},
+    }).encode()
+    # The fast client hands the OpenAI client responses of its own class
+    parsed = {name: _best(response_class(200, content=completion).json, 2000)
+              for name, response_class in (("default", httpx.Response), ("fast", _FastJsonResponse))}
+    print(f"chat completion answer: default {parsed['default']:.1f}us, fast {parsed['fast']:.1f}us "
+          f"({parsed['default'] / parsed['fast']:.1f}x)")
+
+    updates = json.dumps({"ok": True, "result": [message_update(index, "Привет! " * 20) for index in range(100)]})
+    keyboard = {"inline_keyboard": [[{"text": f"🎨 Кнопка {row}-{column}", "callback_data": f"button_{row}_{column}"}
+                                     for column in range(3)] for row in range(6)]}
+    for label, default_call, fast_call, number in (
+            ("getUpdates answer, 100 updates", lambda: default.json_loads(updates), lambda: fast.json_loads(updates),
+             200),
+            ("inline keyboard", lambda: default.json_dumps(keyboard), lambda: fast.json_dumps(keyboard), 20000)):
+        before, after = _best(default_call, number), _best(fast_call, number)
+        print(f"{label}: default {before:.1f}us, fast {after:.1f}us ({before / after:.1f}x)")
+
+
+async def _tasks(count: int) -> float:
+    # Many short tasks passing a value through a queue, the way handlers, streams and schedulers share the loop
+    queue = asyncio.Queue()
+
+    async def worker() -> None:
+        for _ in range(10):
+            await queue.put(1)
+            await asyncio.sleep(0)
+
+    async def consumer() -> None:
+        for _ in range(count * 10):
+            await queue.get()
+
+    started = time.perf_counter()
+    await asyncio.gather(consumer(), *(worker() for _ in range(count)))
+    return time.perf_counter() - started
+
+
+def _run_tasks(count: int, loop_factory=None) -> float:
+    with asyncio.Runner(loop_factory=loop_factory) as runner:
+        return runner.run(_tasks(count))
+
+
+def _event_loop(count: int) -> None:
+    from bot.utils.runtime import uvloop
+
+    default = min(_run_tasks(count) for _ in range(3))
+    if uvloop is None:
+        print(f"event loop, {count} tasks: default {default:.2f}s, uvloop skipped, it is not installed")
+        return
+    fast = min(_run_tasks(count, uvloop.new_event_loop) for _ in range(3))
+    print(f"event loop, {count} tasks: default {default:.2f}s, uvloop {fast:.2f}s ({default / fast:.1f}x)")
+
+
+def _end_to_end(args: argparse.Namespace) -> None:
+    from benchmarks.e2e_load import compare
+
+    # The profiles take turns, and the quickest run of each is compared, since runs of one profile vary too
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for _ in range(args.rounds):
+            for profile in ("default", "fast"):
+                output = os.path.join(directory, f"{profile}.json")
+                subprocess.run([sys.executable, "-m", "benchmarks.e2e_load", "--users", str(args.users), "--output",
+                                output], env={**os.environ, "RUNTIME_PROFILE": profile}, check=True)
+                with open(output) as file:
+                    result = json.load(file)
+                print(f"end to end, {args.users} users, {profile}: {result['elapsed']:.2f}s")
+                if profile not in results or result["elapsed"] < results[profile]["elapsed"]:
+                    results[profile] = result
+    print(compare(results["default"], results["fast"]))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--photo-mb", type=float, default=4.0, help="megabytes of the photo of the vision request")
+    parser.add_argument("--tasks", type=int, default=20000, help="tasks of the event loop part")
+    parser.add_argument("--users", type=int, default=500, help="users of the end-to-end part, 0 to skip it")
+    parser.add_argument("--rounds", type=int, default=2, help="end-to-end runs of every profile")
+    args = parser.parse_args()
+    os.environ.setdefault("OPENAI_API", "fake")
+
+    _payloads(args.photo_mb)
+    _event_loop(args.tasks)
+    if args.users:
+        _end_to_end(args)
+
+
+if __name__ == "__main__":
+    main()
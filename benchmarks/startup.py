@@ -0,0 +1,66 @@
+"""
+Cold start of the bot: import time and resident memory until the dispatcher is ready, lazy against eager.
+
+Every run is a fresh interpreter that imports the bot and builds the dispatcher with LAZY_LOADING=1 or 0, then
+reports the time it took, its resident memory, and how long loading the remaining features and the OpenAI client
+takes afterwards (the cost lazy loading moves to first use).
+
+Usage:
+    python -m benchmarks.startup --runs 5
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+def _rss_mb() -> float:
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def child() -> None:
+    started = time.perf_counter()
+    from bot.config import client
+    from bot.dispatcher import create_dispatcher
+
+    dp = create_dispatcher()
+    ready = time.perf_counter() - started
+    rss = _rss_mb()
+
+    # What lazy loading defers: every feature module and the OpenAI client
+    started = time.perf_counter()
+    for router in dp.sub_routers[0].sub_routers:
+        router.load()
+    client.load()
+    first_use = time.perf_counter() - started
+    print(json.dumps({"ready": ready, "rss_mb": rss, "first_use": first_use, "rss_loaded_mb": _rss_mb()}))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child()
+        return
+
+    results = {}
+    for mode, lazy in (("lazy", "1"), ("eager", "0")):
+        env = {**os.environ, "LAZY_LOADING": lazy, "OPENAI_API": "fake"}
+        runs = [json.loads(subprocess.run([sys.executable, "-m", "benchmarks.startup", "--child"], env=env,
+                                          capture_output=True, text=True, check=True).stdout)
+                for _ in range(args.runs)]
+        results[mode] = {key: round(statistics.median(run[key] for run in runs), 3) for key in runs[0]}
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
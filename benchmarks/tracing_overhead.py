@@ -0,0 +1,98 @@
+"""
+Per-update overhead of update tracing.
+
+Feeds the same update through the bot's real dispatcher (FSM, localization, throttling and scheduler middlewares)
+to a no-op handler, with tracing off, on but not sampling, sampling a share of the updates and tracing every update
+to catch the slow ones, and prints the time per update of each. It also prints what a span costs outside a traced
+update, which is what every instrumented call pays when tracing is off.
+
+Usage:
+    python -m benchmarks.tracing_overhead --updates 20000
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+
+async def _measure(path, sample_rate: float, slow_threshold: float, updates: int) -> tuple[float, dict]:
+    from aiogram import Bot, Router
+    from aiogram.types import Update
+
+    from benchmarks.fake_telegram import FAKE_TOKEN, message_update
+    from bot.config import tracer
+    from bot.dispatcher import create_dispatcher
+
+    tracer.path, tracer.sample_rate, tracer.slow_threshold = path, sample_rate, slow_threshold
+    router = Router(name="router_bench")
+
+    @router.edited_message()
+    async def handle(_) -> None:
+        pass
+
+    dp = create_dispatcher()
+    dp.include_router(router)
+    bot = Bot(token=FAKE_TOKEN)
+    raw = message_update(1, "hello")
+    raw["edited_message"] = raw.pop("message")
+    update = Update.model_validate(raw, context={"bot": bot})
+    for _ in range(1000):
+        await dp.feed_update(bot, update)
+
+    started = time.perf_counter()
+    for _ in range(updates):
+        await dp.feed_update(bot, update)
+    elapsed = time.perf_counter() - started
+    await tracer.close()
+    await bot.session.close()
+    stats = tracer.stats()
+    tracer.counts = dict.fromkeys(tracer.counts, 0)
+    return elapsed / updates * 1e6, stats
+
+
+def _best(path, sample_rate: float, slow_threshold: float, args: argparse.Namespace) -> tuple[float, dict]:
+    # The quickest of a few runs, the others being slowed down by the rest of the machine
+    return min((asyncio.run(_measure(path, sample_rate, slow_threshold, args.updates)) for _ in range(args.runs)),
+               key=lambda result: result[0])
+
+
+def _span_cost(calls: int) -> float:
+    from bot.utils.tracing import span
+
+    started = time.perf_counter()
+    for _ in range(calls):
+        pass
+    empty = time.perf_counter() - started
+    started = time.perf_counter()
+    for _ in range(calls):
+        with span("telegram sendMessage", "telegram", chat_id=1):
+            pass
+    return (time.perf_counter() - started - empty) / calls * 1e9
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", type=int, default=20000)
+    parser.add_argument("--sample-rate", type=float, default=0.01)
+    parser.add_argument("--runs", type=int, default=3, help="runs of every setting, the quickest is shown")
+    args = parser.parse_args()
+    os.environ.setdefault("OPENAI_API", "fake")
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "trace.json")
+        off, _ = _best(None, 0.0, 0.0, args)
+        print(f"tracing off: {off:.1f}us/update, a span outside a traced update {_span_cost(1_000_000):.0f}ns")
+        for name, sample_rate, slow_threshold in (
+                (f"sampling {args.sample_rate:.0%}", args.sample_rate, 0.0),
+                ("slow updates (>1s)", 0.0, 1.0),
+                ("sampling 100%", 1.0, 0.0)):
+            traced, stats = _best(path, sample_rate, slow_threshold, args)
+            print(f"{name}: {traced:.1f}us/update, overhead {traced - off:+.1f}us/update, traced {stats['traced']}, "
+                  f"kept {stats['kept']}, dropped {stats['dropped']}")
+        sizes = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+        print(f"trace files: {sizes / 1e6:.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
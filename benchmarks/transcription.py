@@ -0,0 +1,94 @@
+"""
+Wall-clock time of transcribing a long voice message whole against split into parts transcribed at once.
+
+Builds a synthetic Ogg Opus recording (real page structure, silent payload) and transcribes it through the bot's
+speech to text path against a fake OpenAI server whose transcription time grows with the size of the upload, once
+as one request and once split with split_audio and transcribe_segments. Reports the total time and the time until
+the first text could be shown.
+
+Usage:
+    python -m benchmarks.transcription --minutes 10 --segment-seconds 60 --parallel 4
+"""
+import argparse
+import asyncio
+import io
+import math
+import os
+import struct
+import time
+
+# Telegram voice messages are Opus at about 32 kbit/s, in pages of about a second
+BYTES_PER_SECOND = 4000
+OPUS_RATE = 48000
+
+
+def _ogg_page(body: bytes, granule: int, sequence: int, header_type: int = 0) -> bytes:
+    # The CRC is left at 0, neither the splitter nor the fake server checks it
+    lacing = [255] * (len(body) // 255) + [len(body) % 255]
+    return struct.pack("<4sBBqIIIB", b"OggS", 0, header_type, granule, 1, sequence, 0, len(lacing)) + \
+        bytes(lacing) + body
+
+
+def voice_message(seconds: int) -> bytes:
+    """
+    This function builds an Ogg Opus stream of the given length, one page per second.
+    """
+    head = b"OpusHead" + struct.pack("<BBHIhB", 1, 1, 312, OPUS_RATE, 0, 0)
+    tags = b"OpusTags" + struct.pack("<I", 4) + b"fake" + struct.pack("<I", 0)
+    pages = [_ogg_page(head, 0, 0, header_type=0x02), _ogg_page(tags, 0, 1)]
+    for second in range(seconds):
+        pages.append(_ogg_page(bytes(BYTES_PER_SECOND), (second + 1) * OPUS_RATE, second + 2,
+                               header_type=0x04 if second == seconds - 1 else 0))
+    return b"".join(pages)
+
+
+async def run(args: argparse.Namespace) -> None:
+    from benchmarks.fake_openai import FakeOpenAI
+
+    server = FakeOpenAI(latency=args.latency, audio_rate=args.audio_rate)
+    await server.start()
+    os.environ["OPENAI_API"] = "fake"
+    os.environ["OPENAI_BASE_URL"] = server.base_url
+
+    from bot.config import close_client
+    from bot.handlers.api.speech_to_text import transcribe_segments
+    from bot.utils.audio import split_audio
+
+    seconds = args.minutes * 60
+    data = voice_message(seconds)
+    audio = io.BytesIO(data)
+    results = {}
+    try:
+        for mode, parts in (("whole", 1), ("split", math.ceil(seconds / args.segment_seconds))):
+            segments = split_audio(audio, "audio/ogg", parts)
+            started = time.perf_counter()
+            first = None
+            async for text in transcribe_segments("whisper-1", audio, segments, "voice.ogg", parallel=args.parallel):
+                if text.startswith("Error:"):
+                    raise RuntimeError(text)
+                if first is None:
+                    first = time.perf_counter() - started
+            results[mode] = (len(segments), first, time.perf_counter() - started)
+    finally:
+        await close_client()
+        await server.stop()
+
+    print(f"recording: {args.minutes} min, {len(data)} bytes")
+    for mode, (parts, first, total) in results.items():
+        print(f"{mode:<6} parts={parts:<3} first text {first:.2f}s, complete {total:.2f}s")
+    print(f"speedup: {results['whole'][2] / results['split'][2]:.1f}x")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--minutes", type=int, default=10)
+    parser.add_argument("--segment-seconds", type=int, default=60)
+    parser.add_argument("--parallel", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.5, help="fixed delay of every transcription request")
+    parser.add_argument("--audio-rate", type=float, default=100_000,
+                        help="bytes of audio the fake server transcribes per second")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Cost of the usage ledger on the hot path, and query time of the usage report over millions of records.
+
+Records usage the way the handlers do and reports the time record() takes, then fills a temporary ledger with
+synthetic records spread over users, models and days and times the report before and after compaction.
+
+Usage:
+    python -m benchmarks.usage_ledger --records 2000000 --users 10000 --days 30
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+
+async def hot_path(path: str, calls: int) -> float:
+    from bot.utils.usage import UsageLedger
+
+    ledger = UsageLedger(path, flush_interval=0.1)
+    started = time.perf_counter()
+    for index in range(calls):
+        ledger.record("gpt-4o", prompt_tokens=index % 4000, completion_tokens=300, user_id=index % 1000)
+    elapsed = time.perf_counter() - started
+    await ledger.close()
+    return elapsed / calls
+
+
+def fill(path: str, records: int, users: int, days: int) -> None:
+    from bot.utils.usage import RECORD
+
+    models = ["gpt-4o", "gpt-4", "gpt-4o-mini", "dall-e-3", "dall-e-2", "tts-1", "tts-1-hd", "whisper-1"]
+    now = int(time.time())
+    random.seed(1)
+    with open(path, "wb") as file:
+        batch = []
+        for index in range(records):
+            # Most users stick to two models
+            user = random.randrange(users)
+            model = models[(user + random.randrange(2)) % len(models)]
+            batch.append(RECORD.pack(now - random.randrange(days * 86400), user, model.encode(), 1,
+                                     random.randrange(2), random.randrange(4000), random.randrange(800),
+                                     random.randrange(1000), random.random() * 60))
+            if len(batch) == 100_000:
+                file.write(b"".join(batch))
+                batch = []
+        file.write(b"".join(batch))
+
+
+def run(args: argparse.Namespace) -> None:
+    from bot.usage import report
+    from bot.utils.usage import compact
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "usage.bin")
+        print(f"record(): {asyncio.run(hot_path(path, args.calls)) * 1e6:.2f} us per call")
+        os.remove(path)
+
+        fill(path, args.records, args.users, args.days)
+        print(f"ledger: {args.records} raw records, {os.path.getsize(path) / 1e6:.1f} MB")
+        for by in (["model"], ["user"], ["user", "model", "day"]):
+            started = time.perf_counter()
+            rows = len(report(path, by)) - 1
+            print(f"  by {' '.join(by):<15} {rows:>7} rows in {time.perf_counter() - started:.2f}s")
+
+        started = time.perf_counter()
+        folded = compact(path)
+        print(f"compaction: {folded} records folded in {time.perf_counter() - started:.2f}s, "
+              f"{os.path.getsize(path + '.daily') / 1e6:.1f} MB left")
+        for by in (["model"], ["user"], ["user", "model", "day"]):
+            started = time.perf_counter()
+            rows = len(report(path, by)) - 1
+            print(f"  by {' '.join(by):<15} {rows:>7} rows in {time.perf_counter() - started:.2f}s")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--records", type=int, default=2_000_000)
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--calls", type=int, default=200_000, help="record() calls timed on the hot path")
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
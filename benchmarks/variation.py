@@ -0,0 +1,70 @@
+"""
+Total latency of the "variation" feature against generating and sending the images one after another.
+
+Runs against a fake Telegram Bot API and a fake OpenAI server. The sequential baseline makes one image request at a
+time and sends every image with its own send_photo; the variation job requests them at once (one request with n for
+dall-e-2, parallel requests for dall-e-3) and sends one album.
+
+Usage:
+    python -m benchmarks.variation --images 4 --latency 2 --telegram-latency 0.1
+"""
+import argparse
+import asyncio
+import os
+import time
+
+
+async def run(args: argparse.Namespace) -> None:
+    from benchmarks.fake_openai import FakeOpenAI
+    from benchmarks.fake_telegram import FAKE_TOKEN, FakeTelegram
+
+    telegram = FakeTelegram(latency=args.telegram_latency)
+    openai = FakeOpenAI(latency=args.latency)
+    await telegram.start()
+    await openai.start()
+    os.environ.update(TOKEN_TELEGRAM=FAKE_TOKEN, TELEGRAM_API_URL=telegram.base_url, OPENAI_API="fake",
+                      OPENAI_BASE_URL=openai.base_url)
+
+    from bot.config import close_client
+    from bot.dispatcher import create_bot
+    from bot.handlers.api.image import _generate_image, variation_job
+    from bot.utils.jobs import Job
+
+    bot = create_bot()
+    try:
+        for model in ("dall-e-3", "dall-e-2"):
+            requests = openai.requests
+            started = time.perf_counter()
+            for index in range(args.images):
+                url = await _generate_image(f"sequential {model} {index}", model)
+                await bot.send_photo(chat_id=1, photo=url)
+            sequential = time.perf_counter() - started
+            sequential_requests = openai.requests - requests
+
+            requests = openai.requests
+            payload = {"prompt": f"variation {model}", "model": model, "count": args.images, "wait_message_id": 1}
+            started = time.perf_counter()
+            await variation_job(bot, Job(id=0, kind="variation", chat_id=1, payload=payload, attempts=1))
+            fan_out = time.perf_counter() - started
+            fan_out_requests = openai.requests - requests
+
+            print(f"{model}: sequential {sequential:.2f}s ({sequential_requests} requests, {args.images} photos), "
+                  f"variation {fan_out:.2f}s ({fan_out_requests} requests, 1 album), "
+                  f"speedup {sequential / fan_out:.1f}x")
+    finally:
+        await bot.session.close()
+        await close_client()
+        await telegram.stop()
+        await openai.stop()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=2.0, help="delay of every image request")
+    parser.add_argument("--telegram-latency", type=float, default=0.1, help="delay of every Bot API call")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Webhook throughput against the number of worker processes.
+
+Runs the webhook front and its workers against a fake Telegram Bot API, posts /start updates from many chats as
+Telegram would and measures how many updates per second are fully handled (answer sent back to the fake API).
+
+Usage:
+    python -m benchmarks.webhook_load --workers 1 2 4 --updates 4000
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import time
+
+import aiohttp
+
+from benchmarks.fake_telegram import FAKE_TOKEN, FakeTelegram, message_update
+
+
+def _run_fake_telegram(port_queue: multiprocessing.Queue) -> None:
+    async def serve() -> None:
+        server = FakeTelegram()
+        await server.start()
+        port_queue.put(server.port)
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+def _run_front(workers: int) -> None:
+    from bot.webhook import run_webhook
+
+    run_webhook(workers=workers)
+
+
+async def _wait_until_up(session: aiohttp.ClientSession, url: str) -> None:
+    for _ in range(200):
+        try:
+            async with session.post(url, json=message_update(0, "/start")):
+                return
+        except aiohttp.ClientConnectionError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError("webhook front did not start")
+
+
+async def _sent(session: aiohttp.ClientSession, telegram_url: str) -> int:
+    async with session.get(f"{telegram_url}/stats") as response:
+        return (await response.json())["sent"]
+
+
+async def load(webhook_url: str, telegram_url: str, workers: int, updates: int, chats: int,
+               concurrency: int) -> float:
+    async with aiohttp.ClientSession() as session:
+        baseline = await _sent(session, telegram_url)
+        await _wait_until_up(session, webhook_url)
+        # Warm up every worker (chat i goes to worker i) before the clock starts
+        for chat_id in range(1, workers):
+            async with session.post(webhook_url, json=message_update(chat_id, "/start")):
+                pass
+        while await _sent(session, telegram_url) - baseline < workers:
+            await asyncio.sleep(0.05)
+        baseline += workers
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def post(index: int) -> None:
+            async with semaphore:
+                async with session.post(webhook_url, json=message_update(1000 + index % chats, "/start")):
+                    pass
+
+        started = time.perf_counter()
+        await asyncio.gather(*(post(index) for index in range(updates)))
+        while await _sent(session, telegram_url) - baseline < updates:
+            await asyncio.sleep(0.01)
+        return updates / (time.perf_counter() - started)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--updates", type=int, default=4000)
+    parser.add_argument("--chats", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--port", type=int, default=18080)
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    port_queue = context.Queue()
+    telegram = context.Process(target=_run_fake_telegram, args=(port_queue,), daemon=True)
+    telegram.start()
+    telegram_url = f"http://127.0.0.1:{port_queue.get()}"
+
+    os.environ.update(TOKEN_TELEGRAM=FAKE_TOKEN, TELEGRAM_API_URL=telegram_url, OPENAI_API="fake",
+                      WEBHOOK_HOST="127.0.0.1", WEBHOOK_PORT=str(args.port))
+    os.environ.pop("WEBHOOK_URL", None)
+    # The fake Bot API has no flood limits, so pacing the messages would only measure the limits (see
+    # benchmarks.outbound); OUTBOUND_SCHEDULER=1 turns it back on
+    os.environ.setdefault("OUTBOUND_SCHEDULER", "0")
+    webhook_url = f"http://127.0.0.1:{args.port}/webhook"
+
+    for workers in args.workers:
+        front = context.Process(target=_run_front, args=(workers,))
+        front.start()
+        try:
+            rate = asyncio.run(load(webhook_url, telegram_url, workers, args.updates, args.chats, args.concurrency))
+            print(f"workers={workers} updates/sec={rate:.0f}")
+        finally:
+            front.terminate()
+            front.join()
+    telegram.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,12 @@
 import asyncio
 import logging
-from pathlib import Path
 
-from aiogram import Bot, Dispatcher
-# from aiogram.enums.parse_mode import ParseMode
-from aiogram.fsm.storage.memory import MemoryStorage
-
-from bot import setup_routers
-from bot.config import TOKEN_TELEGRAM
-from bot.middlewares.I10n import L10nMiddleware
-from bot.utils.fluent_helper import FluentDispenser
+from bot.config import (WEBHOOK_URL, WEBHOOK_WORKERS, METRICS_HOST, METRICS_PORT, JOB_QUEUE_PATH, JOB_PROCESSES,
+                        runtime)
+from bot.dispatcher import create_bot, create_dispatcher
+from bot.jobs import job_workers
+from bot.utils.metrics import start_metrics_server
+from bot.webhook import run_webhook
 
 
 async def main():
@@ -21,22 +18,15 @@ async def main():
     Returns:
         None
     """
-    # Initialize the bot with the Telegram token and set the parse mode to HTML
-    bot = Bot(token=TOKEN_TELEGRAM)
-
-    # Initialize the dispatcher with memory storage
-    dp = Dispatcher(storage=MemoryStorage())
+    # Initialize the bot with the Telegram token
+    bot = create_bot()
 
-    # Set up the routers for handling different types of updates
-    router = setup_routers()
-    dp.include_routers(router)
+    # Initialize the dispatcher with its storage, routers and middlewares
+    dp = create_dispatcher()
 
-    # Initialize the localization middleware
-    dispenser = FluentDispenser(
-        locales_dir=Path(__file__).parent.joinpath("bot/locales"),
-        default_language="en"
-    )
-    dp.update.middleware(L10nMiddleware(dispenser))
+    # Serve the Prometheus metrics when a port is configured
+    if METRICS_PORT:
+        await start_metrics_server(METRICS_HOST, METRICS_PORT)
 
     # Delete any existing webhooks and start polling for updates
     await bot.delete_webhook(drop_pending_updates=True)
@@ -47,7 +37,7 @@ if __name__ == "__main__":
     """
     This is the entry point of the script.
 
-    It sets up logging and starts the main function.
+    It sets up logging and starts the bot, in webhook mode when WEBHOOK_URL is set and by polling otherwise.
     """
     # Setup logging
     logging.basicConfig(
@@ -55,8 +45,15 @@ if __name__ == "__main__":
         format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
     )
 
-    # Start the main function
+    # Run on the event loop of the runtime profile (RUNTIME_PROFILE)
+    runtime.install()
+
+    # Start the bot, with separate processes for the background jobs when they are configured
     try:
-        asyncio.run(main())
+        with job_workers(JOB_PROCESSES if JOB_QUEUE_PATH else 0):
+            if WEBHOOK_URL:
+                run_webhook(workers=WEBHOOK_WORKERS)
+            else:
+                asyncio.run(main())
     except (KeyboardInterrupt, SystemExit):
         pass
@@ -1,19 +1,43 @@
 from aiogram import Router
 
-from .handlers.api.image import router_image
-from .handlers.api.speech_to_text import router_speech_to_text
-from .handlers.api.text import router_text
-from .handlers.api.text_to_speech import router_text_to_speech
-from .handlers.api.vision import router_vision
-from .handlers.start import router_start
+from .config import LAZY_LOADING, job_queue
+from .states.state import (StateText, StateImage, StateVariation, StateTextToSpeech, StateSpeechToText,
+                           StateVisionUrl, StateVisionPhoto)
+from .utils.lazy import LazyRouter
+
+# Modules whose jobs run in the background, imported when the first job of their kind runs
+job_queue.lazy("image", "bot.handlers.api.image")
+job_queue.lazy("variation", "bot.handlers.api.image")
+job_queue.lazy("text_to_speech", "bot.handlers.api.text_to_speech")
+job_queue.lazy("speech_to_text", "bot.handlers.api.speech_to_text")
 
 
 def setup_routers() -> Router:
+    """
+    This function builds the router tree of the bot, one router per feature.
+
+    Every feature module is imported on the first update that leads into it, unless LAZY_LOADING is off.
+
+    Returns:
+        Router: The root router.
+    """
+    features = [
+        LazyRouter("bot.handlers.start", "router_start", commands=["start"]),
+        LazyRouter("bot.handlers.api.text", "router_text", callbacks=["text"], callback_prefixes=["gpt-"],
+                   states=[StateText]),
+        LazyRouter("bot.handlers.api.image", "router_image", callbacks=["image", "variation"],
+                   callback_prefixes=["dall", "variation-"], states=[StateImage, StateVariation]),
+        LazyRouter("bot.handlers.api.text_to_speech", "router_text_to_speech", callbacks=["text_to_speech"],
+                   callback_prefixes=["tts"], states=[StateTextToSpeech]),
+        LazyRouter("bot.handlers.api.speech_to_text", "router_speech_to_text", callbacks=["speech_to_text"],
+                   callback_prefixes=["whisper"], states=[StateSpeechToText]),
+        LazyRouter("bot.handlers.api.vision", "router_vision",
+                   callbacks=["vision", "gpt_4_vision_preview", "upload", "upload_url"],
+                   states=[StateVisionPhoto, StateVisionUrl]),
+    ]
     router = Router()
-    router.include_router(router=router_start)
-    router.include_router(router=router_text)
-    router.include_router(router=router_image)
-    router.include_router(router=router_text_to_speech)
-    router.include_router(router=router_speech_to_text)
-    router.include_router(router=router_vision)
+    for feature in features:
+        router.include_router(router=feature)
+        if not LAZY_LOADING:
+            feature.load()
     return router
@@ -1,13 +1,351 @@
 import os
+from pathlib import Path
 
-import openai
+import httpx
 from dotenv import load_dotenv
 
+from bot.utils.asset_cache import AssetCache
+from bot.utils.completion_cache import CompletionCache, SqliteCompletionBackend
+from bot.utils.conversation import CONTEXT_BUDGETS
+from bot.utils.fluent_helper import FluentDispenser
+from bot.utils.jobs import JobQueue, SqliteJobBackend
+from bot.utils.lazy import LazyObject
+from bot.utils.metrics import MetricsTransport, StatsGauge, registry
+from bot.utils.outbound import OutboundScheduler
+from bot.utils.rate_limiter import RateLimit
+from bot.utils.resilience import Resilience
+from bot.utils.runtime import Runtime
+from bot.utils.scheduler import UpstreamScheduler
+from bot.utils.single_flight import SingleFlight
+from bot.utils.tracing import Tracer
+from bot.utils.usage import UsageLedger
+
 load_dotenv()
 
 # Load environment variables
 TOKEN_TELEGRAM = os.getenv("TOKEN_TELEGRAM")
+# Base URL of a local Bot API server, the public one is used when it is not set
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+
+# Webhook mode is used instead of polling when WEBHOOK_URL (the public URL Telegram posts to) is set
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", str(os.cpu_count() or 1)))
+# Updates waiting for a worker, and updates a worker handles at once; Telegram gets a 503 when a queue is full
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+WEBHOOK_WORKER_UPDATES = int(os.getenv("WEBHOOK_WORKER_UPDATES", "1000"))
+# Seconds the workers get on shutdown to finish the updates they received before they are terminated
+WEBHOOK_SHUTDOWN_TIMEOUT = float(os.getenv("WEBHOOK_SHUTDOWN_TIMEOUT", "30"))
 OPENAI_API = os.getenv("OPENAI_API")
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL")
 MONGO_URL = os.getenv("MONGO_URL")
+MONGO_DB = os.getenv("MONGO_DB", "telegram_bot")
+
+# FSM records of hot chats kept in process when the FSM lives in MongoDB
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", "10000"))
+
+# Connection pool settings for the shared OpenAI HTTP client
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "100"))
+OPENAI_MAX_KEEPALIVE = int(os.getenv("OPENAI_MAX_KEEPALIVE", "20"))
+OPENAI_KEEPALIVE_EXPIRY = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY", "30"))
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "600"))
+
+# Retries of failed OpenAI calls: the attempts of a call, the seconds one attempt and the whole call may take, and
+# the share of calls that may be retried
+OPENAI_MAX_ATTEMPTS = int(os.getenv("OPENAI_MAX_ATTEMPTS", "3"))
+OPENAI_ATTEMPT_TIMEOUT = float(os.getenv("OPENAI_ATTEMPT_TIMEOUT", "120"))
+OPENAI_DEADLINE = float(os.getenv("OPENAI_DEADLINE", "300"))
+OPENAI_RETRY_RATIO = float(os.getenv("OPENAI_RETRY_RATIO", "0.1"))
+# Seconds a streamed answer may go without a chunk before it is given up
+OPENAI_STREAM_IDLE_TIMEOUT = float(os.getenv("OPENAI_STREAM_IDLE_TIMEOUT", "60"))
+# Failures in a row after which a model is not called for CIRCUIT_RESET seconds
+CIRCUIT_FAILURES = int(os.getenv("CIRCUIT_FAILURES", "5"))
+CIRCUIT_RESET = float(os.getenv("CIRCUIT_RESET", "30"))
+# Seconds after which a slow call is raced against a second one, as "model=seconds", e.g. "gpt-3.5-turbo=8"
+OPENAI_HEDGE_AFTER = {}
+for _item in filter(None, os.getenv("OPENAI_HEDGE_AFTER", "").split(",")):
+    _model, _, _seconds = _item.partition("=")
+    OPENAI_HEDGE_AFTER[_model] = float(_seconds)
+
+# Stream chat completions into Telegram by editing the placeholder message
+TEXT_STREAMING = os.getenv("TEXT_STREAMING", "1") == "1"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+
+# Per-chat conversation history for the text models, with the prompt budget of each model ("gpt-4=6000,gpt-4o=16000")
+CONVERSATION_MEMORY = os.getenv("CONVERSATION_MEMORY", "1") == "1"
+CONTEXT_BUDGETS = {**CONTEXT_BUDGETS, **{
+    model: int(budget) for model, _, budget in
+    (item.partition("=") for item in os.getenv("CONTEXT_BUDGETS", "").split(",") if item)
+}}
+# Summarize turns dropped from the history instead of forgetting them
+HISTORY_SUMMARY = os.getenv("HISTORY_SUMMARY", "0") == "1"
+HISTORY_SUMMARY_MODEL = os.getenv("HISTORY_SUMMARY_MODEL", "gpt-4o-mini")
+
+# Per-user limits of each feature as "feature=requests/seconds", e.g. "text=20/60,image=5/60"
+RATE_LIMITS = {
+    "text": RateLimit(limit=20, period=60),
+    "image": RateLimit(limit=5, period=60),
+    "variation": RateLimit(limit=2, period=60),
+    "tts": RateLimit(limit=10, period=60),
+    "stt": RateLimit(limit=10, period=60),
+    "vision": RateLimit(limit=10, period=60),
+    "callback": RateLimit(limit=60, period=60),
+}
+for _item in filter(None, os.getenv("RATE_LIMITS", "").split(",")):
+    _feature, _, _limit = _item.partition("=")
+    _requests, _, _seconds = _limit.partition("/")
+    RATE_LIMITS[_feature] = RateLimit(limit=int(_requests), period=float(_seconds or 60))
+# The feature whose limit applies to messages sent in each state group, overridden as "StateGroup=feature", e.g.
+# "StateVisionUrl=vision_url" to give a state group a limit ("vision_url=5/60" in RATE_LIMITS) of its own
+STATE_FEATURES = {
+    "StateText": "text",
+    "StateImage": "image",
+    "StateVariation": "variation",
+    "StateTextToSpeech": "tts",
+    "StateSpeechToText": "stt",
+    "StateVisionUrl": "vision",
+    "StateVisionPhoto": "vision",
+}
+STATE_FEATURES.update(item.split("=", 1) for item in os.getenv("STATE_FEATURES", "").split(",") if item)
+# The feature of the buttons whose callback data starts with each prefix, overridden as "prefix=feature". A button
+# press is counted against "callback:<feature>", limited by that entry of RATE_LIMITS or else by "callback"
+CALLBACK_FEATURES = {
+    "text": "text",
+    "gpt-": "text",
+    "image": "image",
+    "dall": "image",
+    "variation": "variation",
+    "text_to_speech": "tts",
+    "tts": "tts",
+    "speech_to_text": "stt",
+    "whisper": "stt",
+    "vision": "vision",
+    "gpt_4_vision_preview": "vision",
+    "upload": "vision",
+}
+CALLBACK_FEATURES.update(item.split("=", 1) for item in os.getenv("CALLBACK_FEATURES", "").split(",") if item)
+
+# Downloaded media larger than this many bytes is spooled to a temporary file instead of memory
+MEDIA_SPOOL_SIZE = int(os.getenv("MEDIA_SPOOL_SIZE", str(5 * 1024 * 1024)))
+
+# Detail of photos sent to the vision model: "low" (a 512px version at a fixed token cost) or "high"
+VISION_DETAIL = os.getenv("VISION_DETAIL", "high")
+# Photos are shrunk to the resolution the vision model works at before the upload, when Pillow is installed
+VISION_DOWNSCALE = os.getenv("VISION_DOWNSCALE", "1") == "1"
+VISION_JPEG_QUALITY = int(os.getenv("VISION_JPEG_QUALITY", "85"))
+
+# Recordings longer than this many seconds are split and their parts transcribed at once, at most STT_PARALLEL
+# parts of one recording at a time
+STT_SEGMENT_SECONDS = int(os.getenv("STT_SEGMENT_SECONDS", "60"))
+STT_PARALLEL = int(os.getenv("STT_PARALLEL", "4"))
+
+# Long texts are spoken in chunks of whole sentences of at most TTS_CHUNK_CHARS (the API takes 4096), generated
+# TTS_PARALLEL at a time and sent in order; the first chunk is kept short so the first audio arrives sooner.
+# TTS_PIPELINE=0 speaks every text in one piece.
+TTS_PIPELINE = os.getenv("TTS_PIPELINE", "1") == "1"
+TTS_CHUNK_CHARS = min(int(os.getenv("TTS_CHUNK_CHARS", "1000")), 4096)
+TTS_FIRST_CHUNK_CHARS = int(os.getenv("TTS_FIRST_CHUNK_CHARS", "200"))
+TTS_PARALLEL = int(os.getenv("TTS_PARALLEL", "3"))
+
+# Images made at once by the "variation" feature, sent as one album (at most 10)
+VARIATION_COUNT = min(int(os.getenv("VARIATION_COUNT", "4")), 10)
+
+# Generated images and voices whose Telegram file_id is reused for identical requests
+ASSET_CACHE_SIZE = int(os.getenv("ASSET_CACHE_SIZE", "10000"))
+ASSET_CACHE_TTL = float(os.getenv("ASSET_CACHE_TTL", str(7 * 24 * 3600)))
+
+# Optional cache of chat completions for repeated questions
+COMPLETION_CACHE = os.getenv("COMPLETION_CACHE", "0") == "1"
+COMPLETION_CACHE_SIZE = int(os.getenv("COMPLETION_CACHE_SIZE", "10000"))
+COMPLETION_CACHE_TTL = float(os.getenv("COMPLETION_CACHE_TTL", str(24 * 3600)))
+COMPLETION_CACHE_PATH = os.getenv("COMPLETION_CACHE_PATH")
+COMPLETION_CACHE_DISABLED_MODELS = [model for model in os.getenv("COMPLETION_CACHE_DISABLED_MODELS", "").split(",")
+                                    if model]
+
+# Requests waiting for a single model above which new requests are answered with "busy"
+SCHEDULER_MAX_QUEUE = int(os.getenv("SCHEDULER_MAX_QUEUE", "100"))
+
+# Long generations (images, speech, transcriptions) run as background jobs kept in this SQLite file when it is
+# set, and inline in the handler otherwise
+JOB_QUEUE_PATH = os.getenv("JOB_QUEUE_PATH")
+# Number of separate job worker processes; 0 runs the jobs inside the bot process(es)
+JOB_PROCESSES = int(os.getenv("JOB_PROCESSES", "0"))
+# Jobs of each kind run at once by one process as "kind=jobs", e.g. "image=2,text_to_speech=8"
+JOB_CONCURRENCY = {
+    "image": 4,
+    "variation": 2,
+    "text_to_speech": 8,
+    "speech_to_text": 4,
+}
+for _item in filter(None, os.getenv("JOB_CONCURRENCY", "").split(",")):
+    _kind, _, _jobs = _item.partition("=")
+    JOB_CONCURRENCY[_kind] = int(_jobs)
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "5"))
+# Seconds after which the job of a worker that died is claimed again; running jobs renew their lease
+JOB_LEASE = float(os.getenv("JOB_LEASE", "120"))
+
+# Identical requests made at the same time (e.g. the same prompt going viral) share one OpenAI call
+SINGLE_FLIGHT = os.getenv("SINGLE_FLIGHT", "1") == "1"
+
+# Feature modules, locales and the OpenAI client are loaded on first use; 0 loads everything at startup
+LAZY_LOADING = os.getenv("LAZY_LOADING", "1") == "1"
+
+# Outbound Telegram limits: messages in any second for the whole bot (shared by its processes), and
+# "messages/seconds" for one private chat and for one group
+OUTBOUND_SCHEDULER = os.getenv("OUTBOUND_SCHEDULER", "1") == "1"
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+_requests, _, _seconds = os.getenv("TELEGRAM_CHAT_LIMIT", "3/3").partition("/")
+TELEGRAM_CHAT_LIMIT = RateLimit(limit=int(_requests), period=float(_seconds or 3))
+_requests, _, _seconds = os.getenv("TELEGRAM_GROUP_LIMIT", "20/60").partition("/")
+TELEGRAM_GROUP_LIMIT = RateLimit(limit=int(_requests), period=float(_seconds or 60))
+# Seconds an answer may take before a "wait" message is shown; quicker answers are sent without one
+PLACEHOLDER_DELAY = float(os.getenv("PLACEHOLDER_DELAY", "0.5"))
+
+# Seconds between checks for changed locale files, whose texts and menus are then rendered again; 0 never checks
+LOCALES_RELOAD_INTERVAL = float(os.getenv("LOCALES_RELOAD_INTERVAL", "0"))
+
+# Append-only ledger of the OpenAI usage of every user, off when no path is set; see python -m bot.usage
+USAGE_LEDGER_PATH = os.getenv("USAGE_LEDGER_PATH")
+USAGE_FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", "1"))
+USAGE_COMPACT_INTERVAL = float(os.getenv("USAGE_COMPACT_INTERVAL", "3600"))
+
+# Per-update traces in the Chrome trace format (open them in ui.perfetto.dev), off when no path is set: a share
+# TRACE_SAMPLE_RATE of the updates is traced, and every update slower than TRACE_SLOW_SECONDS when it is set. Every
+# process writes its own file, TRACE_PATH with its pid added, rotated at TRACE_MAX_BYTES with TRACE_BACKUPS kept.
+TRACE_PATH = os.getenv("TRACE_PATH")
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+TRACE_SLOW_SECONDS = float(os.getenv("TRACE_SLOW_SECONDS", "0"))
+TRACE_MAX_BYTES = int(os.getenv("TRACE_MAX_BYTES", str(100 * 1024 * 1024)))
+TRACE_BACKUPS = int(os.getenv("TRACE_BACKUPS", "3"))
+
+# What the bot runs on: "default" (asyncio, json, aiogram's session) or "fast" (uvloop, orjson and a Telegram session
+# with RUNTIME_TELEGRAM_CONNECTIONS connections, DNS answers kept RUNTIME_DNS_CACHE seconds and idle connections
+# kept RUNTIME_KEEPALIVE seconds); the fast profile does without uvloop or orjson when they are not installed, see
+# requirements-fast.txt
+RUNTIME_PROFILE = os.getenv("RUNTIME_PROFILE", "default")
+RUNTIME_TELEGRAM_CONNECTIONS = int(os.getenv("RUNTIME_TELEGRAM_CONNECTIONS", "100"))
+RUNTIME_DNS_CACHE = float(os.getenv("RUNTIME_DNS_CACHE", "300"))
+RUNTIME_KEEPALIVE = float(os.getenv("RUNTIME_KEEPALIVE", "60"))
+
+# Prometheus metrics are served on http://METRICS_HOST:METRICS_PORT/metrics when the port is set; in webhook mode
+# worker i serves its own on METRICS_PORT + i
+METRICS_HOST = os.getenv("METRICS_HOST", "0.0.0.0")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0")) or None
+
+
+# The event loop, JSON and HTTP sessions of the runtime profile
+runtime = Runtime(RUNTIME_PROFILE, telegram_connections=RUNTIME_TELEGRAM_CONNECTIONS, dns_cache_ttl=RUNTIME_DNS_CACHE,
+                  keepalive_timeout=RUNTIME_KEEPALIVE)
+
+
+def _create_client():
+    # openai is the heaviest import of the bot after aiogram, so it is imported on the first OpenAI call
+    import openai
+
+    # One keep-alive connection pool shared by every OpenAI call in the bot, timed by the metrics transport
+    http_client = runtime.openai_http_client(
+        transport=MetricsTransport(httpx.AsyncHTTPTransport(
+            limits=httpx.Limits(
+                max_connections=OPENAI_MAX_CONNECTIONS,
+                max_keepalive_connections=OPENAI_MAX_KEEPALIVE,
+                keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY,
+            ),
+        )),
+        timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=5.0),
+    )
+    # Retries are made by the resilience layer, which knows the deadline and the retry budget
+    return openai.AsyncOpenAI(api_key=OPENAI_API, base_url=OPENAI_BASE_URL, http_client=http_client, max_retries=0)
+
+
+# The shared OpenAI client, built on first use
+client = LazyObject(_create_client)
+
+
+async def close_client() -> None:
+    """
+    This function closes the connection pool of the shared OpenAI client, if it was ever opened.
+    """
+    if client.loaded:
+        await client.close()
+
+
+# Every process that calls OpenAI and sends messages (polling or webhook workers, job workers) gets its share of the
+# upstream budgets and of the global Telegram limit
+_PROCESSES = (WEBHOOK_WORKERS if WEBHOOK_URL else 1) + (JOB_PROCESSES if JOB_QUEUE_PATH else 0)
+
+# Per-model budgets and fair queuing in front of every OpenAI call
+scheduler = UpstreamScheduler(max_queue=SCHEDULER_MAX_QUEUE, processes=_PROCESSES)
+
+# Retries, hedging and circuit breaking around every OpenAI call
+resilience = Resilience(
+    max_attempts=OPENAI_MAX_ATTEMPTS,
+    deadline=OPENAI_DEADLINE,
+    attempt_timeout=OPENAI_ATTEMPT_TIMEOUT,
+    retry_ratio=OPENAI_RETRY_RATIO,
+    failure_threshold=CIRCUIT_FAILURES,
+    reset_timeout=CIRCUIT_RESET,
+    hedge_after=OPENAI_HEDGE_AFTER,
+    stream_idle_timeout=OPENAI_STREAM_IDLE_TIMEOUT,
+)
+
+# Shared in-flight calls, in front of the scheduler so joined requests do not take a slot
+single_flight = SingleFlight(enabled=SINGLE_FLIGHT)
+
+# Texts of every language, used by the handlers and by the background jobs to report failures
+dispenser = FluentDispenser(
+    locales_dir=Path(__file__).parent.joinpath("locales"),
+    default_language="en",
+    preload=not LAZY_LOADING,
+    reload_interval=LOCALES_RELOAD_INTERVAL,
+)
+
+# Background jobs, run inline when no queue file is configured
+job_queue = JobQueue(
+    backend=SqliteJobBackend(JOB_QUEUE_PATH) if JOB_QUEUE_PATH else None,
+    concurrency=JOB_CONCURRENCY,
+    max_attempts=JOB_MAX_ATTEMPTS,
+    lease=JOB_LEASE,
+    dispenser=dispenser,
+)
+
+# Flood limits and priorities of the messages the bot sends, applied to the session of every Bot
+outbound = OutboundScheduler(
+    global_limit=RateLimit(limit=max(1, int(TELEGRAM_GLOBAL_RATE / _PROCESSES)), period=1),
+    chat_limit=TELEGRAM_CHAT_LIMIT,
+    group_limit=TELEGRAM_GROUP_LIMIT,
+)
+
+# Telegram file_ids of generated assets, keyed by what they were generated from
+asset_cache = AssetCache(max_entries=ASSET_CACHE_SIZE, ttl=ASSET_CACHE_TTL)
+
+# Answers to repeated questions, None when the completion cache is turned off
+completion_cache = CompletionCache(
+    max_entries=COMPLETION_CACHE_SIZE,
+    ttl=COMPLETION_CACHE_TTL,
+    backend=SqliteCompletionBackend(COMPLETION_CACHE_PATH) if COMPLETION_CACHE_PATH else None,
+    disabled_models=COMPLETION_CACHE_DISABLED_MODELS,
+) if COMPLETION_CACHE else None
+
+# Tokens, images and audio spent per user and model
+usage = UsageLedger(USAGE_LEDGER_PATH, flush_interval=USAGE_FLUSH_INTERVAL, compact_interval=USAGE_COMPACT_INTERVAL)
+
+# Sampled traces of updates, with every slow one
+tracer = Tracer(TRACE_PATH, sample_rate=TRACE_SAMPLE_RATE, slow_threshold=TRACE_SLOW_SECONDS,
+                max_bytes=TRACE_MAX_BYTES, backups=TRACE_BACKUPS)
 
-client = openai.OpenAI(api_key=OPENAI_API)
+# Expose the counters the scheduler and the caches already keep
+registry.add(StatsGauge("bot_scheduler", "Upstream scheduler", scheduler.stats, labelname="model"))
+registry.add(StatsGauge("bot_resilience", "OpenAI retries and circuits", resilience.stats, labelname="model"))
+registry.add(StatsGauge("bot_single_flight", "Single-flight calls", single_flight.stats, labelname="endpoint"))
+registry.add(StatsGauge("bot_outbound", "Outbound Telegram messages", outbound.stats))
+registry.add(StatsGauge("bot_jobs", "Background jobs", job_queue.stats, labelname="kind"))
+registry.add(StatsGauge("bot_asset_cache", "Asset cache", asset_cache.stats))
+if usage.enabled:
+    registry.add(StatsGauge("bot_usage_ledger", "Usage ledger", usage.stats))
+if tracer.enabled:
+    registry.add(StatsGauge("bot_tracing", "Update tracing", tracer.stats))
+if completion_cache is not None:
+    registry.add(StatsGauge("bot_completion_cache", "Completion cache", completion_cache.stats))
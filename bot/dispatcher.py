@@ -0,0 +1,117 @@
+from typing import Any
+
+from aiogram import BaseMiddleware, Bot, Dispatcher
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from bot import setup_routers
+from bot.config import (TOKEN_TELEGRAM, TELEGRAM_API_URL, MONGO_URL, MONGO_DB, FSM_CACHE_SIZE, RATE_LIMITS,
+                        STATE_FEATURES, CALLBACK_FEATURES, JOB_PROCESSES, LAZY_LOADING,
+                        OUTBOUND_SCHEDULER, close_client, client, dispenser, job_queue, outbound, runtime, tracer,
+                        usage)
+from bot.middlewares.I10n import L10nMiddleware
+from bot.middlewares.metrics import UpdateMetricsMiddleware, HandlerMetricsMiddleware, TelegramMetricsMiddleware
+from bot.middlewares.scheduler import SchedulerMiddleware
+from bot.middlewares.throttling import ThrottlingMiddleware
+from bot.middlewares.tracing import (TracingMiddleware, TracedMiddleware, HandlerTracingMiddleware,
+                                     TelegramTracingMiddleware)
+from bot.utils.fsm_storage import CachedStorage, MongoBackend
+from bot.utils.rate_limiter import RateLimiter
+from bot.utils.tracing import TracedStorage
+
+
+def create_bot() -> Bot:
+    """
+    This function creates the bot, talking to TELEGRAM_API_URL instead of the public Bot API when it is set, over
+    the session of the runtime profile.
+
+    The messages it sends go through the outbound scheduler, and every Bot API call it makes is timed for the
+    metrics.
+
+    Returns:
+        Bot: The bot.
+    """
+    session = runtime.telegram_session(TelegramAPIServer.from_base(TELEGRAM_API_URL) if TELEGRAM_API_URL else None)
+    bot = Bot(token=TOKEN_TELEGRAM, session=session)
+    # Calls of traced updates are timed from the outside, so their spans include the wait for the scheduler
+    if tracer.enabled:
+        bot.session.middleware(TelegramTracingMiddleware())
+    # Messages wait for their turn under the flood limits first, so the metrics time only the calls themselves
+    if OUTBOUND_SCHEDULER:
+        bot.session.middleware(outbound)
+    bot.session.middleware(TelegramMetricsMiddleware())
+    return bot
+
+
+def _traced(middleware: BaseMiddleware) -> BaseMiddleware:
+    # Middlewares are wrapped in spans only when tracing is on, so they cost nothing otherwise
+    return TracedMiddleware(middleware) if tracer.enabled else middleware
+
+
+def create_dispatcher(**kwargs: Any) -> Dispatcher:
+    """
+    This function creates the dispatcher with its storage, routers and middlewares.
+
+    It is shared by the polling entry point and every webhook worker, so they all handle updates the same way.
+
+    Args:
+        **kwargs: Extra arguments for the Dispatcher, e.g. events_isolation.
+
+    Returns:
+        Dispatcher: The dispatcher.
+    """
+    # Keep the FSM in MongoDB when it is configured, so it survives restarts and is shared between processes
+    if MONGO_URL:
+        storage = CachedStorage(MongoBackend(MONGO_URL, database=MONGO_DB), cache_size=FSM_CACHE_SIZE)
+    else:
+        storage = MemoryStorage()
+    if tracer.enabled:
+        storage = TracedStorage(storage)
+    dp = Dispatcher(storage=storage, **kwargs)
+
+    # Trace the updates the tracer picks from before the FSM middleware, so the trace spans the event isolation lock
+    # and the state read of every update; aiogram registers the FSM middleware itself, so it is moved behind
+    if tracer.enabled:
+        dp.update.outer_middleware.unregister(dp.fsm)
+        dp.update.outer_middleware(TracingMiddleware(tracer))
+        dp.update.outer_middleware(TracedMiddleware(dp.fsm))
+
+    # Time every update from the outside, so the latency includes the middlewares below
+    dp.update.outer_middleware(UpdateMetricsMiddleware())
+
+    # Set up the routers for handling different types of updates
+    dp.include_routers(setup_routers())
+
+    # Initialize the localization middleware
+    dp.update.middleware(_traced(L10nMiddleware(dispenser)))
+
+    # Drop updates of users who exceed their per-feature limits before they reach the handlers
+    dp.update.middleware(_traced(ThrottlingMiddleware(RateLimiter(RATE_LIMITS), STATE_FEATURES, CALLBACK_FEATURES)))
+
+    # Tag upstream requests with their user and answer shed requests with a "busy" message
+    dp.update.middleware(_traced(SchedulerMiddleware()))
+
+    # Time every handler; inner middlewares of the dispatcher also apply to the nested routers
+    handler_metrics = HandlerMetricsMiddleware()
+    dp.message.middleware(handler_metrics)
+    dp.callback_query.middleware(handler_metrics)
+    if tracer.enabled:
+        handler_tracing = HandlerTracingMiddleware()
+        dp.message.middleware(handler_tracing)
+        dp.callback_query.middleware(handler_tracing)
+
+    # Run the background jobs in this process, unless they have processes of their own
+    if job_queue.enabled and not JOB_PROCESSES:
+        dp.startup.register(job_queue.start)
+        dp.shutdown.register(job_queue.stop)
+
+    # Close the shared OpenAI connection pool when the dispatcher stops
+    if not LAZY_LOADING:
+        client.load()
+    dp.shutdown.register(close_client)
+    # Write the usage records still buffered
+    dp.shutdown.register(usage.close)
+    # Write the traces still kept and close the trace file
+    if tracer.enabled:
+        dp.shutdown.register(tracer.close)
+    return dp
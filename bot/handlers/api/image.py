@@ -1,13 +1,29 @@
+import asyncio
+import contextlib
+from typing import AsyncIterator, Union
+
 import openai
-from aiogram import Router, types, F, flags
+from aiogram import Bot, Router, types, F, flags
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.fsm.context import FSMContext
 from fluent.runtime import FluentLocalization
 
-from bot.config import client
-from ...states.state import StateImage
+from bot.config import client, scheduler, resilience, usage, asset_cache, single_flight, job_queue, VARIATION_COUNT
+from ...states.state import StateImage, StateVariation
+from ...utils.asset_cache import asset_key
+from ...utils.fluent_helper import MenuCache
+from ...utils.jobs import Job, JobError
+from ...utils.outbound import LOW, outbound_priority
+from ...utils.resilience import UpstreamUnavailable
 
 router_image = Router()
 
+# Parameters of every generated image
+IMAGE_SIZE = "1024x1024"
+IMAGE_QUALITY = "standard"
+# Images one request to a model can ask for, the others are requested in parallel
+IMAGES_PER_REQUEST = {"dall-e-2": 10, "dall-e-3": 1}
+
 
 async def generate_image(prompt: str, model: str) -> str:
     """
@@ -20,53 +36,193 @@ async def generate_image(prompt: str, model: str) -> str:
     Returns:
     str: The URL of the generated image. If an error occurs during image generation, it returns a string starting with "Error:" followed by the error message.
     """
+    # Users sending the same prompt at the same time share one generation
+    key = asset_key("images/generations", model, {"size": IMAGE_SIZE, "quality": IMAGE_QUALITY}, prompt)
+    return await single_flight.do(key, "images/generations", lambda: _generate_image(prompt, model))
+
+
+async def _generate_image(prompt: str, model: str) -> str:
+    res = await _generate_images(prompt, model, 1)
+    return res if isinstance(res, str) else res[0]
+
+
+async def _generate_images(prompt: str, model: str, n: int) -> Union[list[str], str]:
     try:
-        # Generate the image using the OpenAI API
-        response = client.images.generate(
-            model=model,
-            prompt=prompt,
-            size="1024x1024",
-            quality="standard",
-            n=1,
-        )
-        # Return the URL of the generated image
-        return response.data[0].url
-    except openai.OpenAIError as e:
+        # Generate the images using the OpenAI API
+        async with scheduler.slot(model, tokens=n):
+            response = await resilience.call(model, lambda: client.images.generate(
+                model=model,
+                prompt=prompt,
+                size=IMAGE_SIZE,
+                quality=IMAGE_QUALITY,
+                n=n,
+            ))
+        usage.record(model, images=len(response.data))
+        # Return the URLs of the generated images
+        return [image.url for image in response.data]
+    except (openai.OpenAIError, UpstreamUnavailable) as e:
         # If an error occurs, return the error message
         return f"Error: {str(e)}"
 
 
-@router_image.callback_query(F.data == "image")
-async def image(call: types.CallbackQuery, l10n: FluentLocalization):
+async def generate_images(prompt: str, model: str, n: int) -> AsyncIterator[str]:
+    """
+    This function generates several images for the same prompt at once and yields their URLs as they are ready.
+
+    Models that make several images per request (dall-e-2) are asked for them in one request, the others (dall-e-3)
+    get one request per image, all sent at the same time.
+
+    Parameters:
+    prompt (str): The prompt to be used for image generation.
+    model (str): The model to be used for image generation. It can be "dall-e-3" or "dall-e-2".
+    n (int): The number of images.
+
+    Yields:
+    str: The URL of the next generated image. If an error occurs, it is a string starting with "Error:" followed by
+    the error message, and the remaining requests are cancelled.
+    """
+    per_request = IMAGES_PER_REQUEST.get(model, 1)
+    batches = [min(per_request, n - start) for start in range(0, n, per_request)]
+
+    async def generate(index: int, count: int) -> Union[list[str], str]:
+        # Users sending the same prompt at the same time share the generations, batch by batch
+        key = asset_key("images/generations", model,
+                        {"size": IMAGE_SIZE, "quality": IMAGE_QUALITY, "n": count, "batch": index}, prompt)
+        return await single_flight.do(key, "images/generations", lambda: _generate_images(prompt, model, count))
+
+    tasks = [asyncio.ensure_future(generate(index, count)) for index, count in enumerate(batches)]
+    try:
+        for future in asyncio.as_completed(tasks):
+            res = await future
+            if isinstance(res, str):
+                yield res
+                return
+            for url in res:
+                yield url
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def image_keyboard(l10n: FluentLocalization) -> types.InlineKeyboardMarkup:
     buttons_image = [
         [types.InlineKeyboardButton(text="dall-e-3", callback_data="dall-e-3")],
         [types.InlineKeyboardButton(text="dall-e-2", callback_data="dall-e-2")],
         [types.InlineKeyboardButton(text="🔙Back", callback_data="back")]
     ]
-    keyboard_image = types.InlineKeyboardMarkup(inline_keyboard=buttons_image)
-    await call.message.edit_text(text=l10n.format_value("text_image"), reply_markup=keyboard_image)
+    return types.InlineKeyboardMarkup(inline_keyboard=buttons_image)
+
+
+@router_image.callback_query(F.data == "image")
+async def image(call: types.CallbackQuery, menus: MenuCache):
+    await call.message.edit_text(text=menus.text("text_image"), reply_markup=menus(image_keyboard))
+
+
+def variation_keyboard(l10n: FluentLocalization) -> types.InlineKeyboardMarkup:
+    buttons_variation = [
+        [types.InlineKeyboardButton(text="dall-e-3", callback_data="variation-dall-e-3")],
+        [types.InlineKeyboardButton(text="dall-e-2", callback_data="variation-dall-e-2")],
+        [types.InlineKeyboardButton(text="🔙Back", callback_data="back")]
+    ]
+    return types.InlineKeyboardMarkup(inline_keyboard=buttons_variation)
+
+
+@router_image.callback_query(F.data == "variation")
+async def variation(call: types.CallbackQuery, menus: MenuCache):
+    await call.message.edit_text(text=menus.text("text_variation"), reply_markup=menus(variation_keyboard))
+
+
+@router_image.callback_query(F.data.startswith("variation-"))
+async def variation_model(call: types.CallbackQuery, state: FSMContext, menus: MenuCache):
+    await call.message.bot.send_message(chat_id=call.message.chat.id, text=menus.text("text_dall"))
+    await state.update_data(model=call.data.removeprefix("variation-"))
+    await state.set_state(StateVariation.variation)
 
 
 @router_image.callback_query(F.data.startswith("dall"))
-async def dall(call: types.CallbackQuery, state: FSMContext, l10n: FluentLocalization):
-    await call.message.bot.send_message(chat_id=call.message.chat.id, text=l10n.format_value("text_dall"))
+async def dall(call: types.CallbackQuery, state: FSMContext, menus: MenuCache):
+    await call.message.bot.send_message(chat_id=call.message.chat.id, text=menus.text("text_dall"))
     await state.update_data(model=call.data)
     await state.set_state(StateImage.image)
 
 
 @router_image.message(StateImage.image)
 @flags.chat_action("upload_photo")
-async def image(msg: types.Message, state: FSMContext, l10n: FluentLocalization) -> None:
+async def image(msg: types.Message, state: FSMContext, menus: MenuCache) -> None:
     """
-    This function handles the message in the "image" state. It generates an image based on the message text and the model stored in the state,
-    and sends this image as a photo. If an error occurs during image generation, it sends a message with the error.
+    This function handles the message in the "image" state. It queues the generation of an image based on the message text and the model stored in the state,
+    which is sent as a photo when it is ready. If an error occurs during image generation, the user gets a message with the error.
+    An image generated before for the same prompt and model is sent again by its Telegram file_id.
     """
     prompt = msg.text
     data = await state.get_data()
-    mesg = await msg.answer(text=l10n.format_value("text_wait"))
-    res = await generate_image(prompt=prompt, model=data["model"])
+    key = asset_key("images/generations", data["model"], {"size": IMAGE_SIZE, "quality": IMAGE_QUALITY}, prompt)
+    file_id = asset_cache.get(key)
+    if file_id:
+        try:
+            await msg.bot.send_photo(chat_id=msg.from_user.id, photo=file_id)
+            return
+        except TelegramBadRequest:
+            # Telegram no longer knows the file, generate the image again
+            asset_cache.discard(key)
+
+    # The "wait" message is noise next to the answers of other users
+    with outbound_priority(LOW):
+        mesg = await msg.answer(text=menus.text("text_wait"))
+    await job_queue.enqueue(msg.bot, "image", msg.from_user.id,
+                            {"prompt": prompt, "model": data["model"], "key": key, "wait_message_id": mesg.message_id},
+                            language=msg.from_user.language_code)
+
+
+@job_queue.job("image")
+async def image_job(bot: Bot, job: Job) -> None:
+    """
+    This function runs a queued image generation and sends the image to the chat, replacing the "wait" message.
+    """
+    res = await generate_image(prompt=job.payload["prompt"], model=job.payload["model"])
     if res.startswith("Error:"):
-        await msg.answer(text=res)
-    else:
-        await mesg.delete()
-        await msg.bot.send_photo(chat_id=msg.from_user.id, photo=res)
+        raise JobError(res)
+    # A retried job may have deleted the message already
+    with contextlib.suppress(TelegramBadRequest):
+        await bot.delete_message(chat_id=job.chat_id, message_id=job.payload["wait_message_id"])
+    sent = await bot.send_photo(chat_id=job.chat_id, photo=res)
+    asset_cache.put(job.payload["key"], sent.photo[-1].file_id, sent.photo[-1].file_size)
+
+
+@router_image.message(StateVariation.variation)
+@flags.chat_action("upload_photo")
+async def variation_prompt(msg: types.Message, state: FSMContext, menus: MenuCache) -> None:
+    """
+    This function handles the message in the "variation" state. It queues the generation of VARIATION_COUNT images
+    for the message text with the model stored in the state, which are sent as one album when they are all ready.
+    """
+    data = await state.get_data()
+    # The "wait" message is noise next to the answers of other users
+    with outbound_priority(LOW):
+        mesg = await msg.answer(text=menus.text("text_wait"))
+    await job_queue.enqueue(msg.bot, "variation", msg.from_user.id,
+                            {"prompt": msg.text, "model": data["model"], "count": VARIATION_COUNT,
+                             "wait_message_id": mesg.message_id}, language=msg.from_user.language_code)
+
+
+@job_queue.job("variation")
+async def variation_job(bot: Bot, job: Job) -> None:
+    """
+    This function runs a queued variation: it generates the images at once, counts them on the "wait" message as
+    they arrive and sends them all in one album.
+    """
+    payload = job.payload
+    urls = []
+    async with contextlib.aclosing(generate_images(payload["prompt"], payload["model"], payload["count"])) as images:
+        async for res in images:
+            if res.startswith("Error:"):
+                raise JobError(res)
+            urls.append(res)
+            if len(urls) < payload["count"]:
+                # A retried job may have deleted the message already
+                with contextlib.suppress(TelegramBadRequest):
+                    await bot.edit_message_text(text=f"⏳ {len(urls)}/{payload['count']} 🖼️", chat_id=job.chat_id,
+                                                message_id=payload["wait_message_id"])
+    with contextlib.suppress(TelegramBadRequest):
+        await bot.delete_message(chat_id=job.chat_id, message_id=payload["wait_message_id"])
+    await bot.send_media_group(chat_id=job.chat_id, media=[types.InputMediaPhoto(media=url) for url in urls])
@@ -1,88 +1,178 @@
-import aiofiles.os
+import contextlib
+import io
+import logging
+import math
+import time
+from typing import AsyncIterator, BinaryIO, Sequence
+
 import openai
-from aiogram import Router, F, types
+from aiogram import Bot, Router, F, types
 from aiogram.fsm.context import FSMContext
 from fluent.runtime import FluentLocalization
 
-from ...config import client
+from ...config import (client, scheduler, resilience, usage, job_queue, STT_SEGMENT_SECONDS, STT_PARALLEL,
+                       STREAM_EDIT_INTERVAL)
 from ...states.state import StateSpeechToText
+from ...utils.audio import AudioPart, split_audio
+from ...utils.fan_out import ordered_fan_out
+from ...utils.fluent_helper import MenuCache
+from ...utils.jobs import Job, JobError
+from ...utils.media import download_media
+from ...utils.message_stream import MessageStreamer
+from ...utils.outbound import LOW, outbound_priority
+from ...utils.resilience import UpstreamUnavailable
+
+logger = logging.getLogger(__name__)
 
 # Create a router for speech to text related commands and filters
 router_speech_to_text = Router()
 
 
-async def generate_speech_to_text(model: str, file_path: str) -> str:
+async def generate_speech_to_text(model: str, audio: bytes, file_name: str, seconds: float = 0.0) -> str:
     """
     This function generates text from speech based on the provided model and audio file.
 
     Parameters:
     model (str): The model to be used for speech to text conversion. It can be "whisper-1".
-    file_path (str): The path to the audio file to be converted to text.
+    audio (bytes): The audio file to be converted to text.
+    file_name (str): The name the audio is uploaded under. Its extension tells the API the audio format.
+    seconds (float): The length of the audio, for the usage ledger.
 
     Returns:
     str: The text generated from the speech in the audio file. If an error occurs during speech to text conversion, it returns a string starting with "Error:" followed by the error message.
     """
-    # Open the audio file in read binary mode
-    audio_file = open(file_path, "rb")
     try:
         # Generate the text from speech using the OpenAI API
-        response = client.audio.translations.create(
-            model=model,
-            file=audio_file,
-            response_format="text"
-        )
+        def translate():
+            # Every attempt uploads from a file of its own, so a hedge racing a slow upload cannot move its position
+            return client.audio.translations.create(
+                model=model,
+                file=(file_name, io.BytesIO(audio)),
+                response_format="text"
+            )
+
+        async with scheduler.slot(model, tokens=1):
+            response = await resilience.call(model, translate)
+        usage.record(model, audio_seconds=seconds)
         # Return the generated text
         return response
-    except openai.OpenAIError as e:
+    except (openai.OpenAIError, UpstreamUnavailable) as e:
         # If an error occurs, return the error message
         return f"Error: {str(e)}"
 
 
-# Handler for the "speech_to_text" callback query
-@router_speech_to_text.callback_query(F.data == "speech_to_text")
-async def speech_to_text(call: types.CallbackQuery, l10n: FluentLocalization) -> None:
+async def transcribe_segments(model: str, audio: BinaryIO, segments: Sequence[AudioPart], file_name: str,
+                              parallel: int = STT_PARALLEL, duration: float = 0.0) -> AsyncIterator[str]:
     """
-    This function handles the "speech_to_text" callback query. It edits the message text and provides a keyboard for speech to text related options.
+    This function transcribes the parts of a split recording at once and yields their texts in order, each as
+    soon as it and every part before it are done. A part is read from the recording only when its turn comes, so
+    at most ``parallel`` parts are held in memory.
+
+    Parameters:
+    model (str): The model to be used for speech to text conversion.
+    audio (BinaryIO): The recording.
+    segments (Sequence[AudioPart]): The parts of the recording, in order.
+    file_name (str): The name the parts are uploaded under. Its extension tells the API the audio format.
+    parallel (int): The most parts transcribed at a time.
+    duration (float): The length of the whole recording in seconds, shared out between the parts by their size
+    for the usage ledger.
+
+    Yields:
+    str: The text of the next part. If an error occurs, it is a string starting with "Error:" followed by the error
+    message, and the remaining parts are cancelled.
     """
+    total = sum(segment.size for segment in segments) or 1
+
+    async def transcribe(segment: AudioPart) -> str:
+        return await generate_speech_to_text(model=model, audio=segment.read(audio), file_name=file_name,
+                                             seconds=duration * segment.size / total)
+
+    async with contextlib.aclosing(ordered_fan_out(segments, transcribe, parallel)) as texts:
+        async for text in texts:
+            yield text
+            if text.startswith("Error:"):
+                return
+
+
+def speech_to_text_keyboard(l10n: FluentLocalization) -> types.InlineKeyboardMarkup:
     button_text_speech_to_text = [
         [types.InlineKeyboardButton(text=l10n.format_value("whisper_1"), callback_data="whisper_1")],
     ]
 
     # Inline keyboard markup for the speech to text conversion model selection
-    keyboard_text_speech_to_text = types.InlineKeyboardMarkup(inline_keyboard=button_text_speech_to_text)
-    await call.message.edit_text(text=l10n.format_value("text_speech_to_text"),
-                                 reply_markup=keyboard_text_speech_to_text)
+    return types.InlineKeyboardMarkup(inline_keyboard=button_text_speech_to_text)
+
+
+# Handler for the "speech_to_text" callback query
+@router_speech_to_text.callback_query(F.data == "speech_to_text")
+async def speech_to_text(call: types.CallbackQuery, menus: MenuCache) -> None:
+    """
+    This function handles the "speech_to_text" callback query. It edits the message text and provides a keyboard for speech to text related options.
+    """
+    await call.message.edit_text(text=menus.text("text_speech_to_text"), reply_markup=menus(speech_to_text_keyboard))
 
 
 # Handler for the "whisper_1" callback query
 @router_speech_to_text.callback_query(F.data.startswith("whisper"))
-async def whisper_1(call: types.CallbackQuery, state: FSMContext, l10n: FluentLocalization) -> None:
+async def whisper_1(call: types.CallbackQuery, state: FSMContext, menus: MenuCache) -> None:
     """
     This function handles the "whisper_1" callback query. It sends a message and updates the state with the model "whisper-1".
     """
-    await call.message.edit_text(text=l10n.format_value("text_enter_audio"))
+    await call.message.edit_text(text=menus.text("text_enter_audio"))
     await state.update_data(model="whisper-1")
     await state.set_state(StateSpeechToText.audio_path)
 
 
 # Handler for the message in the "audio_path" state
 @router_speech_to_text.message(StateSpeechToText.audio_path)
-async def audio_path(msg: types.Message, state: FSMContext, l10n: FluentLocalization) -> None:
+async def audio_path(msg: types.Message, state: FSMContext, menus: MenuCache) -> None:
     """
-    This function handles the message in the "audio_path" state. It downloads the voice message, generates text from the speech using the model stored in the state,
-    and sends this text as a message. If an error occurs during speech to text conversion, it sends a message with the error.
+    This function handles the message in the "audio_path" state. It queues the transcription of the voice message,
+    audio file or video note using the model stored in the state, whose text replaces the "wait" message as it is
+    transcribed. If an error occurs during speech to text conversion, the user gets a message with the error.
     """
-    voice = msg.voice.file_id
-    file = await msg.bot.get_file(file_id=voice)
-    file_path = file.file_path
-    file_name = f"media/{msg.from_user.id}{voice}.mp3"
-    await msg.bot.download_file(file_path, file_name)
-    data = await state.get_data()
-    mesg = await msg.answer(text=l10n.format_value("text_wait"))
-    res = await generate_speech_to_text(file_path=file_name, model=data["model"])
-    if res.startswith("Error:"):
-        await msg.answer(text=res)
+    if msg.voice:
+        media, file_name = msg.voice, "voice.ogg"
+    elif msg.audio:
+        media, file_name = msg.audio, msg.audio.file_name or "audio.mp3"
+    elif msg.video_note:
+        media, file_name = msg.video_note, "video_note.mp4"
     else:
-        await mesg.delete()
-        await msg.answer(text=res)
-        await aiofiles.os.remove(file_name)
+        await msg.answer(text=menus.text("text_enter_audio"))
+        return
+    data = await state.get_data()
+    # The "wait" message is noise next to the answers of other users
+    with outbound_priority(LOW):
+        mesg = await msg.answer(text=menus.text("text_wait"))
+    # Only the Telegram file_id is queued, the worker downloads the recording itself
+    await job_queue.enqueue(msg.bot, "speech_to_text", msg.chat.id,
+                            {"file_id": media.file_id, "file_name": file_name, "duration": media.duration,
+                             "mime_type": getattr(media, "mime_type", None), "model": data["model"],
+                             "wait_message_id": mesg.message_id}, language=msg.from_user.language_code)
+
+
+@job_queue.job("speech_to_text")
+async def speech_to_text_job(bot: Bot, job: Job) -> None:
+    """
+    This function runs a queued transcription. A long recording is split into parts of about STT_SEGMENT_SECONDS
+    which are transcribed at once, and the "wait" message is replaced with the text as the parts are done.
+    """
+    payload = job.payload
+    # Jobs queued before recordings were split only carry the voice message
+    file_name = payload.get("file_name", "voice.ogg")
+    duration = payload.get("duration") or 0
+    parts = max(1, math.ceil(duration / STT_SEGMENT_SECONDS)) if STT_SEGMENT_SECONDS else 1
+    started = time.monotonic()
+    wait_message = types.Message(message_id=payload["wait_message_id"], date=int(time.time()),
+                                 chat=types.Chat(id=job.chat_id, type="private")).as_(bot)
+    streamer = MessageStreamer(wait_message, interval=STREAM_EDIT_INTERVAL)
+    # The recording stays in its spooled file, the parts are read from it as they are transcribed
+    with await download_media(bot, payload["file_id"]) as audio:
+        segments = split_audio(audio, payload.get("mime_type", "audio/ogg"), parts)
+        async for text in transcribe_segments(payload["model"], audio, segments, file_name, duration=duration):
+            if text.startswith("Error:"):
+                raise JobError(text)
+            await streamer.feed(text if not streamer.text else f" {text}")
+    await streamer.finish()
+    logger.info("Transcribed %s s of audio in %s parts in %.1f s", duration, len(segments),
+                time.monotonic() - started)
@@ -1,28 +1,29 @@
+import logging
+from typing import AsyncIterator, Optional
+
 import openai
 from aiogram import types, Router, F, flags
 from aiogram.fsm.context import FSMContext
 from fluent.runtime import FluentLocalization
 
-from ...config import client
+from ...config import (client, scheduler, resilience, usage, completion_cache, single_flight, TEXT_STREAMING,
+                       STREAM_EDIT_INTERVAL, CONVERSATION_MEMORY, CONTEXT_BUDGETS, HISTORY_SUMMARY, HISTORY_SUMMARY_MODEL,
+                       PLACEHOLDER_DELAY)
 from ...states.state import StateText
+from ...utils.asset_cache import asset_key
+from ...utils.conversation import Conversation, DEFAULT_CONTEXT_BUDGET, format_turns
+from ...utils.fluent_helper import MenuCache
+from ...utils.message_stream import MessageStreamer
+from ...utils.outbound import Placeholder
+from ...utils.resilience import UpstreamUnavailable
 
-router_text = Router()
-
+logger = logging.getLogger(__name__)
 
-async def generate_text(prompt: str, model: str) -> str:
-    """
-    This function generates text based on the provided prompt and model.
+router_text = Router()
 
-    Parameters:
-    prompt (str): The prompt to be used for text generation.
-    model (str): The model to be used for text generation. It can be "gpt-4" or "gpt-3.5-turbo".
 
-    Returns:
-    str: The generated text. If an error occurs during text generation, it returns a string starting with "Error:" followed by the error message.
-    """
-    try:
-        # Custom system prompt with instructions
-        system_prompt = """
+# Custom system prompt with instructions
+SYSTEM_PROMPT = """
         You must follow the rules before answering:
         - I have no fingers and the truncate trauma.
         - I need you to return the entire code template or answer. DON’T use placeholders.
@@ -39,24 +40,179 @@ async def generate_text(prompt: str, model: str) -> str:
         5. Answer the question in a natural, human-like manner.
         """
 
+
+def build_messages(prompt: str, conversation: Optional[Conversation] = None) -> list[dict]:
+    """
+    This function builds the chat messages sent to the model for a user prompt and the earlier conversation.
+    """
+    if conversation:
+        return conversation.messages(SYSTEM_PROMPT, prompt)
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": prompt},
+    ]
+
+
+def estimate_tokens(prompt: str, conversation: Optional[Conversation] = None) -> int:
+    """
+    This function roughly estimates the prompt tokens of a request, about four characters per token.
+    """
+    return (len(SYSTEM_PROMPT) + len(prompt)) // 4 + (conversation.tokens if conversation else 0)
+
+
+async def summarize_turns(turns: list[list], summary: Optional[str]) -> Optional[str]:
+    """
+    This function condenses turns dropped from a conversation, together with the previous summary, into a short
+    summary.
+
+    Parameters:
+    turns (list[list]): The dropped turns.
+    summary (Optional[str]): The summary of the turns dropped before.
+
+    Returns:
+    Optional[str]: The new summary, or None if it could not be generated.
+    """
+    text = format_turns(turns)
+    if summary:
+        text = f"Earlier summary: {summary}\n{text}"
+    try:
+        async with scheduler.slot(HISTORY_SUMMARY_MODEL, tokens=len(text) // 4):
+            response = await resilience.call(HISTORY_SUMMARY_MODEL, lambda: client.chat.completions.create(
+                model=HISTORY_SUMMARY_MODEL,
+                messages=[
+                    {"role": "system", "content": "Summarize this conversation in a few sentences. Keep names, "
+                                                  "facts and open questions."},
+                    {"role": "user", "content": text},
+                ],
+                max_tokens=300,
+            ))
+        usage.record(HISTORY_SUMMARY_MODEL, prompt_tokens=response.usage.prompt_tokens,
+                     completion_tokens=response.usage.completion_tokens)
+        return response.choices[0].message.content
+    except (openai.OpenAIError, UpstreamUnavailable) as e:
+        logger.warning("Failed to summarize the conversation: %s", e)
+        return None
+
+
+async def fit_conversation(conversation: Conversation, model: str, prompt: str) -> None:
+    """
+    This function makes the conversation, together with the system prompt and the new prompt, fit the context
+    budget of the model, summarizing the dropped turns when HISTORY_SUMMARY is enabled.
+    """
+    budget = CONTEXT_BUDGETS.get(model, DEFAULT_CONTEXT_BUDGET) - estimate_tokens(prompt)
+    dropped = conversation.trim(max(budget, 0))
+    if dropped and HISTORY_SUMMARY:
+        summary = await summarize_turns(dropped, conversation.summary[0] if conversation.summary else None)
+        if summary:
+            conversation.set_summary(summary)
+
+
+async def generate_text(prompt: str, model: str, conversation: Optional[Conversation] = None) -> str:
+    """
+    This function generates text based on the provided prompt and model.
+
+    Parameters:
+    prompt (str): The prompt to be used for text generation.
+    model (str): The model to be used for text generation. It can be "gpt-4" or "gpt-4o".
+    conversation (Optional[Conversation]): The earlier conversation sent along with the prompt.
+
+    Returns:
+    str: The generated text. If an error occurs during text generation, it returns a string starting with "Error:" followed by the error message.
+    """
+    if conversation:
+        return await _generate_text(prompt, model, conversation)
+    # Without an earlier conversation the answer only depends on the prompt, so users sending the same prompt at
+    # the same time share one request
+    key = asset_key("chat/completions", model, {}, prompt)
+    return await single_flight.do(key, "chat/completions", lambda: _generate_text(prompt, model))
+
+
+async def _generate_text(prompt: str, model: str, conversation: Optional[Conversation] = None) -> str:
+    # Answers only depend on the prompt when there is no earlier conversation
+    use_cache = completion_cache is not None and not conversation
+    if use_cache:
+        cached = await completion_cache.get(model, SYSTEM_PROMPT, prompt)
+        if cached is not None:
+            return cached
+    try:
         # Generate the text using the OpenAI API
-        response = client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": prompt},
-            ]
-        )
+        async with scheduler.slot(model, tokens=estimate_tokens(prompt, conversation)):
+            response = await resilience.call(model, lambda: client.chat.completions.create(
+                model=model,
+                messages=build_messages(prompt, conversation),
+            ))
 
+        answer = response.choices[0].message.content
+        logger.info("%s request used %s prompt tokens", model, response.usage.prompt_tokens)
+        usage.record(model, prompt_tokens=response.usage.prompt_tokens,
+                     completion_tokens=response.usage.completion_tokens)
+        if use_cache:
+            await completion_cache.put(model, SYSTEM_PROMPT, prompt, answer)
         # Return the generated text
-        return response.choices[0].message.content
-    except openai.OpenAIError as e:
+        return answer
+    except (openai.OpenAIError, UpstreamUnavailable) as e:
         # If an error occurs, return the error message
         return f"Error: {str(e)}"
 
 
-@router_text.callback_query(F.data == "text")
-async def text(call: types.CallbackQuery, l10n: FluentLocalization):
+async def stream_text(prompt: str, model: str, conversation: Optional[Conversation] = None) -> AsyncIterator[str]:
+    """
+    This function generates text based on the provided prompt and model and yields it chunk by chunk as the
+    model produces it.
+
+    Parameters:
+    prompt (str): The prompt to be used for text generation.
+    model (str): The model to be used for text generation. It can be "gpt-4" or "gpt-4o".
+    conversation (Optional[Conversation]): The earlier conversation sent along with the prompt.
+
+    Yields:
+    str: The next piece of the generated text. If an error occurs, the last chunk is a string starting with "Error:"
+    followed by the error message.
+    """
+    if conversation:
+        chunks = _stream_text(prompt, model, conversation)
+    else:
+        # Users sending the same prompt at the same time share one stream; late joiners get what was streamed so far
+        key = asset_key("chat/completions", model, {"stream": True}, prompt)
+        chunks = single_flight.stream(key, "chat/completions", lambda: _stream_text(prompt, model))
+    async for chunk in chunks:
+        yield chunk
+
+
+async def _stream_text(prompt: str, model: str, conversation: Optional[Conversation] = None) -> AsyncIterator[str]:
+    # Answers only depend on the prompt when there is no earlier conversation
+    use_cache = completion_cache is not None and not conversation
+    if use_cache:
+        cached = await completion_cache.get(model, SYSTEM_PROMPT, prompt)
+        if cached is not None:
+            yield cached
+            return
+    chunks = []
+    try:
+        # Hold the model slot until the whole answer has been streamed
+        async with scheduler.slot(model, tokens=estimate_tokens(prompt, conversation)):
+            response = await resilience.call(model, lambda: client.chat.completions.create(
+                model=model,
+                messages=build_messages(prompt, conversation),
+                stream=True,
+            ))
+            # Streamed responses carry no usage, report the estimate instead
+            logger.info("%s request used about %s prompt tokens", model, estimate_tokens(prompt, conversation))
+            async for chunk in resilience.stream(model, response):
+                if chunk.choices and chunk.choices[0].delta.content:
+                    chunks.append(chunk.choices[0].delta.content)
+                    yield chunk.choices[0].delta.content
+        usage.record(model, prompt_tokens=estimate_tokens(prompt, conversation),
+                     completion_tokens=len("".join(chunks)) // 4)
+        if use_cache:
+            await completion_cache.put(model, SYSTEM_PROMPT, prompt, "".join(chunks))
+    except (openai.OpenAIError, UpstreamUnavailable) as e:
+        # If an error occurs, finish the answer with the error message
+        prefix = "\n\n" if chunks else ""
+        yield f"{prefix}Error: {str(e)}"
+
+
+def text_keyboard(l10n: FluentLocalization) -> types.InlineKeyboardMarkup:
     # Inline keyboard buttons for selecting the text generation model
     buttons_text = [
         [types.InlineKeyboardButton(text="🧠 GPT-4", callback_data="gpt-4")],
@@ -65,27 +221,61 @@ async def text(call: types.CallbackQuery, l10n: FluentLocalization):
     ]
 
     # Inline keyboard markup for the text generation model selection
-    keyboard_text = types.InlineKeyboardMarkup(inline_keyboard=buttons_text)
-    await call.message.edit_text(text=l10n.format_value("text_text"), reply_markup=keyboard_text)
+    return types.InlineKeyboardMarkup(inline_keyboard=buttons_text)
+
+
+@router_text.callback_query(F.data == "text")
+async def text(call: types.CallbackQuery, menus: MenuCache):
+    await call.message.edit_text(text=menus.text("text_text"), reply_markup=menus(text_keyboard))
 
 
 @router_text.callback_query(F.data.startswith("gpt-"))
 async def gpt(call: types.CallbackQuery, state: FSMContext, l10n: FluentLocalization):
     await call.message.bot.send_message(chat_id=call.message.chat.id,
                                         text=l10n.format_value(msg_id=f"text_{call.data}"))
-    await state.update_data(model=call.data)
+    # Picking a model starts a new conversation
+    await state.update_data(model=call.data, history=None)
     await state.set_state(StateText.text)
 
 
 @router_text.message(StateText.text)
 @flags.chat_action("typing")
-async def text(msg: types.Message, l10n: FluentLocalization, state: FSMContext):
+async def text(msg: types.Message, menus: MenuCache, state: FSMContext):
     prompt = msg.text
     data = await state.get_data()
-    mesg = await msg.answer(text=l10n.format_value(msg_id="text_wait"))
-    res = await generate_text(prompt=prompt, model=data["model"])
-    if res.startswith("Error:"):
-        await msg.answer(text=res)
-    else:
-        await mesg.delete()
-        await msg.bot.send_message(chat_id=msg.from_user.id, text=res)
+    # The "wait" message is only sent when the answer is slow to come, and deleted if the handler fails
+    async with Placeholder(msg, menus.text("text_wait"), delay=PLACEHOLDER_DELAY) as placeholder:
+        conversation = None
+        if CONVERSATION_MEMORY:
+            conversation = Conversation.from_data(data.get("history"))
+            await fit_conversation(conversation, data["model"], prompt)
+
+        if TEXT_STREAMING:
+            # Show the answer as it is generated by editing the placeholder message, or a new one if none was sent
+            streamer = None
+            chunks = []
+            async for chunk in stream_text(prompt=prompt, model=data["model"], conversation=conversation):
+                chunks.append(chunk)
+                if streamer is None:
+                    streamer = MessageStreamer(await placeholder.take(), interval=STREAM_EDIT_INTERVAL,
+                                               chat_message=msg)
+                await streamer.feed(chunk)
+            if streamer is not None:
+                await streamer.finish()
+            else:
+                await placeholder.delete()
+            failed = not chunks or chunks[-1].lstrip("\n").startswith("Error:")
+            res = "".join(chunks)
+        else:
+            res = await generate_text(prompt=prompt, model=data["model"], conversation=conversation)
+            failed = res.startswith("Error:")
+            await placeholder.delete()
+            if failed:
+                await msg.answer(text=res)
+            else:
+                await msg.bot.send_message(chat_id=msg.from_user.id, text=res)
+
+    if conversation is not None and not failed:
+        conversation.add("user", prompt)
+        conversation.add("assistant", res)
+        await state.update_data(history=conversation.to_data())
@@ -1,63 +1,71 @@
-from typing import Literal
+import contextlib
+from typing import Literal, Union
 
-import aiofiles.os
 import openai
-from aiogram import Router, types, F
+from aiogram import Bot, Router, types, F
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.fsm.context import FSMContext
 from fluent.runtime import FluentLocalization
 
-from bot.config import client
+from bot.config import (client, scheduler, resilience, usage, asset_cache, single_flight, job_queue, TTS_PIPELINE,
+                        TTS_CHUNK_CHARS, TTS_FIRST_CHUNK_CHARS, TTS_PARALLEL)
 from ...states.state import StateTextToSpeech
+from ...utils.asset_cache import asset_key
+from ...utils.fan_out import ordered_fan_out
+from ...utils.fluent_helper import MenuCache
+from ...utils.jobs import Job, JobError
+from ...utils.outbound import LOW, outbound_priority
+from ...utils.resilience import UpstreamUnavailable
+from ...utils.sentences import split_sentences
 
 router_text_to_speech = Router()
 
 
-async def generate_text_to_speech(prompt: str, model: str, file_id: str,
-                                  voice: Literal["alloy", "echo", "fable", "onyx", "nova", "shimmer"]) -> str:
+async def generate_text_to_speech(prompt: str, model: str,
+                                  voice: Literal["alloy", "echo", "fable", "onyx", "nova", "shimmer"]
+                                  ) -> Union[bytes, str]:
     """
     This function generates speech from text based on the provided prompt, model, and voice.
 
     Parameters:
     prompt (str): The text to be converted to speech.
     model (str): The model to be used for text to speech conversion. It can be "tts-1" or "tts-1-hd".
-    file_id (str): The id of the file where the generated speech will be saved.
     voice (Literal["alloy", "echo", "fable", "onyx", "nova", "shimmer"]): The voice to be used for the speech. It can be "alloy", "echo", "fable", "onyx", "nova", or "shimmer".
 
     Returns:
-    str: If an error occurs during text to speech conversion, it returns a string starting with "Error:" followed by the error message.
+    Union[bytes, str]: The generated speech as MP3 bytes. If an error occurs during text to speech conversion, it returns a string starting with "Error:" followed by the error message.
     """
+    # Users sending the same text at the same time share one generation
+    key = asset_key("audio/speech", model, {"voice": voice}, prompt)
+    return await single_flight.do(key, "audio/speech", lambda: _generate_text_to_speech(prompt, model, voice))
+
+
+async def _generate_text_to_speech(prompt: str, model: str, voice: str) -> Union[bytes, str]:
     try:
-        # Define the path of the speech file
-        speech_file_path = file_id
         # Generate the speech using the OpenAI API
-        response = client.audio.speech.create(
-            model=model,
-            voice=voice,
-            input=prompt
-        )
-        # Save the generated speech to the file
-        response.stream_to_file(speech_file_path)
-    except openai.OpenAIError as e:
+        async with scheduler.slot(model, tokens=len(prompt)):
+            response = await resilience.call(model, lambda: client.audio.speech.create(
+                model=model,
+                voice=voice,
+                input=prompt
+            ))
+        usage.record(model, characters=len(prompt))
+        # Keep the generated speech in memory, it is uploaded to Telegram from there
+        return response.content
+    except (openai.OpenAIError, UpstreamUnavailable) as e:
         # If an error occurs, return the error message
         return f"Error: {str(e)}"
 
 
-@router_text_to_speech.callback_query(F.data == "text_to_speech")
-async def text_to_speech(call: types.CallbackQuery, l10n: FluentLocalization) -> None:
-    """
-    This function handles the "text_to_speech" callback query. It edits the message text and provides a keyboard for
-    text to speech related options.
-    """
+def model_keyboard(l10n: FluentLocalization) -> types.InlineKeyboardMarkup:
     buttons = [
         [types.InlineKeyboardButton(text=l10n.format_value("tts-1"), callback_data="tts-1")],
         [types.InlineKeyboardButton(text=l10n.format_value("tts-1-hd"), callback_data="tts-1-hd")],
     ]
-    keyboard = types.InlineKeyboardMarkup(inline_keyboard=buttons)
-    await call.message.edit_text(text=l10n.format_value("text_text_to_speech"), reply_markup=keyboard)
+    return types.InlineKeyboardMarkup(inline_keyboard=buttons)
 
 
-@router_text_to_speech.callback_query(F.data.startswith("tts"))
-async def tts(call: types.CallbackQuery, state: FSMContext, l10n: FluentLocalization) -> None:
+def voice_keyboard(l10n: FluentLocalization) -> types.InlineKeyboardMarkup:
     buttons = [
         [types.InlineKeyboardButton(text=l10n.format_value("alloy"), callback_data="alloy"),
          types.InlineKeyboardButton(text=l10n.format_value("echo"), callback_data="echo")],
@@ -66,48 +74,113 @@ async def tts(call: types.CallbackQuery, state: FSMContext, l10n: FluentLocaliza
         [types.InlineKeyboardButton(text=l10n.format_value("nova"), callback_data="nova"),
          types.InlineKeyboardButton(text=l10n.format_value("shimmer"), callback_data="shimmer")],
     ]
-    keyboard = types.InlineKeyboardMarkup(inline_keyboard=buttons)
-    await call.message.edit_text(text=l10n.format_value("text_enter_voice"), reply_markup=keyboard)
+    return types.InlineKeyboardMarkup(inline_keyboard=buttons)
+
+
+@router_text_to_speech.callback_query(F.data == "text_to_speech")
+async def text_to_speech(call: types.CallbackQuery, menus: MenuCache) -> None:
+    """
+    This function handles the "text_to_speech" callback query. It edits the message text and provides a keyboard for
+    text to speech related options.
+    """
+    await call.message.edit_text(text=menus.text("text_text_to_speech"), reply_markup=menus(model_keyboard))
+
+
+@router_text_to_speech.callback_query(F.data.startswith("tts"))
+async def tts(call: types.CallbackQuery, state: FSMContext, menus: MenuCache) -> None:
+    await call.message.edit_text(text=menus.text("text_enter_voice"), reply_markup=menus(voice_keyboard))
     await state.update_data(model=call.data)
     await state.set_state(StateTextToSpeech.text_to_speech)
 
 
 @router_text_to_speech.callback_query(StateTextToSpeech.text_to_speech)
-async def text_to_speech(call: types.CallbackQuery, state: FSMContext, l10n: FluentLocalization) -> None:
+async def text_to_speech(call: types.CallbackQuery, state: FSMContext, menus: MenuCache) -> None:
     """
     This function handles the message in the "text_to_speech" state. It updates the state with the voice model from
     the callback query data.
     """
     voice_model = call.data
-    await call.message.answer(text=l10n.format_value("text_enter_to_speech"))
+    await call.message.answer(text=menus.text("text_enter_to_speech"))
     await state.update_data(voice_model=voice_model)
     await state.set_state(StateTextToSpeech.text)
 
 
-# Function to create an empty file
-async def create_file_async(user_id, message_id) -> None:
-    """
-    This function creates an empty file with the given user id and message id in the file name.
-    """
-    file_name = f"media/{user_id}{message_id}.mp3"
-    async with aiofiles.open(file_name, mode='wb') as file:
-        await file.write(b'')
-
-
 @router_text_to_speech.message(StateTextToSpeech.text)
-async def text(msg: types.Message, state: FSMContext, l10n: FluentLocalization) -> None:
+async def text(msg: types.Message, state: FSMContext, menus: MenuCache) -> None:
     """
-    This function handles the message in the "text" state. It generates speech from the message text using the model and voice model stored in the state,
-    and sends this speech as a voice message. If an error occurs during text to speech conversion, it sends a message with the error.
+    This function handles the message in the "text" state. It queues the generation of speech from the message text using the model and voice model stored in the state,
+    which is sent as a voice message when it is ready. If an error occurs during text to speech conversion, the user gets a message with the error.
+    Speech generated before for the same text, model and voice is sent again by its Telegram file_id.
     """
     prompt = msg.text
     data = await state.get_data()
-    mesg = await msg.answer(text=l10n.format_value("text_wait"))
-    await create_file_async(msg.from_user.id, msg.message_id)
-    await generate_text_to_speech(prompt=prompt, voice=data["voice_model"], model=data["model"],
-                                  file_id=f"media/{msg.from_user.id}{msg.message_id}.mp3")
-    await mesg.delete()
-    await msg.bot.send_voice(chat_id=msg.from_user.id,
-                             voice=types.FSInputFile(f"media/{msg.from_user.id}{msg.message_id}.mp3"),
-                             )
-    await aiofiles.os.remove(f"media/{msg.from_user.id}{msg.message_id}.mp3")
+    key = asset_key("audio/speech", data["model"], {"voice": data["voice_model"]}, prompt)
+    file_id = asset_cache.get(key)
+    if file_id:
+        try:
+            await msg.bot.send_voice(chat_id=msg.from_user.id, voice=file_id)
+            return
+        except TelegramBadRequest:
+            # Telegram no longer knows the file, generate the speech again
+            asset_cache.discard(key)
+
+    # The "wait" message is noise next to the answers of other users
+    with outbound_priority(LOW):
+        mesg = await msg.answer(text=menus.text("text_wait"))
+    await job_queue.enqueue(msg.bot, "text_to_speech", msg.from_user.id,
+                            {"prompt": prompt, "model": data["model"], "voice": data["voice_model"], "key": key,
+                             "wait_message_id": mesg.message_id}, language=msg.from_user.language_code)
+
+
+@job_queue.job("text_to_speech")
+async def text_to_speech_job(bot: Bot, job: Job) -> None:
+    """
+    This function runs a queued speech generation and sends the speech to the chat, replacing the "wait" message.
+
+    A long text is spoken in chunks of whole sentences, generated TTS_PARALLEL at a time and sent as voice messages
+    in order, the first as soon as it is ready. The number of chunks sent is kept in the payload, so a retried job
+    goes on with the first chunk the user has not got yet.
+    """
+    payload = job.payload
+    chunks = [payload["prompt"]]
+    if TTS_PIPELINE:
+        chunks = split_sentences(payload["prompt"], TTS_CHUNK_CHARS, TTS_FIRST_CHUNK_CHARS) or chunks
+    if len(chunks) == 1:
+        keys = [payload["key"]]
+    else:
+        keys = [asset_key("audio/speech", payload["model"], {"voice": payload["voice"]}, chunk) for chunk in chunks]
+
+    async def speak(index: int) -> Union[bytes, str]:
+        # The Telegram file_id of speech generated before, or the generated MP3
+        file_id = asset_cache.get(keys[index])
+        if file_id:
+            return file_id
+        res = await generate_text_to_speech(prompt=chunks[index], voice=payload["voice"], model=payload["model"])
+        if isinstance(res, str):
+            raise JobError(res)
+        return res
+
+    delivered = payload.get("delivered", 0)
+    async with contextlib.aclosing(ordered_fan_out(range(delivered, len(chunks)), speak, TTS_PARALLEL)) as voices:
+        index = delivered
+        async for voice in voices:
+            if index == 0:
+                # A retried job may have deleted the message already
+                with contextlib.suppress(TelegramBadRequest):
+                    await bot.delete_message(chat_id=job.chat_id, message_id=payload["wait_message_id"])
+            if isinstance(voice, str):
+                try:
+                    # Generated before, sent again by its Telegram file_id
+                    await bot.send_voice(chat_id=job.chat_id, voice=voice)
+                    index += 1
+                    await job_queue.checkpoint(job, delivered=index)
+                    continue
+                except TelegramBadRequest:
+                    # Telegram no longer knows the file, generate the speech again
+                    asset_cache.discard(keys[index])
+                    voice = await speak(index)
+            sent = await bot.send_voice(chat_id=job.chat_id,
+                                        voice=types.BufferedInputFile(voice, filename="speech.mp3"))
+            asset_cache.put(keys[index], sent.voice.file_id, len(voice))
+            index += 1
+            await job_queue.checkpoint(job, delivered=index)
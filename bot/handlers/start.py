@@ -2,11 +2,12 @@ from aiogram import Router, types
 from aiogram.filters import CommandStart
 from fluent.runtime import FluentLocalization
 
+from ..utils.fluent_helper import MenuCache
+
 router_start = Router()
 
 
-@router_start.message(CommandStart())
-async def start(msg: types.Message, l10n: FluentLocalization):
+def start_keyboard(l10n: FluentLocalization) -> types.InlineKeyboardMarkup:
     buttons_start = [
         [types.InlineKeyboardButton(text=l10n.format_value("text"), callback_data="text"),
          types.InlineKeyboardButton(text=l10n.format_value("image"), callback_data="image")],
@@ -16,5 +17,10 @@ async def start(msg: types.Message, l10n: FluentLocalization):
          types.InlineKeyboardButton(text=l10n.format_value("speech_to_text"), callback_data="speech_to_text")],
         [types.InlineKeyboardButton(text=l10n.format_value("help"), url="https://t.me/ernestilchenko")]
     ]
-    keyboard = types.InlineKeyboardMarkup(inline_keyboard=buttons_start)
-    await msg.answer(text=l10n.format_value("cmd-start", args={"name": msg.from_user.full_name}), reply_markup=keyboard)
+    return types.InlineKeyboardMarkup(inline_keyboard=buttons_start)
+
+
+@router_start.message(CommandStart())
+async def start(msg: types.Message, l10n: FluentLocalization, menus: MenuCache):
+    await msg.answer(text=l10n.format_value("cmd-start", args={"name": msg.from_user.full_name}),
+                     reply_markup=menus(start_keyboard))
@@ -0,0 +1,59 @@
+import asyncio
+import logging
+import multiprocessing
+from contextlib import contextmanager
+from typing import Iterator
+
+# Importing the bot package declares the module of every kind of job (job_queue.lazy), imported when its first job runs
+from bot.config import close_client, job_queue, runtime, usage
+from bot.dispatcher import create_bot
+
+logger = logging.getLogger(__name__)
+
+
+async def _serve_jobs(index: int, stop: multiprocessing.Event) -> None:
+    bot = create_bot()
+    await job_queue.start(bot)
+    logger.info("Job worker %s started", index)
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, stop.wait)
+    finally:
+        await job_queue.stop()
+        await close_client()
+        await usage.close()
+        await bot.session.close()
+
+
+def _run_jobs(index: int, stop: multiprocessing.Event) -> None:
+    logging.basicConfig(
+        level=logging.INFO,
+        format=f"%(asctime)s - %(levelname)s - jobs {index} - %(name)s - %(message)s",
+    )
+    runtime.install()
+    try:
+        asyncio.run(_serve_jobs(index, stop))
+    except KeyboardInterrupt:
+        pass
+
+
+@contextmanager
+def job_workers(processes: int) -> Iterator[None]:
+    """
+    This function runs ``processes`` job worker processes while the context is open. They share the job queue
+    file with the bot, which only enqueues.
+
+    Parameters:
+    processes (int): The number of job worker processes, 0 for none.
+    """
+    context = multiprocessing.get_context("spawn")
+    stop = context.Event()
+    workers = [context.Process(target=_run_jobs, args=(index, stop), daemon=True) for index in range(processes)]
+    for worker in workers:
+        worker.start()
+    try:
+        yield
+    finally:
+        # Let every worker finish its running jobs; unfinished ones go back to the queue
+        stop.set()
+        for worker in workers:
+            worker.join()
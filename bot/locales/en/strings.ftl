@@ -77,4 +77,8 @@ text_vision =
 
 text_select = 🔘 Select your option from the choices below! 👇
 text_enter_photo = 🖼️ Upload your photo here and let's see what we can create! 🎨
-text_enter_url = 🔗 Enter your URL here and let's explore what's on the web! 🌐
\ No newline at end of file
+text_enter_url = 🔗 Enter your URL here and let's explore what's on the web! 🌐
+text_busy = 🚦 The bot is very busy right now. Please try again in a minute! ⏳
+text_rate_limited = 🐢 Too many requests! Please try again in { $seconds } s. ⏳
+text_job_failed = 😔 Something went wrong with your request. Please try again later! 🔄
+text_variation = 🔄 Describe an image once and get several takes on it at the same time! Pick a model: 🎨
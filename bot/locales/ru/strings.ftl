@@ -32,3 +32,7 @@ text_text_ru =
 text_gpt-4 = 🤔 Введите ваш вопрос здесь и позвольте GPT-4 найти ответы! 💡
 text_gpt-4o = 🚀 Введите ваш вопрос, чтобы быстрая модель GPT-4o Turbo справилась с ним! ✨
 text_wait = ⏳ Пожалуйста, подождите немного.... Идет обработка! ⌛
+text_busy = 🚦 Сейчас бот очень загружен. Пожалуйста, попробуйте через минуту! ⏳
+text_rate_limited = 🐢 Слишком много запросов! Попробуйте снова через { $seconds } с. ⏳
+text_job_failed = 😔 Что-то пошло не так с вашим запросом. Пожалуйста, попробуйте позже! 🔄
+text_variation = 🔄 Опишите изображение один раз и получите сразу несколько его вариантов! Выберите модель: 🎨
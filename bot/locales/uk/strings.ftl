@@ -30,3 +30,7 @@ text_text_uk =
 text_gpt-4_uk = 🤔 Введіть ваше запитання тут і дозвольте GPT-4 знайти відповіді! 💡
 text_gpt-4o_uk = 🚀 Введіть ваше запитання, щоб швидка модель GPT-4o Turbo впоралася з ним! ✨
 text_wait_uk = ⏳ Будь ласка, зачекайте трохи.... Обробка триває! ⌛
+text_busy = 🚦 Зараз бот дуже завантажений. Будь ласка, спробуйте за хвилину! ⏳
+text_rate_limited = 🐢 Забагато запитів! Спробуйте знову через { $seconds } с. ⏳
+text_job_failed = 😔 Щось пішло не так із вашим запитом. Будь ласка, спробуйте пізніше! 🔄
+text_variation = 🔄 Опишіть зображення один раз і отримайте одразу кілька його варіантів! Оберіть модель: 🎨
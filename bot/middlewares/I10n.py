@@ -50,7 +50,7 @@ class L10nMiddleware(BaseMiddleware):
         """
         This method is an asynchronous method that is called when the middleware is applied to an event.
 
-        It sets the localization for the event based on the user's language code.
+        It sets the localization and the rendered menus for the event based on the user's language code.
 
         Args:
             handler (Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]]): The handler to call after the middleware is applied.
@@ -61,10 +61,12 @@ class L10nMiddleware(BaseMiddleware):
             Any: The result of the handler.
         """
         event: Update
+        language_code = None
         if is_pm(event):
             user: User = data["event_from_user"]
-            data[self.middleware_key] = self.dispenser.get_language(user.language_code)
-        else:
-            data[self.middleware_key] = self.dispenser.default_locale
+            language_code = user.language_code
+        data[self.middleware_key] = self.dispenser.get_language(language_code)
+        # The static texts and keyboards of the language, rendered once
+        data["menus"] = self.dispenser.get_menus(language_code)
 
         return await handler(event, data)
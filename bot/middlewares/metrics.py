@@ -0,0 +1,91 @@
+import time
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.dispatcher.event.handler import HandlerObject
+from aiogram.methods import TelegramMethod
+from aiogram.methods.base import Response, TelegramType
+from aiogram.types import TelegramObject, Update
+
+from bot.utils.metrics import (updates_in_flight, update_errors, update_latency, handler_latency,
+                               telegram_latency)
+
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """
+    This class is an outer update middleware that records latency, in-flight count and errors of every update.
+    """
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any],
+    ) -> Any:
+        event: Update
+        labels = (event.event_type,)
+        updates_in_flight.inc(labels)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            update_errors.inc(labels)
+            raise
+        finally:
+            update_latency.observe(labels, time.perf_counter() - started)
+            updates_in_flight.inc(labels, -1)
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """
+    This class is an inner middleware that records the latency of every handler, labeled with its router.
+
+    Registered on the dispatcher's message and callback query observers, it also applies to the nested routers.
+    """
+
+    def __init__(self):
+        self._labels: dict[Callable, tuple[str, str]] = {}
+
+    def labels(self, handler: HandlerObject) -> tuple[str, str]:
+        labels = self._labels.get(handler.callback)
+        if labels is None:
+            # Every feature module has one router named after it, e.g. bot.handlers.api.text -> router_text
+            module = handler.callback.__module__.rsplit(".", 1)[-1]
+            labels = self._labels[handler.callback] = (f"router_{module}", handler.callback.__name__)
+        return labels
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any],
+    ) -> Any:
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            handler_latency.observe(self.labels(data["handler"]), time.perf_counter() - started)
+
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """
+    This class is a Bot session middleware that records the latency of every Telegram Bot API call.
+    """
+
+    async def __call__(
+            self,
+            make_request: NextRequestMiddlewareType[TelegramType],
+            bot: Bot,
+            method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        started = time.perf_counter()
+        status = "ok"
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            # Bot API errors are raised as exceptions, e.g. TelegramRetryAfter or TelegramBadRequest
+            status = type(e).__name__
+            raise
+        finally:
+            telegram_latency.observe((method.__api_method__, status), time.perf_counter() - started)
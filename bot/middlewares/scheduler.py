@@ -0,0 +1,49 @@
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update, User
+from fluent.runtime import FluentLocalization
+
+from bot.utils.scheduler import SchedulerBusy, current_user
+
+
+class SchedulerMiddleware(BaseMiddleware):
+    """
+    This class is a middleware for the upstream request scheduler.
+
+    It tells the scheduler which user the update belongs to, so requests are queued fairly per user, and answers
+    with a localized "busy" message when the scheduler sheds a request. It must be registered after
+    L10nMiddleware, because it uses the localization that middleware puts into the data.
+    """
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any],
+    ) -> Any:
+        """
+        This method is an asynchronous method that is called when the middleware is applied to an event.
+
+        Args:
+            handler (Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]]): The handler to call after the middleware is applied.
+            event (TelegramObject): The event object that the middleware is applied to.
+            data (Dict[str, Any]): The data associated with the event.
+
+        Returns:
+            Any: The result of the handler.
+        """
+        event: Update
+        user: User = data.get("event_from_user")
+        token = current_user.set(user.id if user else 0)
+        try:
+            return await handler(event, data)
+        except SchedulerBusy:
+            l10n: FluentLocalization = data["l10n"]
+            text = l10n.format_value("text_busy")
+            if event.message:
+                await event.message.answer(text=text)
+            elif event.callback_query:
+                await event.callback_query.answer(text=text, show_alert=True)
+        finally:
+            current_user.reset(token)
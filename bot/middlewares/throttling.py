@@ -0,0 +1,85 @@
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update, User
+from fluent.runtime import FluentLocalization
+
+from bot.utils.rate_limiter import RateLimiter
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    This class is a middleware that limits how often each user may use each feature.
+
+    Messages are counted against the feature of the state group they are sent in. Button presses are counted
+    against "callback:<feature>", the feature found by the longest prefix of the callback data or else by the state
+    group, so pressing through one menu does not use up the presses of the others. Rejected updates are not handled;
+    the user is told once per limited period, in their language, when to try again. It must be registered after
+    L10nMiddleware.
+    """
+
+    def __init__(self, limiter: RateLimiter, state_features: Optional[dict[str, str]] = None,
+                 callback_features: Optional[dict[str, str]] = None):
+        """
+        This method initializes the ThrottlingMiddleware class.
+
+        Args:
+            limiter (RateLimiter): The limiter holding the buckets of the users.
+            state_features (Optional[dict[str, str]]): The feature of each state group.
+            callback_features (Optional[dict[str, str]]): The feature of the buttons, by callback data prefix.
+        """
+        self.limiter = limiter
+        self.state_features = state_features or {}
+        # Longest prefixes first, so "text_to_speech" is not taken for "text"
+        self.callback_features = sorted((callback_features or {}).items(), key=lambda item: -len(item[0]))
+
+    def feature(self, event: Update, data: Dict[str, Any]) -> Optional[str]:
+        raw_state = data.get("raw_state")
+        state_feature = self.state_features.get(raw_state.split(":", 1)[0]) if raw_state else None
+        if event.callback_query:
+            callback = event.callback_query.data or ""
+            feature = next((feature for prefix, feature in self.callback_features if callback.startswith(prefix)),
+                           state_feature)
+            return f"callback:{feature}" if feature else "callback"
+        if event.message:
+            return state_feature
+        return None
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any],
+    ) -> Any:
+        """
+        This method is an asynchronous method that is called when the middleware is applied to an event.
+
+        Args:
+            handler (Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]]): The handler to call after the
+                middleware is applied.
+            event (TelegramObject): The event object that the middleware is applied to.
+            data (Dict[str, Any]): The data associated with the event.
+
+        Returns:
+            Any: The result of the handler, or None if the update was rejected.
+        """
+        event: Update
+        user: User = data.get("event_from_user")
+        feature = self.feature(event, data)
+        if user is None or feature is None:
+            return await handler(event, data)
+
+        allowed, retry_after = self.limiter.hit(user.id, feature)
+        if allowed:
+            return await handler(event, data)
+        if retry_after is not None:
+            l10n: FluentLocalization = data["l10n"]
+            text = l10n.format_value("text_rate_limited", {"seconds": max(1, round(retry_after))})
+            if event.message:
+                await event.message.answer(text=text)
+            else:
+                await event.callback_query.answer(text=text, show_alert=True)
+        elif event.callback_query:
+            # Stop the loading indicator on the button without repeating the warning
+            await event.callback_query.answer()
+        return None
@@ -0,0 +1,94 @@
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.methods import TelegramMethod
+from aiogram.methods.base import Response, TelegramType
+from aiogram.types import TelegramObject, Update, User
+
+from bot.utils.tracing import Tracer, span
+
+
+class TracingMiddleware(BaseMiddleware):
+    """
+    This class is an outer update middleware that starts the trace of every update the tracer picks; every span made
+    while the update is handled becomes part of it.
+    """
+
+    def __init__(self, tracer: Tracer):
+        """
+        This method initializes the TracingMiddleware class.
+
+        Args:
+            tracer (Tracer): The tracer that samples and writes the traces.
+        """
+        self.tracer = tracer
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any],
+    ) -> Any:
+        event: Update
+        user: User = data.get("event_from_user")
+        async with self.tracer.trace(f"update {event.event_type}", track=f"update {event.update_id}",
+                                     user=user.id if user else 0):
+            return await handler(event, data)
+
+
+class TracedMiddleware(BaseMiddleware):
+    """
+    This class wraps an update middleware and times it, with everything below it, as a span named after its class.
+    """
+
+    def __init__(self, middleware: BaseMiddleware):
+        """
+        This method initializes the TracedMiddleware class.
+
+        Args:
+            middleware (BaseMiddleware): The middleware to time.
+        """
+        self.middleware = middleware
+        self.name = type(middleware).__name__
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any],
+    ) -> Any:
+        with span(self.name, "middleware"):
+            return await self.middleware(handler, event, data)
+
+
+class HandlerTracingMiddleware(BaseMiddleware):
+    """
+    This class is an inner middleware that times every handler as a span named after its module and function.
+    """
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any],
+    ) -> Any:
+        callback = data["handler"].callback
+        with span(f"{callback.__module__.rsplit('.', 1)[-1]}.{callback.__name__}", "handler"):
+            return await handler(event, data)
+
+
+class TelegramTracingMiddleware(BaseRequestMiddleware):
+    """
+    This class is a Bot session middleware that times every Telegram Bot API call of a traced update as a span,
+    the wait for the outbound scheduler included.
+    """
+
+    async def __call__(
+            self,
+            make_request: NextRequestMiddlewareType[TelegramType],
+            bot: Bot,
+            method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        with span(f"telegram {method.__api_method__}", "telegram", chat_id=getattr(method, "chat_id", None)):
+            return await make_request(bot, method)
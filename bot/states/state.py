@@ -15,6 +15,13 @@ class StateImage(StatesGroup):
     image = State()
 
 
+class StateVariation(StatesGroup):
+    """
+    This class represents the state group for image variations. It includes a single state: "variation".
+    """
+    variation = State()
+
+
 class StateTextToSpeech(StatesGroup):
     """
     This class represents the state group for text to speech conversion. It includes three states: "text_to_speech",
@@ -0,0 +1,81 @@
+"""
+Usage report of the bot: what users and models spent on OpenAI, summed from the usage ledger (USAGE_LEDGER_PATH).
+
+Usage:
+    python -m bot.usage --by model day --since 2024-05-01
+    python -m bot.usage --by user --model gpt-4o --top 20
+    python -m bot.usage --compact
+"""
+import argparse
+import calendar
+import sys
+import time
+from typing import Optional
+
+from bot.utils.usage import COUNTERS, GROUPS, aggregate, compact, read_records
+
+
+def _day(value: str) -> float:
+    return calendar.timegm(time.strptime(value, "%Y-%m-%d"))
+
+
+def report(path: str, by: list[str], since: Optional[str] = None, until: Optional[str] = None,
+           users: Optional[list[int]] = None, models: Optional[list[str]] = None, sort: str = "requests",
+           top: Optional[int] = None) -> list[list]:
+    """
+    This function sums the usage of a ledger and returns it as table rows, the header first.
+
+    Parameters:
+    path (str): The raw ledger file.
+    by (list[str]): The fields to group by, out of user, model and day.
+    since (Optional[str]): The first day included, as YYYY-MM-DD.
+    until (Optional[str]): The last day included, as YYYY-MM-DD.
+    users (Optional[list[int]]): Only these users.
+    models (Optional[list[str]]): Only these models.
+    sort (str): The counter the rows are sorted by, largest first; the groups are sorted in order when it is empty.
+    top (Optional[int]): The most rows returned.
+
+    Returns:
+    list[list]: The header and the rows.
+    """
+    sums = aggregate(read_records(path), by=by, since=_day(since) if since else None,
+                     until=_day(until) + 86400 if until else None, users=set(users) if users else None,
+                     models=set(models) if models else None)
+    if sort:
+        index = COUNTERS.index(sort)
+        rows = sorted(sums.items(), key=lambda item: item[1][index], reverse=True)
+    else:
+        rows = sorted(sums.items())
+    rows = [[*key, *counters[:5], round(counters[5], 1)] for key, counters in rows[:top]]
+    return [[*by, *COUNTERS], *rows]
+
+
+def main() -> None:
+    from bot.config import USAGE_LEDGER_PATH
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--path", default=USAGE_LEDGER_PATH, help="the ledger file, USAGE_LEDGER_PATH by default")
+    parser.add_argument("--by", nargs="*", choices=GROUPS, default=["user", "model"])
+    parser.add_argument("--since", help="first day, YYYY-MM-DD")
+    parser.add_argument("--until", help="last day, YYYY-MM-DD")
+    parser.add_argument("--user", type=int, action="append", help="only this user, may be repeated")
+    parser.add_argument("--model", action="append", help="only this model, may be repeated")
+    parser.add_argument("--sort", choices=[*COUNTERS, ""], default="requests", help="empty to sort by the groups")
+    parser.add_argument("--top", type=int, help="print only the first rows")
+    parser.add_argument("--compact", action="store_true", help="fold the raw records into daily ones first")
+    args = parser.parse_args()
+    if not args.path:
+        parser.error("the ledger is not configured, set USAGE_LEDGER_PATH or pass --path")
+
+    started = time.perf_counter()
+    if args.compact:
+        print(f"compacted {compact(args.path)} records", file=sys.stderr)
+    table = report(args.path, args.by, args.since, args.until, args.user, args.model, args.sort, args.top)
+    widths = [max(len(str(row[column])) for row in table) for column in range(len(table[0]))]
+    for row in table:
+        print("  ".join(str(value).rjust(width) for value, width in zip(row, widths)))
+    print(f"{len(table) - 1} rows in {time.perf_counter() - started:.2f}s", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
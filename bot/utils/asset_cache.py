@@ -0,0 +1,97 @@
+import hashlib
+import json
+from typing import Any, Optional
+
+from bot.utils.lru import LRUCache
+
+
+def asset_key(endpoint: str, model: str, params: dict[str, Any], prompt: str) -> str:
+    """
+    This function builds the content address of a generated asset.
+
+    Parameters:
+    endpoint (str): The OpenAI endpoint that generates the asset, e.g. "audio/speech".
+    model (str): The model used for generation.
+    params (dict[str, Any]): The remaining request parameters that change the output.
+    prompt (str): The input the asset is generated from.
+
+    Returns:
+    str: A hex SHA-256 digest identifying the asset.
+    """
+    raw = json.dumps([endpoint, model, params, prompt], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class AssetCache:
+    """
+    This class remembers the Telegram file_id of assets the bot has already generated and uploaded.
+
+    A repeated request is answered by sending the stored file_id, which costs a single Telegram call with no
+    OpenAI request and no upload. Entries expire after ``ttl`` seconds and the least recently used ones are evicted
+    once the cache holds ``max_entries`` assets.
+    """
+
+    def __init__(self, max_entries: int = 10_000, ttl: float = 7 * 24 * 3600):
+        """
+        This method initializes the AssetCache class.
+
+        Args:
+            max_entries (int): The maximum number of assets remembered at once.
+            ttl (float): The number of seconds an asset is reused before it is generated again.
+        """
+        # key -> file_id, sized by the bytes of the asset
+        self._entries = LRUCache(max_entries=max_entries, ttl=ttl)
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        This method looks up the file_id of an asset and counts the hit or miss.
+
+        Args:
+            key (str): The key built with asset_key.
+
+        Returns:
+            Optional[str]: The Telegram file_id, or None if the asset is unknown or expired.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.bytes_saved += entry[1]
+        return entry[0]
+
+    def put(self, key: str, file_id: str, size: Optional[int]) -> None:
+        """
+        This method stores the file_id Telegram returned for a freshly uploaded asset.
+
+        Args:
+            key (str): The key built with asset_key.
+            file_id (str): The file_id of the uploaded asset.
+            size (Optional[int]): The size of the asset in bytes, used to report the bytes saved by hits.
+        """
+        self._entries.put(key, file_id, size or 0)
+
+    def discard(self, key: str) -> None:
+        """
+        This method forgets an asset, e.g. when Telegram no longer accepts its file_id.
+        """
+        self._entries.discard(key)
+
+    def stats(self) -> dict[str, float]:
+        """
+        This method reports how well the cache works.
+
+        Returns:
+            dict[str, float]: The number of entries, hits and misses, the hit rate and the bytes not re-uploaded.
+        """
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "bytes_saved": self.bytes_saved,
+        }
@@ -0,0 +1,178 @@
+import io
+import struct
+from dataclasses import dataclass
+from typing import BinaryIO, Optional
+
+# Fixed part of an Ogg page header, followed by the segment table
+_OGG_HEADER = struct.Struct("<4sBBqIIIB")
+# Header type flag of a page that continues a packet of the previous page
+_OGG_CONTINUED = 0x01
+# Bytes of an MP3 file searched at a time for the next frame header
+_MP3_WINDOW = 4096
+
+
+@dataclass(frozen=True)
+class AudioPart:
+    """
+    This class describes a part of a split audio file by the byte ranges of the file it is made of, so the parts
+    are read one at a time instead of the whole file being held in memory.
+    """
+    ranges: tuple[tuple[int, int], ...]
+
+    @property
+    def size(self) -> int:
+        return sum(end - start for start, end in self.ranges)
+
+    def read(self, file: BinaryIO) -> bytes:
+        """
+        This method reads the part from the file it was split from.
+
+        Parameters:
+        file (BinaryIO): The audio file.
+
+        Returns:
+        bytes: The part, a file that can be decoded on its own.
+        """
+        chunks = []
+        for start, end in self.ranges:
+            file.seek(start)
+            chunks.append(file.read(end - start))
+        return b"".join(chunks)
+
+
+def _length(file: BinaryIO) -> int:
+    return file.seek(0, io.SEEK_END)
+
+
+def _ogg_pages(file: BinaryIO, length: int) -> Optional[list[tuple[int, int, int, int]]]:
+    # (start, end, header type, granule position) of every page, None when the file is not a clean Ogg stream.
+    # Only the page headers are read, the audio data in between is skipped.
+    pages = []
+    position = 0
+    while position < length:
+        file.seek(position)
+        header = file.read(_OGG_HEADER.size)
+        if len(header) < _OGG_HEADER.size:
+            return None
+        capture, _, header_type, granule, _, _, _, segments = _OGG_HEADER.unpack(header)
+        if capture != b"OggS":
+            return None
+        table = file.read(segments)
+        end = position + _OGG_HEADER.size + segments + sum(table)
+        if len(table) < segments or end > length:
+            return None
+        pages.append((position, end, header_type, granule))
+        position = end
+    return pages
+
+
+def split_ogg(file: BinaryIO, parts: int) -> list[AudioPart]:
+    """
+    This function splits an Ogg stream (a Telegram voice message) into about equally long streams at page
+    boundaries, without decoding it.
+
+    Every part starts with the header pages of the stream, so it can be decoded on its own. A part never starts with
+    a page that continues a packet of the previous one.
+
+    Parameters:
+    file (BinaryIO): The Ogg stream.
+    parts (int): The number of parts wanted.
+
+    Returns:
+    list[AudioPart]: The parts in order, the stream as it is when it cannot be split.
+    """
+    length = _length(file)
+    pages = _ogg_pages(file, length) if parts > 1 else None
+    if not pages:
+        return [AudioPart(((0, length),))]
+    # Header pages (identification, comments) carry no audio and have a granule position of 0
+    headers = 0
+    while headers < len(pages) and pages[headers][3] == 0:
+        headers += 1
+    if headers == len(pages):
+        return [AudioPart(((0, length),))]
+    header = (0, pages[headers][0])
+    audio = pages[headers:]
+    target = (audio[-1][1] - audio[0][0]) / parts
+
+    chunks = []
+    start = audio[0][0]
+    for page_start, _, header_type, _ in audio[1:]:
+        if page_start - start >= target and not header_type & _OGG_CONTINUED and len(chunks) < parts - 1:
+            chunks.append(AudioPart((header, (start, page_start))))
+            start = page_start
+    chunks.append(AudioPart((header, (start, length))))
+    return chunks
+
+
+def _is_mp3_frame(data: bytes, position: int) -> bool:
+    if position + 4 > len(data) or data[position] != 0xFF or data[position + 1] & 0xE0 != 0xE0:
+        return False
+    version, layer = data[position + 1] >> 3 & 0x03, data[position + 1] >> 1 & 0x03
+    bitrate, sample_rate = data[position + 2] >> 4, data[position + 2] >> 2 & 0x03
+    # Reserved values, and the "free" bitrate nobody uses
+    return version != 1 and layer != 0 and bitrate not in (0, 15) and sample_rate != 3
+
+
+def _next_mp3_frame(file: BinaryIO, position: int, length: int) -> int:
+    # A frame header is 4 bytes long, so every window overlaps the next one by 3 bytes
+    while position < length:
+        file.seek(position)
+        window = file.read(_MP3_WINDOW + 3)
+        for offset in range(min(_MP3_WINDOW, len(window))):
+            if _is_mp3_frame(window, offset):
+                return position + offset
+        position += _MP3_WINDOW
+    return length
+
+
+def split_mp3(file: BinaryIO, parts: int) -> list[AudioPart]:
+    """
+    This function splits an MP3 file into about equally long files at frame boundaries, without decoding it.
+
+    Parameters:
+    file (BinaryIO): The MP3 file.
+    parts (int): The number of parts wanted.
+
+    Returns:
+    list[AudioPart]: The parts in order, the file as it is when it cannot be split.
+    """
+    length = _length(file)
+    if parts <= 1:
+        return [AudioPart(((0, length),))]
+    # An ID3v2 tag at the start stays with the first part
+    start = 0
+    file.seek(0)
+    tag = file.read(10)
+    if tag[:3] == b"ID3" and len(tag) == 10:
+        start = 10 + (tag[6] << 21 | tag[7] << 14 | tag[8] << 7 | tag[9])
+    cuts = []
+    for index in range(1, parts):
+        position = _next_mp3_frame(file, start + (length - start) * index // parts, length)
+        if position < length and (not cuts or position > cuts[-1]):
+            cuts.append(position)
+    bounds = [0, *cuts, length]
+    return [AudioPart(((begin, end),)) for begin, end in zip(bounds, bounds[1:])]
+
+
+def split_audio(file: BinaryIO, mime_type: Optional[str], parts: int) -> list[AudioPart]:
+    """
+    This function splits an audio file into about equally long files that can be transcribed on their own.
+
+    Ogg (voice messages) and MP3 files are split; other formats, e.g. the MP4 of a video note, need decoding to be
+    split and are returned whole. The file is searched for the places to cut, never read whole.
+
+    Parameters:
+    file (BinaryIO): The audio file, seekable.
+    mime_type (Optional[str]): Its MIME type, as Telegram reports it.
+    parts (int): The number of parts wanted.
+
+    Returns:
+    list[AudioPart]: The parts in order, read from the file with AudioPart.read.
+    """
+    file.seek(0)
+    if mime_type in ("audio/ogg", "audio/opus", "audio/x-opus+ogg") or file.read(4) == b"OggS":
+        return split_ogg(file, parts)
+    if mime_type in ("audio/mpeg", "audio/mp3"):
+        return split_mp3(file, parts)
+    return [AudioPart(((0, _length(file)),))]
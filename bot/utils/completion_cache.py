@@ -0,0 +1,155 @@
+import asyncio
+import hashlib
+import sqlite3
+import time
+from typing import Iterable, Optional
+
+from bot.utils.lru import LRUCache
+
+
+def normalize_prompt(prompt: str) -> str:
+    """
+    This function normalizes a prompt so trivially different spellings of the same question share a cache entry.
+
+    Whitespace is collapsed and case is folded.
+    """
+    return " ".join(prompt.split()).casefold()
+
+
+class SqliteCompletionBackend:
+    """
+    This class persists cached completions in a SQLite file, so they survive restarts.
+
+    SQLite calls are blocking, so every query runs in a worker thread.
+    """
+
+    def __init__(self, path: str):
+        """
+        This method initializes the SqliteCompletionBackend class.
+
+        Args:
+            path (str): The path of the SQLite database file.
+        """
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS completions (key TEXT PRIMARY KEY, answer TEXT, expires REAL)")
+        self._db.commit()
+        self._lock = asyncio.Lock()
+
+    def _get(self, key: str) -> Optional[tuple[str, float]]:
+        return self._db.execute("SELECT answer, expires FROM completions WHERE key = ?", (key,)).fetchone()
+
+    def _set(self, key: str, answer: str, expires: float) -> None:
+        self._db.execute("INSERT OR REPLACE INTO completions VALUES (?, ?, ?)", (key, answer, expires))
+        self._db.execute("DELETE FROM completions WHERE expires < ?", (time.time(),))
+        self._db.commit()
+
+    async def get(self, key: str) -> Optional[str]:
+        async with self._lock:
+            row = await asyncio.to_thread(self._get, key)
+        if row is None or row[1] < time.time():
+            return None
+        return row[0]
+
+    async def set(self, key: str, answer: str, ttl: float) -> None:
+        async with self._lock:
+            await asyncio.to_thread(self._set, key, answer, time.time() + ttl)
+
+    def close(self) -> None:
+        self._db.close()
+
+
+class CompletionCache:
+    """
+    This class caches chat completions for repeated questions.
+
+    Entries are keyed by the model, a hash of the system prompt and the normalized user prompt. Hot entries live in
+    an in-memory LRU bounded by entry count and total characters; an optional backend keeps them across restarts
+    and is read through on a memory miss.
+    """
+
+    def __init__(self, max_entries: int = 10_000, max_chars: int = 50_000_000, ttl: float = 24 * 3600,
+                 backend: Optional[SqliteCompletionBackend] = None, disabled_models: Iterable[str] = ()):
+        """
+        This method initializes the CompletionCache class.
+
+        Args:
+            max_entries (int): The maximum number of answers kept in memory.
+            max_chars (int): The maximum total length of the answers kept in memory.
+            ttl (float): The number of seconds an answer is reused.
+            backend (Optional[SqliteCompletionBackend]): The persistent store, or None to cache in memory only.
+            disabled_models (Iterable[str]): The models whose answers are never cached.
+        """
+        self.ttl = ttl
+        self.backend = backend
+        self.disabled_models = set(disabled_models)
+        self._memory = LRUCache(max_entries=max_entries, ttl=ttl, max_size=max_chars)
+        self.hits = 0
+        self.misses = 0
+
+    def enabled(self, model: str) -> bool:
+        return model not in self.disabled_models
+
+    @staticmethod
+    def key(model: str, system_prompt: str, prompt: str) -> str:
+        system_hash = hashlib.sha256(system_prompt.encode("utf-8")).hexdigest()
+        raw = "\0".join((model, system_hash, normalize_prompt(prompt)))
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    async def get(self, model: str, system_prompt: str, prompt: str) -> Optional[str]:
+        """
+        This method looks up the cached answer of a question.
+
+        Args:
+            model (str): The model the question is asked to.
+            system_prompt (str): The system prompt sent with the question.
+            prompt (str): The question of the user.
+
+        Returns:
+            Optional[str]: The cached answer, or None on a miss or when the model is not cached.
+        """
+        if not self.enabled(model):
+            return None
+        key = self.key(model, system_prompt, prompt)
+        entry = self._memory.get(key)
+        answer = entry[0] if entry else None
+        if answer is None and self.backend is not None:
+            answer = await self.backend.get(key)
+            if answer is not None:
+                self._memory.put(key, answer, len(answer))
+        if answer is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return answer
+
+    async def put(self, model: str, system_prompt: str, prompt: str, answer: str) -> None:
+        """
+        This method stores the answer to a question.
+
+        Args:
+            model (str): The model that answered.
+            system_prompt (str): The system prompt sent with the question.
+            prompt (str): The question of the user.
+            answer (str): The answer of the model.
+        """
+        if not self.enabled(model):
+            return
+        key = self.key(model, system_prompt, prompt)
+        self._memory.put(key, answer, len(answer))
+        if self.backend is not None:
+            await self.backend.set(key, answer, self.ttl)
+
+    def stats(self) -> dict[str, float]:
+        """
+        This method reports how well the cache works.
+
+        Returns:
+            dict[str, float]: The number of answers in memory, hits, misses and the hit rate.
+        """
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._memory),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
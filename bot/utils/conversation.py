@@ -0,0 +1,130 @@
+import math
+from typing import Optional
+
+# Tokens the chat format adds around every message
+MESSAGE_OVERHEAD = 4
+
+# Default prompt budget per model, leaving room for the answer inside the context window
+CONTEXT_BUDGETS = {
+    "gpt-4": 6_000,
+    "gpt-4o": 16_000,
+}
+DEFAULT_CONTEXT_BUDGET = 4_000
+
+_ROLES = {"u": "user", "a": "assistant"}
+_CODES = {role: code for code, role in _ROLES.items()}
+
+
+def count_tokens(text: str) -> int:
+    """
+    This function estimates the number of tokens of a message, about four characters per token.
+    """
+    return math.ceil(len(text) / 4) + MESSAGE_OVERHEAD
+
+
+class Conversation:
+    """
+    This class is the history of a chat with the text model, kept in the FSM data in compact form.
+
+    Every turn is stored as ``[role code, text, tokens]``; its tokens are counted once when it is added and never
+    again. The prompt is laid out as system prompt, summary of dropped turns, turns and the new question, so the
+    beginning of consecutive requests stays the same and provider-side prompt caching applies. When the history
+    outgrows the budget, the oldest turns are dropped in one go down to ``trim_to`` of the budget, so the prefix
+    changes only once in a while instead of on every request.
+    """
+
+    def __init__(self, turns: Optional[list] = None, summary: Optional[list] = None, trim_to: float = 0.6):
+        """
+        This method initializes the Conversation class.
+
+        Args:
+            turns (Optional[list]): The stored turns, oldest first.
+            summary (Optional[list]): The stored summary of dropped turns as ``[text, tokens]``.
+            trim_to (float): The share of the budget the history is cut down to when it overflows.
+        """
+        self.turns = turns or []
+        self.summary = summary
+        self.trim_to = trim_to
+        self.tokens = sum(turn[2] for turn in self.turns) + (summary[1] if summary else 0)
+
+    @classmethod
+    def from_data(cls, data: Optional[dict]) -> "Conversation":
+        data = data or {}
+        # The lists belong to the FSM record, which must not change before the answer succeeded and is saved
+        turns = [list(turn) for turn in data.get("turns") or []]
+        summary = list(data["summary"]) if data.get("summary") else None
+        return cls(turns=turns, summary=summary)
+
+    def to_data(self) -> dict:
+        return {"turns": self.turns, "summary": self.summary}
+
+    def __bool__(self) -> bool:
+        return bool(self.turns or self.summary)
+
+    def add(self, role: str, text: str) -> None:
+        """
+        This method appends a turn and counts its tokens.
+
+        Args:
+            role (str): "user" or "assistant".
+            text (str): The text of the turn.
+        """
+        tokens = count_tokens(text)
+        self.turns.append([_CODES[role], text, tokens])
+        self.tokens += tokens
+
+    def set_summary(self, text: str) -> None:
+        if self.summary:
+            self.tokens -= self.summary[1]
+        self.summary = [text, count_tokens(text)]
+        self.tokens += self.summary[1]
+
+    def trim(self, budget: int) -> list[list]:
+        """
+        This method drops the oldest turns when the history does not fit into the budget.
+
+        Turns are dropped in user/assistant pairs, so the history never starts with an answer.
+
+        Args:
+            budget (int): The number of tokens the history may use.
+
+        Returns:
+            list[list]: The dropped turns, oldest first.
+        """
+        if self.tokens <= budget:
+            return []
+        target = budget * self.trim_to
+        cut = 0
+        while cut < len(self.turns) and self.tokens > target:
+            self.tokens -= self.turns[cut][2]
+            cut += 1
+        if cut < len(self.turns) and self.turns[cut][0] == "a":
+            self.tokens -= self.turns[cut][2]
+            cut += 1
+        dropped, self.turns = self.turns[:cut], self.turns[cut:]
+        return dropped
+
+    def messages(self, system_prompt: str, prompt: str) -> list[dict]:
+        """
+        This method builds the chat messages of a request in the stable prefix layout.
+
+        Args:
+            system_prompt (str): The system prompt.
+            prompt (str): The new question of the user.
+
+        Returns:
+            list[dict]: The messages to send to the model.
+        """
+        messages = [{"role": "system", "content": system_prompt}]
+        if self.summary:
+            messages.append({"role": "system", "content": f"Summary of the earlier conversation: {self.summary[0]}"})
+        messages.extend({"role": _ROLES[code], "content": text} for code, text, _ in self.turns)
+        messages.append({"role": "user", "content": prompt})
+        return messages
+
+
+def format_turns(turns: list[list]) -> str:
+    """
+    This function renders stored turns as plain text, e.g. to have them summarized.
+    """
+    return "\n".join(f"{_ROLES[code]}: {text}" for code, text, _ in turns)
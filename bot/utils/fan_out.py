@@ -0,0 +1,37 @@
+import asyncio
+from typing import AsyncIterator, Awaitable, Callable, Iterable, TypeVar
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+async def ordered_fan_out(items: Iterable[T], function: Callable[[T], Awaitable[R]],
+                          parallel: int) -> AsyncIterator[R]:
+    """
+    This function runs a function over the items at once, at most ``parallel`` at a time, and yields the results
+    in the order of the items, each as soon as it and every result before it are ready.
+
+    Closing the iterator early (e.g. with contextlib.aclosing around a loop that breaks) cancels the calls still
+    running or waiting.
+
+    Parameters:
+    items (Iterable[T]): The inputs, in order.
+    function (Callable[[T], Awaitable[R]]): The call made for each input.
+    parallel (int): The most calls running at a time.
+
+    Yields:
+    R: The result of the next input. An exception raised by a call is raised here, in its turn.
+    """
+    semaphore = asyncio.Semaphore(parallel)
+
+    async def call(item: T) -> R:
+        async with semaphore:
+            return await function(item)
+
+    tasks = [asyncio.ensure_future(call(item)) for item in items]
+    try:
+        for task in tasks:
+            yield await task
+    finally:
+        for task in tasks:
+            task.cancel()
@@ -1,14 +1,55 @@
-
+import time
 from pathlib import Path
+from typing import Any, Callable, Optional, TypeVar
 
 from fluent.runtime import FluentLocalization, FluentResourceLoader
 
+T = TypeVar("T")
+
+
+class MenuCache:
+    """
+    This class holds the static texts and keyboards of one language, rendered once and shared by every update.
+
+    A keyboard is rendered by a builder function taking the localization; the builder itself is the cache key, so
+    builders must be module-level functions. The cached objects are shared, aiogram's frozen models keep them
+    from being changed by accident.
+    """
+
+    def __init__(self, l10n: FluentLocalization):
+        self.l10n = l10n
+        self._texts: dict[str, str] = {}
+        self._built: dict[Callable, Any] = {}
+
+    def text(self, msg_id: str) -> str:
+        """
+        This method returns a message without arguments, formatted once.
+        """
+        text = self._texts.get(msg_id)
+        if text is None:
+            text = self._texts[msg_id] = self.l10n.format_value(msg_id)
+        return text
+
+    def __call__(self, builder: Callable[[FluentLocalization], T]) -> T:
+        """
+        This method returns what the builder renders for this language, calling it only the first time.
+        """
+        try:
+            return self._built[builder]
+        except KeyError:
+            built = self._built[builder] = builder(self.l10n)
+            return built
+
 
 class FluentDispenser:
-    def __init__(self, locales_dir: Path, default_language: str = "en"):
+    def __init__(self, locales_dir: Path, default_language: str = "en", preload: bool = False,
+                 reload_interval: float = 0):
         self.__loader = FluentResourceLoader(str(locales_dir) + "/{locale}")
         self.__default_language = default_language
+        self.__locales_dir = locales_dir
+        # Localizations and menus are built on the first request for their language
         self.languages = dict()
+        self.menus: dict[str, MenuCache] = dict()
 
         dirs_names = set()
         default_language_dir = None
@@ -20,22 +61,66 @@ class FluentDispenser:
         if not default_language_dir:
             raise ValueError("FluentDispenser: default language directory not found")
 
-        ftl_files_list = [item.name for item in default_language_dir.iterdir() if item.suffix == ".ftl"]
+        self.__names = dirs_names
+        self.__ftl_files_list = [item.name for item in default_language_dir.iterdir() if item.suffix == ".ftl"]
+
+        # Changed locale files are picked up at most every reload_interval seconds, never when it is 0
+        self.__reload_interval = reload_interval
+        self.__checked_at = time.monotonic()
+        self.__version = self.__files_version()
+
+        if preload:
+            for name in dirs_names:
+                self.__load(name)
 
-        for name in dirs_names:
-            if name == default_language:
-                self.languages[name] = FluentLocalization([self.__default_language], ftl_files_list, self.__loader)
+    def __files_version(self) -> tuple:
+        return tuple(sorted((str(path), path.stat().st_mtime_ns) for path in self.__locales_dir.glob("*/*.ftl")))
+
+    def __check_reload(self) -> None:
+        if not self.__reload_interval or time.monotonic() - self.__checked_at < self.__reload_interval:
+            return
+        self.__checked_at = time.monotonic()
+        version = self.__files_version()
+        if version != self.__version:
+            self.__version = version
+            self.languages = dict()
+            self.menus = dict()
+
+    def __load(self, name: str) -> FluentLocalization:
+        localization = self.languages.get(name)
+        if localization is None:
+            if name == self.__default_language:
+                locales = [self.__default_language]
             else:
-                self.languages[name] = FluentLocalization([name, self.__default_language], ftl_files_list,
-                                                          self.__loader)
+                locales = [name, self.__default_language]
+            localization = FluentLocalization(locales, self.__ftl_files_list, self.__loader)
+            # Looking up a missing message parses the files of every locale in the chain, now rather than in the
+            # middle of the first real message
+            localization.format_value("")
+            self.languages[name] = localization
+        return localization
 
     @property
     def default_locale(self) -> FluentLocalization:
-        return self.languages[self.__default_language]
+        return self.__load(self.__default_language)
 
     @property
     def available_languages(self) -> list[str]:
-        return list(self.languages.keys())
+        return list(self.__names)
+
+    def get_language(self, language_code: Optional[str]):
+        self.__check_reload()
+        if language_code not in self.__names:
+            return self.default_locale
+        return self.__load(language_code)
 
-    def get_language(self, language_code: str):
-        return self.languages.get(language_code, self.default_locale)
+    def get_menus(self, language_code: Optional[str]) -> MenuCache:
+        """
+        This method returns the rendered static texts and keyboards of a language.
+        """
+        self.__check_reload()
+        name = language_code if language_code in self.__names else self.__default_language
+        menus = self.menus.get(name)
+        if menus is None:
+            menus = self.menus[name] = MenuCache(self.__load(name))
+        return menus
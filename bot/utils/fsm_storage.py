@@ -0,0 +1,192 @@
+import asyncio
+import copy
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryBackend:
+    """
+    This class keeps FSM records in a dict. It stands in for MongoBackend in tests and benchmarks.
+    """
+
+    def __init__(self):
+        self.records: dict[str, dict] = {}
+        self.loads = 0
+        self.saves = 0
+
+    async def load(self, key: str) -> Optional[dict]:
+        self.loads += 1
+        record = self.records.get(key)
+        return copy.deepcopy(record) if record is not None else None
+
+    async def save(self, key: str, record: dict) -> None:
+        self.saves += 1
+        self.records[key] = copy.deepcopy(record)
+
+    async def close(self) -> None:
+        pass
+
+
+class MongoBackend:
+    """
+    This class keeps FSM records in a MongoDB collection, one document per chat and user.
+    """
+
+    def __init__(self, url: str, database: str = "telegram_bot", collection: str = "fsm"):
+        """
+        This method initializes the MongoBackend class.
+
+        Args:
+            url (str): The MongoDB connection URL.
+            database (str): The database name.
+            collection (str): The collection name.
+        """
+        # Imported here so the rest of the storage works without the MongoDB driver
+        from motor.motor_asyncio import AsyncIOMotorClient
+
+        self._client = AsyncIOMotorClient(url)
+        self._collection = self._client[database][collection]
+
+    async def load(self, key: str) -> Optional[dict]:
+        document = await self._collection.find_one({"_id": key})
+        if document is None:
+            return None
+        return {"state": document.get("state"), "data": document.get("data", {})}
+
+    async def save(self, key: str, record: dict) -> None:
+        # The driver encodes the document while the cached record may still change, so it gets a copy of its own
+        await self._collection.replace_one({"_id": key}, copy.deepcopy(record), upsert=True)
+
+    async def close(self) -> None:
+        self._client.close()
+
+
+class CachedStorage(BaseStorage):
+    """
+    This class is a persistent FSM storage with an in-process read-through cache.
+
+    Records of hot chats are served from an LRU, so reads usually cost no round trip. Writes update the cached
+    record and are flushed by a background task on the next loop iteration, so the ``update_data`` + ``set_state``
+    pair a handler makes becomes a single save. Several processes can share the backend as long as every chat is
+    always handled by the same process, otherwise their caches go stale. A save that fails is tried again a few
+    times before the record is given up.
+    """
+
+    def __init__(self, backend, cache_size: int = 10_000, flush_delay: float = 0.0,
+                 key_builder: Optional[KeyBuilder] = None, max_retries: int = 5, retry_delay: float = 1.0):
+        """
+        This method initializes the CachedStorage class.
+
+        Args:
+            backend: The persistent store, e.g. MongoBackend or MemoryBackend.
+            cache_size (int): The number of records kept in memory.
+            flush_delay (float): The number of seconds writes are held back to merge them with later ones.
+            key_builder (Optional[KeyBuilder]): Builds the record key from the storage key.
+            max_retries (int): The number of times a failed save of a record is tried again.
+            retry_delay (float): The number of seconds before the first retry; it doubles with every retry.
+        """
+        self.backend = backend
+        self.cache_size = cache_size
+        self.flush_delay = flush_delay
+        self.key_builder = key_builder or DefaultKeyBuilder()
+        self._cache: OrderedDict[str, dict] = OrderedDict()
+        # Records written but not saved yet, and records being saved right now
+        self._dirty: dict[str, dict] = {}
+        self._saving: dict[str, dict] = {}
+        # Record key -> failed saves in a row
+        self._failures: dict[str, int] = {}
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self._flush_task: Optional[asyncio.Task] = None
+
+    async def _record(self, key: StorageKey) -> tuple[str, dict]:
+        name = self.key_builder.build(key)
+        record = self._cache.get(name)
+        if record is not None:
+            self._cache.move_to_end(name)
+            return name, record
+
+        record = self._dirty.get(name) or self._saving.get(name)
+        if record is None:
+            record = await self.backend.load(name) or {"state": None, "data": {}}
+            # Another update of the same chat may have loaded the record meanwhile, keep its copy
+            if name in self._cache:
+                return name, self._cache[name]
+        self._cache[name] = record
+        if len(self._cache) > self.cache_size:
+            # Evicting a dirty record is safe, the pending flush still holds it
+            self._cache.popitem(last=False)
+        return name, record
+
+    def _schedule(self, name: str, record: dict) -> None:
+        self._dirty[name] = record
+        # A flush task that crashed or was cancelled is replaced, or no record would ever be saved again
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush())
+
+    async def _flush(self) -> None:
+        try:
+            await self._save_dirty()
+        except Exception:
+            logger.exception("Failed to flush FSM records, they are saved with the next write")
+            for name, record in self._saving.items():
+                self._dirty.setdefault(name, record)
+            self._saving = {}
+        self._flush_task = None
+
+    async def _save_dirty(self) -> None:
+        await asyncio.sleep(self.flush_delay)
+        while self._dirty:
+            self._saving, self._dirty = self._dirty, {}
+            results = await asyncio.gather(
+                *(self.backend.save(name, record) for name, record in self._saving.items()),
+                return_exceptions=True,
+            )
+            retries = 0
+            for (name, record), result in zip(self._saving.items(), results):
+                if not isinstance(result, Exception):
+                    self._failures.pop(name, None)
+                    continue
+                failures = self._failures[name] = self._failures.get(name, 0) + 1
+                if failures > self.max_retries:
+                    logger.error("Giving up saving FSM record %s after %s attempts: %r", name, failures, result)
+                    del self._failures[name]
+                    continue
+                logger.warning("Failed to save FSM record %s, attempt %s: %r", name, failures, result)
+                retries = max(retries, failures)
+                # A write made while it was being saved is newer and takes its place
+                self._dirty.setdefault(name, record)
+            self._saving = {}
+            if retries:
+                await asyncio.sleep(self.retry_delay * 2 ** (retries - 1))
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        name, record = await self._record(key)
+        record["state"] = state.state if isinstance(state, State) else state
+        self._schedule(name, record)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        _, record = await self._record(key)
+        return record["state"]
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        name, record = await self._record(key)
+        record["data"] = data.copy()
+        self._schedule(name, record)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, record = await self._record(key)
+        return record["data"].copy()
+
+    async def close(self) -> None:
+        if self._flush_task is not None and not self._flush_task.done():
+            await self._flush_task
+        if self._dirty:
+            await self._flush()
+        await self.backend.close()
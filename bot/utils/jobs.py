@@ -0,0 +1,397 @@
+import asyncio
+import importlib
+import json
+import logging
+import sqlite3
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Optional
+
+from aiogram import Bot
+
+from bot.utils.fluent_helper import FluentDispenser
+from bot.utils.scheduler import SchedulerBusy, current_user
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Job:
+    """
+    This class is a queued piece of work: what to do (``kind``), for which chat and with which input.
+    """
+    id: int
+    kind: str
+    chat_id: int
+    payload: dict[str, Any]
+    attempts: int
+
+
+class JobError(Exception):
+    """
+    This exception is raised by a job that failed in a way the user should be told about. After the last attempt
+    its message is sent to the chat as is.
+    """
+
+
+JobHandler = Callable[[Bot, Job], Awaitable[None]]
+
+# Failures other than JobError the user is told about in their language; any other one gets "text_job_failed"
+FAILURE_MESSAGES: dict[type[Exception], str] = {
+    SchedulerBusy: "text_busy",
+}
+
+
+class SqliteJobBackend:
+    """
+    This class keeps the job queue in a SQLite file, so queued jobs survive restarts and can be shared by several
+    processes on one host.
+
+    A claimed job is leased for a while instead of removed; it is deleted only once it is done. Its worker renews the
+    lease while the job runs, and a job whose worker died becomes claimable again when its lease expires, so every
+    job runs at least once.
+
+    SQLite calls are blocking, so every query runs in a worker thread.
+    """
+
+    def __init__(self, path: str):
+        """
+        This method initializes the SqliteJobBackend class.
+
+        Args:
+            path (str): The path of the SQLite database file.
+        """
+        # Transactions are explicit, so a claim is atomic across processes
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, "
+            "chat_id INTEGER NOT NULL, payload TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, "
+            "run_at REAL NOT NULL, leased_until REAL NOT NULL DEFAULT 0, failed INTEGER NOT NULL DEFAULT 0, "
+            "error TEXT)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (kind, failed, run_at)")
+        self._lock = asyncio.Lock()
+
+    def _add(self, kind: str, chat_id: int, payload: str, run_at: float) -> int:
+        cursor = self._db.execute("INSERT INTO jobs (kind, chat_id, payload, run_at) VALUES (?, ?, ?, ?)",
+                                  (kind, chat_id, payload, run_at))
+        return cursor.lastrowid
+
+    def _claim(self, kind: str, limit: int, lease: float) -> list[Job]:
+        now = time.time()
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            rows = self._db.execute(
+                "SELECT id, chat_id, payload, attempts FROM jobs WHERE kind = ? AND failed = 0 AND run_at <= ? "
+                "AND leased_until <= ? ORDER BY run_at LIMIT ?",
+                (kind, now, now, limit),
+            ).fetchall()
+            self._db.executemany("UPDATE jobs SET leased_until = ?, attempts = attempts + 1 WHERE id = ?",
+                                 [(now + lease, row[0]) for row in rows])
+            self._db.execute("COMMIT")
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        return [Job(id=row[0], kind=kind, chat_id=row[1], payload=json.loads(row[2]), attempts=row[3] + 1)
+                for row in rows]
+
+    def _execute(self, query: str, *params: Any) -> None:
+        self._db.execute(query, params)
+
+    async def _run(self, function: Callable, *args: Any) -> Any:
+        async with self._lock:
+            return await asyncio.to_thread(function, *args)
+
+    async def add(self, kind: str, chat_id: int, payload: dict[str, Any]) -> int:
+        return await self._run(self._add, kind, chat_id, json.dumps(payload), time.time())
+
+    async def claim(self, kind: str, limit: int, lease: float) -> list[Job]:
+        return await self._run(self._claim, kind, limit, lease)
+
+    async def complete(self, job_id: int) -> None:
+        await self._run(self._execute, "DELETE FROM jobs WHERE id = ?", job_id)
+
+    async def retry(self, job_id: int, run_at: float, error: str) -> None:
+        await self._run(self._execute, "UPDATE jobs SET run_at = ?, leased_until = 0, error = ? WHERE id = ?",
+                        run_at, error, job_id)
+
+    async def renew(self, job_id: int, lease: float) -> None:
+        await self._run(self._execute, "UPDATE jobs SET leased_until = ? WHERE id = ?", time.time() + lease, job_id)
+
+    async def save(self, job_id: int, payload: dict[str, Any]) -> None:
+        await self._run(self._execute, "UPDATE jobs SET payload = ? WHERE id = ?", json.dumps(payload), job_id)
+
+    async def release(self, job_id: int) -> None:
+        # The job was interrupted, not failed: it is claimable again at once and the attempt does not count
+        await self._run(self._execute, "UPDATE jobs SET leased_until = 0, attempts = attempts - 1 WHERE id = ?",
+                        job_id)
+
+    async def fail(self, job_id: int, error: str) -> None:
+        # Failed jobs are kept for inspection
+        await self._run(self._execute, "UPDATE jobs SET failed = 1, leased_until = 0, error = ? WHERE id = ?",
+                        error, job_id)
+
+    def close(self) -> None:
+        self._db.close()
+
+
+class JobQueue:
+    """
+    This class runs long generations in the background and delivers their results to the chat.
+
+    Handlers enqueue a job and return at once; a worker loop per job kind claims jobs from the backend and runs up
+    to the concurrency of that kind at a time. A failed job is retried with exponential backoff, and after the
+    last attempt the user is told, with the message of a JobError or a text in their language for any other
+    error. Without a backend, enqueueing runs the job right away in the caller, once, which is how the bot behaved
+    before jobs were queued.
+    """
+
+    def __init__(self, backend: Optional[SqliteJobBackend] = None, concurrency: Optional[dict[str, int]] = None,
+                 default_concurrency: int = 4, max_attempts: int = 5, backoff: float = 5.0,
+                 max_backoff: float = 300.0, lease: float = 120.0, poll_interval: float = 0.5,
+                 dispenser: Optional[FluentDispenser] = None):
+        """
+        This method initializes the JobQueue class.
+
+        Args:
+            backend (Optional[SqliteJobBackend]): The persistent queue, or None to run jobs inline.
+            concurrency (Optional[dict[str, int]]): The number of jobs of each kind run at once by one process.
+            default_concurrency (int): The concurrency of kinds missing from ``concurrency``.
+            max_attempts (int): The number of times a job is tried before it is given up.
+            backoff (float): The delay in seconds before the first retry; it doubles with every attempt.
+            max_backoff (float): The longest delay in seconds between two attempts.
+            lease (float): The number of seconds a claimed job is reserved for its worker. The worker renews the
+                lease every third of it while the job runs, so it only bounds how long the job of a dead worker
+                waits before it is claimed again.
+            poll_interval (float): The number of seconds between two looks for jobs enqueued by other processes
+                or due for a retry.
+            dispenser (Optional[FluentDispenser]): The texts the user is told about failed jobs with. Without it,
+                only the messages of JobError are sent.
+        """
+        self.backend = backend
+        self.concurrency = concurrency or {}
+        self.default_concurrency = default_concurrency
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.dispenser = dispenser
+        self._handlers: dict[str, JobHandler] = {}
+        # kind -> module that registers its handler when imported
+        self._modules: dict[str, str] = {}
+        self._workers: list[asyncio.Task] = []
+        self._running: set[asyncio.Task] = set()
+        self._wakeup: dict[str, asyncio.Event] = {}
+        self._stopping = False
+        # kind -> counters since start
+        self._counts: dict[str, dict[str, int]] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.backend is not None
+
+    def job(self, kind: str) -> Callable[[JobHandler], JobHandler]:
+        """
+        This method registers the function that runs the jobs of a kind.
+
+        Args:
+            kind (str): The kind of job, e.g. "image".
+
+        Returns:
+            Callable[[JobHandler], JobHandler]: The decorator.
+        """
+        def register(handler: JobHandler) -> JobHandler:
+            self._handlers[kind] = handler
+            return handler
+        return register
+
+    def lazy(self, kind: str, module: str) -> None:
+        """
+        This method declares the module that registers the handler of a kind, to be imported when the first job of
+        the kind runs.
+
+        Args:
+            kind (str): The kind of job, e.g. "image".
+            module (str): The module, e.g. "bot.handlers.api.image".
+        """
+        self._modules[kind] = module
+
+    def _handler(self, kind: str) -> JobHandler:
+        if kind not in self._handlers and kind in self._modules:
+            importlib.import_module(self._modules[kind])
+        return self._handlers[kind]
+
+    def _count(self, kind: str, name: str) -> None:
+        counts = self._counts.setdefault(kind, {"enqueued": 0, "completed": 0, "retried": 0, "failed": 0})
+        counts[name] += 1
+
+    async def enqueue(self, bot: Bot, kind: str, chat_id: int, payload: dict[str, Any],
+                      language: Optional[str] = None) -> None:
+        """
+        This method queues a job, or runs it right away when there is no backend.
+
+        Args:
+            bot (Bot): The bot, used when the job runs right away.
+            kind (str): The kind of job, registered with ``job``.
+            chat_id (int): The chat the result goes to.
+            payload (dict[str, Any]): The JSON-serializable input of the job.
+            language (Optional[str]): The language code of the user, for the message sent if the job fails.
+        """
+        if language is not None:
+            payload = {**payload, "language": language}
+        self._count(kind, "enqueued")
+        if not self.enabled:
+            await self._execute(bot, Job(id=0, kind=kind, chat_id=chat_id, payload=payload, attempts=1))
+            return
+        await self.backend.add(kind, chat_id, payload)
+        # Workers of this process need not wait for their next poll
+        if kind in self._wakeup:
+            self._wakeup[kind].set()
+
+    async def checkpoint(self, job: Job, **progress: Any) -> None:
+        """
+        This method records the progress of a running job in its payload, so a retry of the job can pick up where
+        the failed attempt left off instead of starting over.
+
+        Args:
+            job (Job): The running job.
+            **progress (Any): The JSON-serializable payload keys to set.
+        """
+        job.payload.update(progress)
+        if self.enabled:
+            await self.backend.save(job.id, job.payload)
+
+    async def _execute(self, bot: Bot, job: Job) -> None:
+        # Upstream requests of the job are scheduled as requests of the user it runs for
+        token = current_user.set(job.chat_id)
+        heartbeat = asyncio.create_task(self._heartbeat(job)) if self.enabled else None
+        try:
+            await self._handler(job.kind)(bot, job)
+        except asyncio.CancelledError:
+            if self.enabled:
+                await self.backend.release(job.id)
+            raise
+        except Exception as e:
+            if not self.enabled and not isinstance(e, JobError):
+                raise
+            await self._failed(bot, job, e)
+        else:
+            if self.enabled:
+                await self.backend.complete(job.id)
+            self._count(job.kind, "completed")
+        finally:
+            if heartbeat is not None:
+                heartbeat.cancel()
+            current_user.reset(token)
+
+    async def _heartbeat(self, job: Job) -> None:
+        # Keeps the job leased while it runs, however long it takes, so no other worker claims it meanwhile
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                await self.backend.renew(job.id, self.lease)
+            except sqlite3.Error:
+                logger.exception("Failed to renew the lease of job %s (%s)", job.id, job.kind)
+
+    async def _failed(self, bot: Bot, job: Job, error: Exception) -> None:
+        if self.enabled and job.attempts < self.max_attempts:
+            delay = min(self.max_backoff, self.backoff * 2 ** (job.attempts - 1))
+            logger.warning("Job %s (%s) failed on attempt %s of %s, retrying in %.0f s: %s",
+                           job.id, job.kind, job.attempts, self.max_attempts, delay, error)
+            await self.backend.retry(job.id, time.time() + delay, str(error))
+            self._count(job.kind, "retried")
+            return
+
+        if self.enabled:
+            logger.error("Job %s (%s) failed after %s attempts: %s", job.id, job.kind, job.attempts, error)
+            await self.backend.fail(job.id, str(error))
+        self._count(job.kind, "failed")
+        text = self._failure_text(job, error)
+        if text is not None:
+            await bot.send_message(chat_id=job.chat_id, text=text)
+
+    def _failure_text(self, job: Job, error: Exception) -> Optional[str]:
+        if isinstance(error, JobError):
+            return str(error)
+        msg_id = next((msg_id for kind, msg_id in FAILURE_MESSAGES.items() if isinstance(error, kind)), None)
+        if msg_id is None:
+            # An unexpected error (a database or a Telegram one) is logged, the user only hears that the job failed
+            logger.error("Job %s (%s) failed with an unexpected error", job.id, job.kind, exc_info=error)
+            msg_id = "text_job_failed"
+        if self.dispenser is None:
+            return None
+        return self.dispenser.get_language(job.payload.get("language")).format_value(msg_id)
+
+    async def _work(self, bot: Bot, kind: str) -> None:
+        limit = self.concurrency.get(kind, self.default_concurrency)
+        running: set[asyncio.Task] = set()
+        wakeup = self._wakeup[kind] = asyncio.Event()
+
+        def finished(task: asyncio.Task) -> None:
+            running.discard(task)
+            self._running.discard(task)
+            wakeup.set()
+            if not task.cancelled() and task.exception() is not None:
+                logger.error("Job of kind %s crashed", kind, exc_info=task.exception())
+
+        while not self._stopping:
+            # Cleared before claiming, so a job enqueued meanwhile still wakes the loop
+            wakeup.clear()
+            free = limit - len(running)
+            jobs = []
+            if free > 0:
+                try:
+                    jobs = await self.backend.claim(kind, free, self.lease)
+                except sqlite3.Error:
+                    logger.exception("Failed to claim jobs of kind %s", kind)
+            for job in jobs:
+                task = asyncio.create_task(self._execute(bot, job))
+                running.add(task)
+                self._running.add(task)
+                task.add_done_callback(finished)
+            try:
+                await asyncio.wait_for(wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def start(self, bot: Bot) -> None:
+        """
+        This method starts a worker loop for every registered kind of job.
+
+        Args:
+            bot (Bot): The bot the results are delivered with.
+        """
+        if not self.enabled or self._workers:
+            return
+        self._stopping = False
+        self._workers = [asyncio.create_task(self._work(bot, kind)) for kind in {*self._handlers, *self._modules}]
+
+    async def stop(self, timeout: float = 30.0) -> None:
+        """
+        This method stops claiming jobs and waits for the running ones. Jobs still running after ``timeout``
+        seconds are interrupted and handed back to the queue.
+
+        Args:
+            timeout (float): The number of seconds running jobs are given to finish.
+        """
+        self._stopping = True
+        for wakeup in self._wakeup.values():
+            wakeup.set()
+        await asyncio.gather(*self._workers)
+        self._workers = []
+        if self._running:
+            _, pending = await asyncio.wait(set(self._running), timeout=timeout)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    def stats(self) -> dict[str, dict[str, int]]:
+        """
+        This method reports what happened to the jobs of this process.
+
+        Returns:
+            dict[str, dict[str, int]]: Per kind, the jobs enqueued, completed, retried and failed since start.
+        """
+        return {kind: dict(counts) for kind, counts in self._counts.items()}
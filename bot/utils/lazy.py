@@ -0,0 +1,113 @@
+import importlib
+import logging
+import time
+from typing import Any, Callable, Iterable, Optional
+
+from aiogram import Router
+from aiogram.fsm.state import StatesGroup
+from aiogram.types import CallbackQuery, Message, TelegramObject
+
+logger = logging.getLogger(__name__)
+
+
+class LazyObject:
+    """
+    This class stands in for an object that is expensive to build, and builds it on first attribute access.
+    """
+
+    def __init__(self, factory: Callable[[], Any]):
+        self._factory = factory
+        self._object = None
+
+    @property
+    def loaded(self) -> bool:
+        return self._object is not None
+
+    def load(self) -> Any:
+        if self._object is None:
+            self._object = self._factory()
+        return self._object
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.load(), name)
+
+
+async def _placeholder(*_: Any) -> None:
+    # Never called, see LazyRouter.__init__
+    pass
+
+
+def _never(*_: Any) -> bool:
+    return False
+
+
+class LazyRouter(Router):
+    """
+    This class is a router that imports the module of its feature on the first update that leads into it.
+
+    The updates that lead into a feature are declared up front: the commands it handles, the callback data of its
+    buttons and its FSM states. Updates matching none of them are passed on without importing anything, so the
+    module (and everything it imports) is loaded only when somebody actually uses the feature.
+    """
+
+    def __init__(self, module: str, attribute: str, commands: Iterable[str] = (), callbacks: Iterable[str] = (),
+                 callback_prefixes: Iterable[str] = (), states: Iterable[type[StatesGroup]] = ()):
+        """
+        This method initializes the LazyRouter class.
+
+        Args:
+            module (str): The module of the feature, e.g. "bot.handlers.api.text".
+            attribute (str): The name of the router in the module.
+            commands (Iterable[str]): The commands of the feature, without the slash.
+            callbacks (Iterable[str]): The callback data of its buttons.
+            callback_prefixes (Iterable[str]): The prefixes of callback data of its buttons, e.g. "gpt-".
+            states (Iterable[type[StatesGroup]]): Its FSM state groups; every update in one of them leads into it.
+        """
+        super().__init__(name=attribute)
+        self.module = module
+        self.attribute = attribute
+        self.commands = frozenset(commands)
+        self.callbacks = frozenset(callbacks)
+        self.callback_prefixes = tuple(callback_prefixes)
+        self.states = tuple(states)
+        self.router: Optional[Router] = None
+
+        observers = [self.message]
+        if self.callbacks or self.callback_prefixes or self.states:
+            observers.append(self.callback_query)
+        for observer in observers:
+            observer.filter(self._enter)
+            # A handler that never matches, so resolve_used_update_types() sees the update types of the feature
+            # before it is loaded
+            observer.register(_placeholder, _never)
+
+    def _leads_in(self, event: TelegramObject, raw_state: Optional[str]) -> bool:
+        if raw_state is not None and any(raw_state in group for group in self.states):
+            return True
+        if isinstance(event, CallbackQuery):
+            data = event.data or ""
+            return data in self.callbacks or data.startswith(self.callback_prefixes)
+        if isinstance(event, Message) and self.commands and event.text and event.text.startswith("/"):
+            return event.text[1:].split(maxsplit=1)[0].split("@", 1)[0] in self.commands
+        return False
+
+    async def _enter(self, event: TelegramObject, raw_state: Optional[str] = None) -> bool:
+        if not self._leads_in(event, raw_state):
+            return False
+        self.load()
+        return True
+
+    def load(self) -> Router:
+        """
+        This method imports the module of the feature and includes its router, if it has not been done yet.
+
+        Returns:
+            Router: The router of the feature.
+        """
+        if self.router is None:
+            started = time.perf_counter()
+            router = getattr(importlib.import_module(self.module), self.attribute)
+            self.include_router(router)
+            self.router = router
+            logger.info("Loaded %s in %.0f ms", self.module, (time.perf_counter() - started) * 1000)
+        return self.router
@@ -0,0 +1,73 @@
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+
+
+class LRUCache:
+    """
+    This class is a least-recently-used cache whose entries expire after a fixed time.
+
+    It is bounded by the number of entries and, optionally, by the total size of the values as reported to put.
+    """
+
+    def __init__(self, max_entries: int, ttl: float, max_size: Optional[int] = None):
+        """
+        This method initializes the LRUCache class.
+
+        Args:
+            max_entries (int): The maximum number of entries.
+            ttl (float): The number of seconds an entry stays valid.
+            max_size (Optional[int]): The maximum total size of all entries, or None for no size limit.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_size = max_size
+        self.size = 0
+        # key -> (value, size, expiry time)
+        self._entries: OrderedDict[str, tuple[Any, int, float]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[tuple[Any, int]]:
+        """
+        This method looks up an entry and marks it as recently used.
+
+        Args:
+            key (str): The key of the entry.
+
+        Returns:
+            Optional[tuple[Any, int]]: The value and its size, or None if the entry is missing or expired.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[2] < time.monotonic():
+            self.discard(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry[0], entry[1]
+
+    def put(self, key: str, value: Any, size: int = 0) -> None:
+        """
+        This method stores an entry and evicts the least recently used ones above the limits.
+
+        Args:
+            key (str): The key of the entry.
+            value (Any): The value to store.
+            size (int): The size of the value, counted against max_size.
+        """
+        self.discard(key)
+        self._entries[key] = (value, size, time.monotonic() + self.ttl)
+        self.size += size
+        while len(self._entries) > self.max_entries or (self.max_size is not None and self.size > self.max_size):
+            _, (_, evicted, _) = self._entries.popitem(last=False)
+            self.size -= evicted
+
+    def discard(self, key: str) -> None:
+        """
+        This method removes an entry if it is present.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
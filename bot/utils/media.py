@@ -0,0 +1,32 @@
+from tempfile import SpooledTemporaryFile
+
+from aiogram import Bot
+
+from bot.config import MEDIA_SPOOL_SIZE
+from bot.utils.tracing import span
+
+
+async def download_media(bot: Bot, file_id: str, max_memory: int = MEDIA_SPOOL_SIZE) -> SpooledTemporaryFile:
+    """
+    This function downloads a Telegram file into memory, spilling it to a temporary file only when it is larger
+    than ``max_memory`` bytes.
+
+    The caller owns the returned buffer and should close it (or use it as a context manager); a spilled temporary
+    file is removed on close, so nothing is left behind on error paths.
+
+    Parameters:
+    bot (Bot): The bot used to download the file.
+    file_id (str): The Telegram id of the file.
+    max_memory (int): The size in bytes above which the file is spooled to disk.
+
+    Returns:
+    SpooledTemporaryFile: The file contents, positioned at the start.
+    """
+    buffer = SpooledTemporaryFile(max_size=max_memory)
+    try:
+        with span("telegram download", "telegram", file_id=file_id):
+            await bot.download(file_id, destination=buffer)
+    except BaseException:
+        buffer.close()
+        raise
+    return buffer
@@ -0,0 +1,98 @@
+import asyncio
+import time
+from typing import Optional
+
+from aiogram import types
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+
+# Telegram refuses messages longer than this many characters
+MESSAGE_LIMIT = 4096
+
+
+class MessageStreamer:
+    """
+    This class shows a growing answer by editing a Telegram message in place.
+
+    Incoming chunks are buffered and merged, so the message is edited at most once per ``interval`` seconds and
+    the bot stays under Telegram's edit rate limits. When the text grows past ``limit`` characters, the current
+    message is finalized and the rest rolls over into a new message.
+    """
+
+    def __init__(self, message: Optional[types.Message], interval: float = 1.0, limit: int = MESSAGE_LIMIT,
+                 chat_message: Optional[types.Message] = None):
+        """
+        This method initializes the MessageStreamer class.
+
+        Args:
+            message (Optional[types.Message]): The placeholder message that is edited with the first part of the
+                answer, None to send the first part as a new message.
+            interval (float): The minimum delay in seconds between two edits of the same message.
+            limit (int): The maximum length of a single message.
+            chat_message (Optional[types.Message]): A message of the chat new messages are sent to, the placeholder
+                when None.
+        """
+        self.message: Optional[types.Message] = message
+        self.interval = interval
+        self.limit = limit
+        self.text = ""
+        self.first_visible: Optional[float] = None
+        self._chat_message = chat_message or message
+        self._shown = None
+        self._next_edit = 0.0
+
+    async def feed(self, chunk: str) -> None:
+        """
+        This method appends a chunk to the answer and flushes it to Telegram if the edit interval has passed.
+
+        Args:
+            chunk (str): The text to append.
+        """
+        self.text += chunk
+        while len(self.text) > self.limit:
+            await self._rollover()
+        if self.text.strip() and time.monotonic() >= self._next_edit:
+            await self._flush(wait=False)
+
+    async def finish(self) -> None:
+        """
+        This method pushes whatever is still buffered, waiting out flood control if necessary.
+        """
+        if self.text.strip():
+            await self._flush(wait=True)
+
+    async def _rollover(self) -> None:
+        # Prefer to split on a line break so a paragraph is not cut in half
+        cut = self.text.rfind("\n", 0, self.limit)
+        if cut < self.limit // 2:
+            cut = self.limit
+        head, self.text = self.text[:cut], self.text[cut:].lstrip("\n")
+        await self._flush(wait=True, text=head)
+        # The next flush sends a new message instead of editing the finalized one
+        self.message = None
+        self._shown = None
+
+    async def _flush(self, wait: bool, text: Optional[str] = None) -> None:
+        text = self.text if text is None else text
+        if text == self._shown:
+            return
+        while True:
+            try:
+                if self.message is None:
+                    self.message = await self._chat_message.answer(text=text)
+                else:
+                    await self.message.edit_text(text=text)
+                break
+            except TelegramRetryAfter as e:
+                if not wait:
+                    # Skip this edit, the next chunk will carry the merged text
+                    self._next_edit = time.monotonic() + e.retry_after
+                    return
+                await asyncio.sleep(e.retry_after)
+            except TelegramBadRequest as e:
+                if "message is not modified" not in e.message:
+                    raise
+                break
+        if self.first_visible is None:
+            self.first_visible = time.monotonic()
+        self._shown = text
+        self._next_edit = time.monotonic() + self.interval
@@ -0,0 +1,291 @@
+import time
+from bisect import bisect_left
+from types import SimpleNamespace
+from typing import Any, AsyncGenerator, AsyncIterator, Callable, Iterable, Optional
+
+import aiohttp
+import httpx
+from aiogram import __version__ as aiogram_version
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiohttp import web
+from aiohttp.hdrs import USER_AGENT
+from aiohttp.http import SERVER_SOFTWARE
+
+from bot.utils.tracing import span
+
+# Latency buckets in seconds, from a fast Telegram call to a slow image generation
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """
+    This class is a Prometheus counter with labels.
+    """
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, labels: tuple[str, ...] = (), amount: float = 1) -> None:
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self) -> Iterable[str]:
+        for labels, value in self.values.items():
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {value}"
+
+
+class Gauge(Counter):
+    """
+    This class is a Prometheus gauge with labels.
+    """
+    kind = "gauge"
+
+    def set(self, labels: tuple[str, ...], value: float) -> None:
+        self.values[labels] = value
+
+
+class Histogram:
+    """
+    This class is a Prometheus histogram with labels.
+
+    Observing a value is a bisect over the bucket bounds and three increments, so it is cheap enough for every
+    update.
+    """
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # labels -> [count per bucket (the last one is +Inf), sum]
+        self.values: dict[tuple[str, ...], list] = {}
+
+    def observe(self, labels: tuple[str, ...], value: float) -> None:
+        series = self.values.get(labels)
+        if series is None:
+            series = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self) -> Iterable[str]:
+        for labels, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, labels)} {total}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}"
+
+
+class StatsGauge:
+    """
+    This class exposes the dict returned by a ``stats()`` method as gauges, read at scrape time.
+
+    Flat stats become one gauge per key; stats nested by e.g. model become one gauge per key labeled with it.
+    """
+    kind = None
+
+    def __init__(self, name: str, documentation: str, source: Callable[[], dict], labelname: Optional[str] = None):
+        self.name = name
+        self.documentation = documentation
+        self.source = source
+        self.labelname = labelname
+
+    def render(self) -> Iterable[str]:
+        stats = self.source()
+        if self.labelname is None:
+            stats = {None: stats}
+        samples: dict[str, list[str]] = {}
+        for label, values in stats.items():
+            labels = _format_labels((self.labelname,), (label,)) if self.labelname else ""
+            for key, value in values.items():
+                samples.setdefault(key, []).append(f"{self.name}_{key}{labels} {value}")
+        for key, lines in samples.items():
+            yield f"# HELP {self.name}_{key} {self.documentation}: {key}"
+            yield f"# TYPE {self.name}_{key} gauge"
+            yield from lines
+
+
+class Registry:
+    """
+    This class holds the metrics of the process and renders them in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            if metric.kind:
+                lines.append(f"# HELP {metric.name} {metric.documentation}")
+                lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+updates_in_flight = registry.add(Gauge("bot_updates_in_flight", "Updates being handled", ("type",)))
+update_errors = registry.add(Counter("bot_update_errors_total", "Updates whose handling raised", ("type",)))
+update_latency = registry.add(Histogram("bot_update_seconds", "Time to handle an update", ("type",)))
+handler_latency = registry.add(Histogram("bot_handler_seconds", "Time spent in a handler", ("router", "handler")))
+openai_latency = registry.add(Histogram("bot_openai_seconds", "Time to the response headers of an OpenAI call",
+                                        ("endpoint", "status")))
+openai_bytes = registry.add(Counter("bot_openai_bytes_total", "Bytes sent to and received from OpenAI",
+                                    ("endpoint", "direction")))
+telegram_latency = registry.add(Histogram("bot_telegram_seconds", "Time of a Telegram Bot API call",
+                                          ("method", "status")))
+telegram_bytes = registry.add(Counter("bot_telegram_bytes_total",
+                                      "Bytes sent to and received from Telegram, file downloads included",
+                                      ("method", "direction")))
+vision_image_bytes = registry.add(Counter("bot_vision_image_bytes_total",
+                                          "Bytes of photos sent to the vision model, and of their largest sizes",
+                                          ("size",)))
+vision_image_tokens = registry.add(Counter("bot_vision_image_tokens_total",
+                                           "Image tokens of photos sent to the vision model, and of their largest "
+                                           "sizes", ("size",)))
+
+
+class _CountingStream(httpx.AsyncByteStream):
+    # A request or response body that counts its bytes as they go through, streamed and chunked ones included
+    def __init__(self, stream: httpx.AsyncByteStream, labels: tuple[str, str]):
+        self._stream = stream
+        self._labels = labels
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        async for chunk in self._stream:
+            openai_bytes.inc(self._labels, len(chunk))
+            yield chunk
+
+    async def aclose(self) -> None:
+        await self._stream.aclose()
+
+
+class MetricsTransport(httpx.AsyncBaseTransport):
+    """
+    This class wraps the transport of the shared OpenAI HTTP client and records latency and bytes of every call.
+
+    Bytes are counted as the bodies are written and read, so a streamed answer counts what was actually received.
+    """
+
+    def __init__(self, transport: httpx.AsyncBaseTransport):
+        self._transport = transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        endpoint = request.url.path.rsplit("/v1/", 1)[-1]
+        started = time.perf_counter()
+        status = "error"
+        request.stream = _CountingStream(request.stream, (endpoint, "sent"))
+        try:
+            # The HTTP request of one attempt, up to the response headers, is a span of a traced update
+            with span(f"{request.method} {endpoint}", "openai") as current:
+                response = await self._transport.handle_async_request(request)
+                status = str(response.status_code)
+                current.set(status=status)
+            response.stream = _CountingStream(response.stream, (endpoint, "received"))
+            return response
+        finally:
+            openai_latency.observe((endpoint, status), time.perf_counter() - started)
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
+
+
+def _telegram_method(url: Any) -> str:
+    # /bot<token>/sendMessage, the token left out
+    return url.path.rsplit("/", 1)[-1]
+
+
+async def _on_telegram_chunk_sent(_: aiohttp.ClientSession, __: SimpleNamespace,
+                                  params: aiohttp.TraceRequestChunkSentParams) -> None:
+    telegram_bytes.inc((_telegram_method(params.url), "sent"), len(params.chunk))
+
+
+async def _on_telegram_chunk_received(_: aiohttp.ClientSession, __: SimpleNamespace,
+                                      params: aiohttp.TraceResponseChunkReceivedParams) -> None:
+    telegram_bytes.inc((_telegram_method(params.url), "received"), len(params.chunk))
+
+
+class MetricsSession(AiohttpSession):
+    """
+    This class is the aiogram session of the bot, counting the bytes of every Bot API call and file download.
+
+    Request middlewares only see the method and the parsed result, so the bytes are counted by aiohttp as the
+    bodies are written and read: with a trace config for the Bot API calls, and chunk by chunk for downloads, which
+    aiohttp does not trace. The connection pool can be tuned with ``connector_options``.
+    """
+
+    def __init__(self, connector_options: Optional[dict[str, Any]] = None, **kwargs: Any):
+        """
+        This method initializes the MetricsSession class.
+
+        Args:
+            connector_options (Optional[dict[str, Any]]): Arguments of the aiohttp connector on top of aiogram's,
+                e.g. ``limit`` or ``ttl_dns_cache``.
+            **kwargs (Any): Arguments of AiohttpSession, e.g. ``api`` or ``json_loads``.
+        """
+        super().__init__(**kwargs)
+        self.connector_options = connector_options or {}
+        self.trace_config = aiohttp.TraceConfig()
+        self.trace_config.on_request_chunk_sent.append(_on_telegram_chunk_sent)
+        self.trace_config.on_response_chunk_received.append(_on_telegram_chunk_received)
+
+    async def create_session(self) -> aiohttp.ClientSession:
+        # AiohttpSession.create_session of aiogram 3.7 with the trace config and connector options added, since it
+        # takes neither; requirements.txt pins aiogram to 3.7.x for the session state this relies on
+        if self._should_reset_connector:
+            await self.close()
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=self._connector_type(**{**self._connector_init, **self.connector_options}),
+                headers={USER_AGENT: f"{SERVER_SOFTWARE} aiogram/{aiogram_version}"},
+                trace_configs=[self.trace_config],
+            )
+            self._should_reset_connector = False
+        return self._session
+
+    async def stream_content(self, url: str, headers: Optional[dict[str, Any]] = None, timeout: int = 30,
+                             chunk_size: int = 65536, raise_for_status: bool = True) -> AsyncGenerator[bytes, None]:
+        async for chunk in super().stream_content(url, headers, timeout, chunk_size, raise_for_status):
+            telegram_bytes.inc(("download", "received"), len(chunk))
+            yield chunk
+
+
+async def start_metrics_server(host: str, port: int) -> web.AppRunner:
+    """
+    This function serves the metrics of the process on http://host:port/metrics.
+
+    Parameters:
+    host (str): The host to bind to.
+    port (int): The port to bind to.
+
+    Returns:
+    web.AppRunner: The runner, to be cleaned up on shutdown.
+    """
+    async def metrics(_: web.Request) -> web.Response:
+        return web.Response(text=registry.render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -0,0 +1,404 @@
+import asyncio
+import contextlib
+import contextvars
+import logging
+import time
+from collections import OrderedDict, deque
+from typing import Any, Iterator, Optional, Union
+
+from aiogram import Bot, types
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest, TelegramRetryAfter
+from aiogram.methods import TelegramMethod
+from aiogram.methods.base import Response, TelegramType
+
+from bot.utils.rate_limiter import RateLimit
+
+logger = logging.getLogger(__name__)
+
+# Priorities of outbound calls, the lowest goes first
+HIGH, NORMAL, LOW = 0, 1, 2
+
+# The Bot API methods that post to a chat, with their default priority; other methods are not scheduled
+PRIORITIES = {
+    "sendMessage": HIGH,
+    "sendPhoto": HIGH,
+    "sendVoice": HIGH,
+    "sendAudio": HIGH,
+    "sendDocument": HIGH,
+    "sendVideo": HIGH,
+    "sendAnimation": HIGH,
+    "sendSticker": HIGH,
+    "sendMediaGroup": HIGH,
+    "copyMessage": HIGH,
+    "forwardMessage": HIGH,
+    "editMessageText": NORMAL,
+    "editMessageCaption": NORMAL,
+    "editMessageMedia": NORMAL,
+    "editMessageReplyMarkup": NORMAL,
+    "sendChatAction": LOW,
+    "deleteMessage": LOW,
+}
+# Calls that are skipped when they waited longer than drop_after; a chat action is stale after 5 seconds anyway
+DROPPABLE = {"sendChatAction"}
+# Edits that replace what the message shows, so a queued one is made useless by a newer one of the same message
+MERGEABLE = {"editMessageText", "editMessageCaption", "editMessageMedia", "editMessageReplyMarkup"}
+
+# The turn of a call that was skipped
+DROPPED = object()
+
+# Priority of the calls made in the current context, overriding the default of their method
+_priority: contextvars.ContextVar[Optional[int]] = contextvars.ContextVar("outbound_priority", default=None)
+
+
+@contextlib.contextmanager
+def outbound_priority(priority: int) -> Iterator[None]:
+    """
+    This function makes the Telegram calls made inside the ``with`` block go out with the given priority, e.g. LOW
+    for a "wait" message that must not hold up answers to other users.
+    """
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class _Send:
+    __slots__ = ("priority", "chat_id", "method", "enqueued", "turn", "followers")
+
+    def __init__(self, priority: int, chat_id: Union[int, str], method: str):
+        self.priority = priority
+        self.chat_id = chat_id
+        self.method = method
+        self.enqueued = time.monotonic()
+        # Set by the pump: None to go, DROPPED, or the future of the newer call this one was merged into
+        self.turn: asyncio.Future = asyncio.get_running_loop().create_future()
+        # Callers of the older calls merged into this one, waiting for its response
+        self.followers: list[asyncio.Future] = []
+
+    def finish(self, response: Optional[Response] = None, error: Optional[BaseException] = None) -> None:
+        for follower in self.followers:
+            if follower.done():
+                continue
+            if isinstance(error, asyncio.CancelledError):
+                follower.cancel()
+            elif error is not None:
+                follower.set_exception(error)
+            else:
+                follower.set_result(response)
+
+
+class OutboundScheduler(BaseRequestMiddleware):
+    """
+    This class is a Bot session middleware that keeps the messages of the bot under Telegram's flood limits, so the
+    bot waits for its turn instead of getting TelegramRetryAfter errors.
+
+    The limits are sliding windows, as Telegram words them: at most ``limit`` messages in any ``period`` seconds, in
+    total and per chat.
+    Calls that have to wait are released by priority: answers (HIGH) before edits (NORMAL) before deletes and chat
+    actions (LOW), and a chat that is out of tokens does not hold up the others. A queued edit is merged into a
+    newer edit of the same message, a chat action that waited too long is dropped, and a call refused with
+    TelegramRetryAfter is queued again once the chat may be written to.
+    """
+
+    def __init__(self, global_limit: RateLimit = RateLimit(limit=30, period=1),
+                 chat_limit: RateLimit = RateLimit(limit=3, period=3),
+                 group_limit: RateLimit = RateLimit(limit=20, period=60),
+                 drop_after: float = 5.0, max_retries: int = 3, idle_after: float = 3600):
+        """
+        This method initializes the OutboundScheduler class.
+
+        Args:
+            global_limit (RateLimit): The messages the bot may send in total in a period.
+            chat_limit (RateLimit): The messages the bot may send to one private chat in a period.
+            group_limit (RateLimit): The messages the bot may send to one group (a chat with a negative id) in a
+                period.
+            drop_after (float): The seconds after which a queued droppable call (see DROPPABLE) is skipped.
+            max_retries (int): The times a call refused with TelegramRetryAfter is made again.
+            idle_after (float): The seconds after which the bucket of an idle chat is dropped.
+        """
+        self.global_limit = global_limit
+        self.chat_limit = chat_limit
+        self.group_limit = group_limit
+        self.drop_after = drop_after
+        self.max_retries = max_retries
+        self.idle_after = max(idle_after, chat_limit.period, group_limit.period)
+        # [times of the messages answered in the last period, messages on their way] for the whole bot
+        self._global = [deque(), 0]
+        # chat id -> the same for the chat, followed by the time it is blocked until and the time of its last use,
+        # least recently used first
+        self._chats: OrderedDict[Union[int, str], list] = OrderedDict()
+        # One FIFO list of waiting calls per priority
+        self._queues: list[list[_Send]] = [[], [], []]
+        # (method, chat id, message id) -> the queued edit of that message
+        self._edits: dict[tuple, _Send] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._pump_task: Optional[asyncio.Task] = None
+        self.counts = {"sent": 0, "queued": 0, "merged": 0, "dropped": 0, "retried": 0}
+        self.wait_total = 0.0
+
+    def _limit(self, chat_id: Union[int, str]) -> RateLimit:
+        return self.group_limit if isinstance(chat_id, int) and chat_id < 0 else self.chat_limit
+
+    def _chat(self, chat_id: Union[int, str], now: float) -> list:
+        window = self._chats.pop(chat_id, None)
+        if window is None:
+            window = [deque(), 0, 0.0, now]
+        window[3] = now
+        self._chats[chat_id] = window
+        # The least recently used window is always first, so this stops at the first active one
+        while self._chats:
+            idle_id, idle = next(iter(self._chats.items()))
+            if now - idle[3] < self.idle_after:
+                break
+            del self._chats[idle_id]
+        return window
+
+    @staticmethod
+    def _window_wait(window: list, limit: RateLimit, now: float) -> float:
+        # The seconds until the window has room for one more message
+        times = window[0]
+        while times and now - times[0] >= limit.period:
+            times.popleft()
+        if len(times) + window[1] < limit.limit:
+            return 0.0
+        # With every message of the window still on its way, the first one to be answered makes room
+        return times[0] + limit.period - now if times else limit.period
+
+    def _take(self, chat_id: Union[int, str]) -> float:
+        # Counts a message to the chat as on its way and returns 0, or returns the seconds until the chat may get one
+        now = time.monotonic()
+        window = self._chat(chat_id, now)
+        wait = max(window[2] - now, self._window_wait(window, self._limit(chat_id), now),
+                   self._window_wait(self._global, self.global_limit, now))
+        if wait > 0:
+            return wait
+        window[1] += 1
+        self._global[1] += 1
+        return 0.0
+
+    def _done(self, chat_id: Union[int, str]) -> None:
+        # A message counts from when Telegram answered it: it reached Telegram at some point before, and counting
+        # from the send instead would let the next window overlap it when the calls take different times
+        now = time.monotonic()
+        for window in (self._chat(chat_id, now), self._global):
+            window[0].append(now)
+            window[1] -= 1
+        if self._wakeup is not None and any(self._queues):
+            self._wakeup.set()
+
+    async def __call__(
+            self,
+            make_request: NextRequestMiddlewareType[TelegramType],
+            bot: Bot,
+            method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        name = method.__api_method__
+        chat_id = getattr(method, "chat_id", None)
+        priority = PRIORITIES.get(name)
+        if priority is None or chat_id is None:
+            return await make_request(bot, method)
+        override = _priority.get()
+        priority = priority if override is None else override
+
+        retries = 0
+        followers = []
+        while True:
+            send = _Send(priority, chat_id, name)
+            # Callers merged into a call refused by flood control wait for it to be made again
+            send.followers = followers
+            turn = await self._wait_turn(send, method)
+            if turn is DROPPED:
+                return Response[bool](ok=True, result=True)
+            if turn is not None:
+                # A newer edit of the same message was sent instead, its response is this call's too
+                return await turn
+            try:
+                response = await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                self._done(chat_id)
+                # No more messages to this chat until Telegram allows them again
+                self._chat(chat_id, time.monotonic())[2] = time.monotonic() + e.retry_after
+                if retries >= self.max_retries:
+                    send.finish(error=e)
+                    raise
+                retries += 1
+                self.counts["retried"] += 1
+                logger.info("Flood control on %s in chat %s, retrying in %s s", name, chat_id, e.retry_after)
+                followers = send.followers
+                continue
+            except BaseException as e:
+                self._done(chat_id)
+                send.finish(error=e)
+                raise
+            self._done(chat_id)
+            send.finish(response)
+            return response
+
+    async def _wait_turn(self, send: _Send, method: TelegramMethod) -> Any:
+        # Fast path: nothing is waiting and both windows have room
+        if not any(self._queues) and not self._take(send.chat_id):
+            self.counts["sent"] += 1
+            return None
+        self.counts["queued"] += 1
+        key = None
+        if send.method in MERGEABLE and getattr(method, "message_id", None) is not None:
+            key = (send.method, send.chat_id, method.message_id)
+            older = self._edits.get(key)
+            if older is not None and not older.turn.done():
+                # The older edit is replaced by this one, its caller gets this one's response
+                self._queues[older.priority].remove(older)
+                follower = asyncio.get_running_loop().create_future()
+                send.followers = [*older.followers, follower]
+                older.followers = []
+                older.turn.set_result(follower)
+                self.counts["merged"] += 1
+            self._edits[key] = send
+        self._queues[send.priority].append(send)
+        self._start_pump()
+        try:
+            return await send.turn
+        except asyncio.CancelledError as e:
+            if send.turn.cancelled():
+                # Cancelled while waiting: the turn future is cancelled along with the caller
+                self._queues[send.priority].remove(send)
+                send.finish(error=e)
+            elif send.turn.result() is None:
+                # Released at the same time, the message is never sent but counts as one
+                self._done(send.chat_id)
+            raise
+        finally:
+            if key is not None and self._edits.get(key) is send:
+                del self._edits[key]
+            self.wait_total += time.monotonic() - send.enqueued
+
+    def _start_pump(self) -> None:
+        if self._pump_task is None or self._pump_task.done():
+            self._wakeup = asyncio.Event()
+            self._pump_task = asyncio.create_task(self._pump())
+        else:
+            self._wakeup.set()
+
+    async def _pump(self) -> None:
+        # Releases waiting calls as the windows make room, until none is left
+        while any(self._queues):
+            wait = self._release()
+            if wait is None:
+                continue
+            self._wakeup.clear()
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wakeup.wait(), wait)
+
+    def _release(self) -> Optional[float]:
+        # Releases the first call that may go and returns None, or returns the seconds until one may
+        now = time.monotonic()
+        if global_wait := self._window_wait(self._global, self.global_limit, now):
+            # No chat may get a message before the whole bot may
+            return global_wait
+        soonest = None
+        tried = set()
+        for queue in self._queues:
+            for index, send in enumerate(queue):
+                if send.method in DROPPABLE and now - send.enqueued > self.drop_after:
+                    del queue[index]
+                    send.turn.set_result(DROPPED)
+                    self.counts["dropped"] += 1
+                    return None
+                if send.chat_id in tried:
+                    # An earlier call of this chat goes first
+                    continue
+                tried.add(send.chat_id)
+                wait = self._take(send.chat_id)
+                if not wait:
+                    del queue[index]
+                    send.turn.set_result(None)
+                    self.counts["sent"] += 1
+                    return None
+                soonest = wait if soonest is None else min(soonest, wait)
+        return soonest
+
+    def stats(self) -> dict[str, float]:
+        """
+        This method reports how many calls were sent, queued, merged, dropped and retried.
+
+        Returns:
+            dict[str, float]: The counts, the calls waiting now, the chats tracked and the average wait of a
+            queued call in seconds.
+        """
+        return {
+            **self.counts,
+            "waiting": sum(map(len, self._queues)),
+            "chats": len(self._chats),
+            "wait_avg": self.wait_total / self.counts["queued"] if self.counts["queued"] else 0.0,
+        }
+
+
+class Placeholder:
+    """
+    This class sends a "wait" message only if the answer takes longer than ``delay`` seconds, so an instant answer
+    costs no send and delete of a message nobody got to read.
+
+    It is used as an async context manager around the work the user waits for. The message goes out with LOW
+    priority. take() gives the placeholder to the caller (e.g. to edit it into the answer), or None if it was never
+    sent; delete() removes it, or makes sure it is never sent. A placeholder neither taken nor deleted when the block
+    exits, e.g. because the handler raised, is deleted then.
+    """
+
+    def __init__(self, message: types.Message, text: str, delay: float = 0.0):
+        """
+        This method initializes the Placeholder class.
+
+        Args:
+            message (types.Message): The message of the user, the placeholder is sent to its chat.
+            text (str): The text of the placeholder.
+            delay (float): The seconds after which the placeholder is sent, 0 to send it at once.
+        """
+        self._message = message
+        self._text = text
+        self._delay = delay
+        self._sending = False
+        self._taken = False
+        self._task: Optional[asyncio.Future] = None
+
+    async def __aenter__(self) -> "Placeholder":
+        self._task = asyncio.ensure_future(self._send(self._message, self._text, self._delay))
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        if not self._taken:
+            await self.delete()
+
+    async def _send(self, message: types.Message, text: str, delay: float) -> types.Message:
+        if delay > 0:
+            await asyncio.sleep(delay)
+        # Once the call is made it cannot be taken back, only deleted
+        self._sending = True
+        with outbound_priority(LOW):
+            return await message.answer(text=text)
+
+    async def take(self) -> Optional[types.Message]:
+        """
+        This method returns the placeholder if it was sent (waiting for it if it is being sent), and makes sure it
+        is never sent otherwise.
+
+        Returns:
+            Optional[types.Message]: The placeholder, or None.
+        """
+        self._taken = True
+        if not self._sending:
+            self._task.cancel()
+            return None
+        try:
+            return await self._task
+        except TelegramAPIError:
+            return None
+
+    async def delete(self) -> None:
+        """
+        This method deletes the placeholder if it was sent, and makes sure it is never sent otherwise.
+        """
+        message = await self.take()
+        if message is not None:
+            with contextlib.suppress(TelegramBadRequest):
+                await message.delete()
@@ -0,0 +1,88 @@
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Hashable, Optional
+
+
+@dataclass(frozen=True)
+class RateLimit:
+    """
+    This class describes a token bucket: ``limit`` requests per ``period`` seconds, all of which may come at once.
+    """
+    limit: int
+    period: float
+
+    @property
+    def rate(self) -> float:
+        return self.limit / self.period
+
+
+class RateLimiter:
+    """
+    This class keeps a token bucket for every active (user, feature) pair.
+
+    A bucket is two numbers, and buckets untouched for ``idle_after`` seconds are evicted (they would be full again
+    anyway), so memory stays proportional to the number of active users.
+    """
+
+    def __init__(self, limits: dict[str, RateLimit], idle_after: float = 3600):
+        """
+        This method initializes the RateLimiter class.
+
+        Args:
+            limits (dict[str, RateLimit]): The limit of each feature. Features without a limit are not throttled.
+            idle_after (float): The number of seconds after which the bucket of an idle user is dropped.
+        """
+        self.limits = limits
+        self.idle_after = max([idle_after, *(limit.period for limit in limits.values())])
+        # (user id, feature) -> [tokens, last update time, rejection reported]
+        self._buckets: OrderedDict[tuple[Hashable, str], list] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def hit(self, user_id: Hashable, feature: str) -> tuple[bool, Optional[float]]:
+        """
+        This method takes a token from the bucket of the user for a feature.
+
+        Args:
+            user_id (Hashable): The user.
+            feature (str): The feature the user is using. A part of a feature, e.g. "callback:image", has a bucket
+                of its own, limited by its own entry of the limits or else by the one of the feature ("callback").
+
+        Returns:
+            tuple[bool, Optional[float]]: Whether the request is allowed, and for a rejected request the number of
+            seconds until the next token, or None if the user was already told about the limit.
+        """
+        limit = self.limits.get(feature) or self.limits.get(feature.split(":", 1)[0])
+        if limit is None:
+            return True, None
+
+        now = time.monotonic()
+        self._evict(now)
+        key = (user_id, feature)
+        bucket = self._buckets.pop(key, None)
+        if bucket is None:
+            bucket = [float(limit.limit), now, False]
+        else:
+            bucket[0] = min(limit.limit, bucket[0] + (now - bucket[1]) * limit.rate)
+            bucket[1] = now
+        self._buckets[key] = bucket
+
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            bucket[2] = False
+            return True, None
+        retry_after = (1 - bucket[0]) / limit.rate
+        if bucket[2]:
+            return False, None
+        bucket[2] = True
+        return False, retry_after
+
+    def _evict(self, now: float) -> None:
+        # The least recently used bucket is always first, so this stops at the first active one
+        while self._buckets:
+            key, bucket = next(iter(self._buckets.items()))
+            if now - bucket[1] < self.idle_after:
+                break
+            del self._buckets[key]
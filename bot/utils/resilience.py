@@ -0,0 +1,339 @@
+import asyncio
+import logging
+import random
+import time
+from typing import Any, AsyncIterable, AsyncIterator, Awaitable, Callable, Optional, TypeVar
+
+from bot.utils.tracing import span
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Circuit breaker states, as reported in the stats
+CLOSED, HALF_OPEN, OPEN = 0, 1, 2
+
+
+class UpstreamUnavailable(Exception):
+    """
+    This exception is raised instead of calling OpenAI when the circuit of the model is open, or when a call ran out
+    of time. Its message is meant for the user.
+    """
+
+
+def is_retryable(error: BaseException) -> bool:
+    """
+    This function tells whether a failed OpenAI call may succeed when made again: timeouts, connection errors, rate
+    limits and server errors. Errors of the request itself (bad input, authentication) are not.
+    """
+    if isinstance(error, asyncio.TimeoutError):
+        return True
+    import openai
+
+    if isinstance(error, (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and (error.status_code == 408 or error.status_code >= 500)
+
+
+def _is_rate_limited(error: BaseException) -> bool:
+    # A 429 says the account is over its limits, not that the model is down
+    return getattr(error, "status_code", None) == 429
+
+
+def _retry_after(error: BaseException) -> Optional[float]:
+    # The delay a rate limited response asks for, if any
+    response = getattr(error, "response", None)
+    try:
+        return float(response.headers["retry-after"])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+
+
+async def _close(result: Any) -> None:
+    close = getattr(result, "close", None)
+    if close is not None:
+        closed = close()
+        if asyncio.iscoroutine(closed):
+            await closed
+
+
+class RetryBudget:
+    """
+    This class limits retries to a share of the requests, so retries cannot multiply the load on an upstream that is
+    already failing.
+
+    Every request deposits ``ratio`` of a token and every retry (or hedge) withdraws a whole one. On top of that the
+    budget refills by ``min_per_second`` tokens a second, so a quiet bot can still retry now and then.
+    """
+
+    def __init__(self, ratio: float = 0.1, min_per_second: float = 0.5, max_tokens: float = 20.0):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self._updated = time.monotonic()
+
+    def _refill(self, amount: float = 0.0) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.max_tokens, self.tokens + amount + (now - self._updated) * self.min_per_second)
+        self._updated = now
+
+    def deposit(self) -> None:
+        self._refill(self.ratio)
+
+    def withdraw(self) -> bool:
+        self._refill()
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class CircuitBreaker:
+    """
+    This class stops calls to a model that keeps failing, so users get an answer at once instead of waiting for
+    the same failure.
+
+    After ``failure_threshold`` failures in a row the circuit opens and calls are refused for ``reset_timeout``
+    seconds. Then one call is let through as a probe: its success closes the circuit, its failure opens it again.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        # When the circuit opened, or when the last probe was let through
+        self._since = 0.0
+
+    def retry_in(self) -> float:
+        """
+        This method returns how many seconds a call has to wait before it is let through, 0 if it may go now.
+        """
+        if self.state == CLOSED:
+            return 0.0
+        remaining = self._since + self.reset_timeout - time.monotonic()
+        if remaining > 0:
+            # Open, or the probe is still running
+            return remaining
+        # Let one probe through; another one goes if it never reports back (e.g. it was cancelled)
+        self.state = HALF_OPEN
+        self._since = time.monotonic()
+        return 0.0
+
+    def success(self) -> None:
+        self.state = CLOSED
+        self.failures = 0
+
+    def failure(self) -> None:
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != OPEN:
+                logger.warning("Circuit opened after %s failures", self.failures)
+            self.state = OPEN
+            self._since = time.monotonic()
+
+
+class _ModelGuard:
+    def __init__(self, resilience: "Resilience"):
+        self.breaker = CircuitBreaker(resilience.failure_threshold, resilience.reset_timeout)
+        self.budget = RetryBudget(resilience.retry_ratio, resilience.retry_min_per_second)
+        self.counts = {"calls": 0, "retries": 0, "hedges": 0, "hedges_won": 0, "rejected": 0, "budget_exhausted": 0}
+
+
+class Resilience:
+    """
+    This class makes the OpenAI calls of every handler survive slow and failing upstream requests.
+
+    A call is retried on errors that may pass (see is_retryable) with jittered exponential backoff, as long as the
+    deadline of the call leaves room and the retry budget of the model allows. A model that keeps failing gets its
+    circuit opened; rate limited calls back off as OpenAI asks and do not count against the circuit. When a hedge
+    delay is set for a model, a call still running after it is raced against a second, identical call and the first
+    to succeed wins. The body of a streamed answer is read through ``stream``, which gives up on a stream that stalls.
+    """
+
+    def __init__(self, max_attempts: int = 3, deadline: float = 180.0, attempt_timeout: float = 90.0,
+                 backoff: float = 0.5, max_backoff: float = 10.0, retry_ratio: float = 0.1,
+                 retry_min_per_second: float = 0.5, failure_threshold: int = 5, reset_timeout: float = 30.0,
+                 hedge_after: Optional[dict[str, float]] = None, stream_idle_timeout: float = 60.0):
+        """
+        This method initializes the Resilience class.
+
+        Args:
+            max_attempts (int): The most attempts of a call, the first one included.
+            deadline (float): The seconds a call may take in total, retries and backoff included.
+            attempt_timeout (float): The seconds a single attempt may take.
+            backoff (float): The base delay in seconds before the first retry, doubled for every next one.
+            max_backoff (float): The longest delay in seconds before a retry.
+            retry_ratio (float): The retries allowed per call, on average (see RetryBudget).
+            retry_min_per_second (float): The retries allowed per second whatever the number of calls.
+            failure_threshold (int): The failures in a row that open the circuit of a model.
+            reset_timeout (float): The seconds an open circuit refuses calls.
+            hedge_after (Optional[dict[str, float]]): Per model, the seconds after which a second call is raced
+                against a slow one. Models without an entry are not hedged.
+            stream_idle_timeout (float): The seconds a streamed answer may go without a chunk.
+        """
+        self.max_attempts = max_attempts
+        self.deadline = deadline
+        self.attempt_timeout = attempt_timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retry_ratio = retry_ratio
+        self.retry_min_per_second = retry_min_per_second
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.hedge_after = hedge_after or {}
+        self.stream_idle_timeout = stream_idle_timeout
+        self._guards: dict[str, _ModelGuard] = {}
+
+    def _guard(self, model: str) -> _ModelGuard:
+        guard = self._guards.get(model)
+        if guard is None:
+            guard = self._guards[model] = _ModelGuard(self)
+        return guard
+
+    async def call(self, model: str, factory: Callable[[], Awaitable[T]], deadline: Optional[float] = None) -> T:
+        """
+        This method makes an OpenAI call with retries, hedging and the circuit breaker of its model.
+
+        Args:
+            model (str): The model called, whose circuit and retry budget apply.
+            factory (Callable[[], Awaitable[T]]): Makes one attempt of the call; called again for every retry and
+                hedge.
+            deadline (Optional[float]): The seconds the call may take in total, the default deadline when None.
+
+        Returns:
+            T: The result of the first attempt that succeeded.
+
+        Raises:
+            UpstreamUnavailable: The circuit of the model is open, or the call ran out of time.
+            Exception: The error of the last attempt, when it cannot be retried.
+        """
+        # The whole call, retries and waits included, is a span of a traced update; its attempts are nested in it
+        with span(f"openai {model}", "openai"):
+            return await self._call(model, factory, deadline)
+
+    async def _call(self, model: str, factory: Callable[[], Awaitable[T]], deadline: Optional[float]) -> T:
+        guard = self._guard(model)
+        guard.counts["calls"] += 1
+        retry_in = guard.breaker.retry_in()
+        if retry_in:
+            guard.counts["rejected"] += 1
+            raise UpstreamUnavailable(f"{model} is unavailable right now, please try again in {retry_in:.0f} s")
+        guard.budget.deposit()
+
+        ends_at = time.monotonic() + (self.deadline if deadline is None else deadline)
+        attempt = 1
+        while True:
+            remaining = ends_at - time.monotonic()
+            try:
+                result = await self._attempt(model, guard, factory, min(self.attempt_timeout, remaining))
+            except Exception as e:
+                if not is_retryable(e):
+                    if getattr(e, "status_code", None) is not None:
+                        # OpenAI answered, only the request was wrong
+                        guard.breaker.success()
+                    raise
+                if not _is_rate_limited(e):
+                    guard.breaker.failure()
+                delay = _retry_after(e) or random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+                give_up = attempt >= self.max_attempts or guard.breaker.state == OPEN or \
+                    time.monotonic() + delay >= ends_at
+                if not give_up and not guard.budget.withdraw():
+                    guard.counts["budget_exhausted"] += 1
+                    give_up = True
+                if give_up:
+                    if isinstance(e, asyncio.TimeoutError):
+                        raise UpstreamUnavailable(f"{model} did not answer in time, please try again later") from e
+                    raise
+                guard.counts["retries"] += 1
+                logger.info("Retrying a %s call in %.1f s after %s (attempt %s)", model, delay, type(e).__name__,
+                            attempt + 1)
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            guard.breaker.success()
+            return result
+
+    async def stream(self, model: str, stream: AsyncIterable[T]) -> AsyncIterator[T]:
+        """
+        This method yields the chunks of a streamed answer, giving up when the next one takes longer than
+        ``stream_idle_timeout``. The attempt timeout of ``call`` ends when the stream opens, so without this a stream
+        that stalls after its first bytes would hold its slot forever.
+
+        Args:
+            model (str): The model streaming, whose circuit a stalled stream counts against.
+            stream (AsyncIterable[T]): The stream returned by the call.
+
+        Yields:
+            T: The chunks of the stream.
+
+        Raises:
+            UpstreamUnavailable: The stream stalled. It is closed.
+        """
+        iterator = stream.__aiter__()
+        try:
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(iterator.__anext__(), self.stream_idle_timeout)
+                except StopAsyncIteration:
+                    return
+                except asyncio.TimeoutError as e:
+                    self._guard(model).breaker.failure()
+                    raise UpstreamUnavailable(f"{model} stopped answering, please try again later") from e
+                yield chunk
+        finally:
+            await _close(stream)
+
+    async def _attempt(self, model: str, guard: _ModelGuard, factory: Callable[[], Awaitable[T]],
+                       timeout: float) -> T:
+        hedge_after = self.hedge_after.get(model)
+        if hedge_after is None or hedge_after >= timeout:
+            return await asyncio.wait_for(factory(), timeout)
+        return await asyncio.wait_for(self._race(guard, factory, hedge_after), timeout)
+
+    async def _race(self, guard: _ModelGuard, factory: Callable[[], Awaitable[T]], hedge_after: float) -> T:
+        tasks = [asyncio.ensure_future(factory())]
+        winner = None
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+            # The hedge is a retry made early, so it is paid from the same budget
+            if not done and guard.budget.withdraw():
+                guard.counts["hedges"] += 1
+                tasks.append(asyncio.ensure_future(factory()))
+            pending = set(tasks)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        winner = winner or task
+                    else:
+                        error = error or task.exception()
+                if winner is not None:
+                    if winner is not tasks[0]:
+                        guard.counts["hedges_won"] += 1
+                    return winner.result()
+            raise error
+        finally:
+            for task in tasks:
+                if task is winner:
+                    continue
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled() and task.exception() is None:
+                    # A call that lost the race may still hold a connection, e.g. an open stream
+                    await _close(task.result())
+
+    def stats(self) -> dict[str, dict[str, float]]:
+        """
+        This method reports the calls, retries, hedges and circuit state of every model.
+
+        Returns:
+            dict[str, dict[str, float]]: Per model, the counts, the circuit state (0 closed, 1 half open, 2 open) and
+            the retry tokens left.
+        """
+        return {
+            model: {**guard.counts, "circuit": guard.breaker.state, "retry_tokens": round(guard.budget.tokens, 2)}
+            for model, guard in self._guards.items()
+        }
@@ -0,0 +1,152 @@
+import asyncio
+import json
+import logging
+from typing import Any, Optional
+
+import httpx
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import PRODUCTION, TelegramAPIServer
+
+from bot.utils.metrics import MetricsSession
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+logger = logging.getLogger(__name__)
+
+
+def _orjson_dumps(value: Any) -> str:
+    try:
+        return orjson.dumps(value).decode()
+    except TypeError:
+        # orjson refuses what the standard library takes, e.g. integers over 64 bits or keys that are not strings
+        return json.dumps(value)
+
+
+def _orjson_dumps_bytes(value: Any) -> bytes:
+    try:
+        return orjson.dumps(value)
+    except TypeError:
+        return json.dumps(value).encode()
+
+
+class _FastJsonResponse(httpx.Response):
+    # An OpenAI response whose JSON body is parsed by orjson
+    def json(self, **kwargs: Any) -> Any:
+        if kwargs:
+            return super().json(**kwargs)
+        return orjson.loads(self.content)
+
+
+class _FastJsonTransport(httpx.AsyncBaseTransport):
+    # Hands the OpenAI client responses that parse their JSON with orjson
+    def __init__(self, transport: httpx.AsyncBaseTransport):
+        self._transport = transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        response = await self._transport.handle_async_request(request)
+        return _FastJsonResponse(status_code=response.status_code, headers=response.headers, stream=response.stream,
+                                 extensions=response.extensions, request=request)
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
+
+
+class _FastJsonClient(httpx.AsyncClient):
+    # Serializes the JSON bodies of OpenAI requests with orjson, e.g. the megabytes of base64 of a vision photo
+    def build_request(self, method: str, url: Any, *, json: Any = None, headers: Any = None,
+                      **kwargs: Any) -> httpx.Request:
+        if json is None or kwargs.get("content") is not None or kwargs.get("data") or kwargs.get("files"):
+            return super().build_request(method, url, json=json, headers=headers, **kwargs)
+        headers = httpx.Headers(headers)
+        headers.setdefault("Content-Type", "application/json")
+        return super().build_request(method, url, content=_orjson_dumps_bytes(json), headers=headers, **kwargs)
+
+
+class Runtime:
+    """
+    This class sets up what the bot runs on: the event loop, the JSON (de)serialization of Telegram and OpenAI
+    payloads and the HTTP sessions, for the "default" or the "fast" profile.
+
+    The default profile is the plain asyncio loop, the standard json module and aiogram's default session. The fast
+    profile runs on uvloop, parses and serializes payloads with orjson, and gives the Telegram session a larger
+    DNS cache and longer keep-alive. Each of uvloop and orjson is used only when it is installed; without it the
+    fast profile falls back to the default for that part, with a warning.
+    """
+
+    def __init__(self, profile: str = "default", telegram_connections: int = 100, dns_cache_ttl: float = 300,
+                 keepalive_timeout: float = 60):
+        """
+        This method initializes the Runtime class.
+
+        Args:
+            profile (str): "default" or "fast".
+            telegram_connections (int): The most connections the Telegram session opens, in the fast profile.
+            dns_cache_ttl (float): The seconds resolved Telegram addresses are kept, in the fast profile.
+            keepalive_timeout (float): The seconds an idle Telegram connection is kept open, in the fast profile.
+        """
+        if profile not in ("default", "fast"):
+            raise ValueError(f"Unknown runtime profile {profile!r}, expected default or fast")
+        self.profile = profile
+        self.telegram_connections = telegram_connections
+        self.dns_cache_ttl = dns_cache_ttl
+        self.keepalive_timeout = keepalive_timeout
+        fast = profile == "fast"
+        self.uvloop = fast and uvloop is not None
+        self.orjson = fast and orjson is not None
+        self.json_loads = orjson.loads if self.orjson else json.loads
+        self.json_dumps = _orjson_dumps if self.orjson else json.dumps
+
+    def install(self) -> None:
+        """
+        This method makes the event loops created from now on (asyncio.run, aiohttp's run_app) those of the profile.
+        It is called once by every process, before its loop starts.
+        """
+        if self.profile != "fast":
+            return
+        missing = [name for name, module in (("uvloop", uvloop), ("orjson", orjson)) if module is None]
+        if missing:
+            logger.warning("Fast runtime profile without %s, using the defaults instead", " and ".join(missing))
+        if self.uvloop:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+    def telegram_session(self, api: Optional[TelegramAPIServer] = None) -> AiohttpSession:
+        """
+        This method creates the session a Bot talks to the Bot API and downloads files with.
+
+        Parameters:
+        api (Optional[TelegramAPIServer]): The Bot API server, the public one when None.
+
+        Returns:
+        AiohttpSession: The session.
+        """
+        connector_options = None
+        if self.profile == "fast":
+            # One connection pool for every call of the bot, whose addresses and connections outlive the short
+            # defaults of aiohttp (10 s of DNS cache, 15 s of keep-alive)
+            connector_options = {"limit": self.telegram_connections, "ttl_dns_cache": self.dns_cache_ttl,
+                                 "keepalive_timeout": self.keepalive_timeout}
+        return MetricsSession(connector_options=connector_options, api=api or PRODUCTION, json_loads=self.json_loads,
+                              json_dumps=self.json_dumps)
+
+    def openai_http_client(self, transport: httpx.AsyncBaseTransport, **kwargs: Any) -> httpx.AsyncClient:
+        """
+        This method creates the HTTP client of the shared OpenAI client.
+
+        Parameters:
+        transport (httpx.AsyncBaseTransport): The transport, with its connection pool.
+        **kwargs: Other arguments of httpx.AsyncClient, e.g. the timeout.
+
+        Returns:
+        httpx.AsyncClient: The HTTP client.
+        """
+        if not self.orjson:
+            return httpx.AsyncClient(transport=transport, **kwargs)
+        return _FastJsonClient(transport=_FastJsonTransport(transport), **kwargs)
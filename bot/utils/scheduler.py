@@ -0,0 +1,230 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import AsyncIterator, Optional
+
+logger = logging.getLogger(__name__)
+
+# The user on whose behalf the current update is handled, set by SchedulerMiddleware
+current_user: ContextVar[int] = ContextVar("current_user", default=0)
+
+
+class SchedulerBusy(Exception):
+    """
+    This exception is raised when a model queue is too deep to accept another request.
+    """
+
+    def __init__(self, model: str):
+        super().__init__(f"Upstream queue for {model} is full")
+        self.model = model
+
+
+@dataclass(frozen=True)
+class ModelBudget:
+    """
+    This class describes how much of a model the bot may use at once.
+
+    ``tokens_per_minute`` is counted in the unit the model is billed in: tokens for chat models, images for
+    DALL·E, characters for TTS and requests for Whisper.
+    """
+    concurrency: int
+    tokens_per_minute: int
+
+
+# Default budgets, sized below the OpenAI tier limits so one burst cannot exhaust them
+MODEL_BUDGETS = {
+    "gpt-4": ModelBudget(concurrency=8, tokens_per_minute=40_000),
+    "gpt-4o": ModelBudget(concurrency=16, tokens_per_minute=150_000),
+    "gpt-4o-mini": ModelBudget(concurrency=16, tokens_per_minute=200_000),
+    "dall-e-3": ModelBudget(concurrency=2, tokens_per_minute=7),
+    "dall-e-2": ModelBudget(concurrency=4, tokens_per_minute=50),
+    "tts-1": ModelBudget(concurrency=8, tokens_per_minute=100_000),
+    "tts-1-hd": ModelBudget(concurrency=4, tokens_per_minute=50_000),
+    "whisper-1": ModelBudget(concurrency=8, tokens_per_minute=50),
+}
+DEFAULT_BUDGET = ModelBudget(concurrency=4, tokens_per_minute=10_000)
+
+
+class _ModelQueue:
+    """
+    This class holds the waiting requests and the budget state of a single model.
+    """
+
+    def __init__(self, model: str, budget: ModelBudget):
+        self.model = model
+        self.budget = budget
+        self.in_flight = 0
+        self.tokens = float(budget.tokens_per_minute)
+        self.refilled_at = time.monotonic()
+        # user id -> waiting (future, cost) pairs, in round-robin order
+        self.waiters: OrderedDict[int, deque] = OrderedDict()
+        self.queued = 0
+        self.served = 0
+        self.shed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        rate = self.budget.tokens_per_minute / 60
+        self.tokens = min(self.budget.tokens_per_minute, self.tokens + (now - self.refilled_at) * rate)
+        self.refilled_at = now
+
+    def cost(self, tokens: int) -> int:
+        # A single request larger than the whole budget would otherwise wait forever
+        return min(tokens, self.budget.tokens_per_minute)
+
+
+class UpstreamScheduler:
+    """
+    This class gates every request to OpenAI behind a per-model budget.
+
+    Each model has a concurrency limit and a tokens-per-minute bucket. Requests that cannot start right away wait in
+    per-user queues that are served round-robin, so one user sending dozens of requests cannot starve the others.
+    When too many requests are already waiting for a model, new ones are rejected with SchedulerBusy.
+    """
+
+    def __init__(self, budgets: dict[str, ModelBudget] = None, max_queue: int = 100, processes: int = 1):
+        """
+        This method initializes the UpstreamScheduler class.
+
+        Args:
+            budgets (dict[str, ModelBudget]): The budget for each model. Unknown models use DEFAULT_BUDGET.
+            max_queue (int): The number of waiting requests per model above which new requests are shed.
+            processes (int): The number of processes that each run a scheduler drawing from the same budgets.
+        """
+        self.budgets = MODEL_BUDGETS if budgets is None else budgets
+        self.max_queue = max_queue
+        self.processes = processes
+        self._queues: dict[str, _ModelQueue] = {}
+
+    def _queue(self, model: str) -> _ModelQueue:
+        queue = self._queues.get(model)
+        if queue is None:
+            budget = self.budgets.get(model, DEFAULT_BUDGET)
+            # Every process gets its share of the budget, so together they stay within it
+            budget = ModelBudget(concurrency=max(1, budget.concurrency // self.processes),
+                                 tokens_per_minute=max(1, budget.tokens_per_minute // self.processes))
+            queue = self._queues[model] = _ModelQueue(model, budget)
+        return queue
+
+    @asynccontextmanager
+    async def slot(self, model: str, tokens: int = 1, user_id: Optional[int] = None) -> AsyncIterator[None]:
+        """
+        This method waits for a free slot of the model and holds it for the duration of the block.
+
+        Args:
+            model (str): The model the request goes to.
+            tokens (int): The estimated cost of the request in the unit of the model budget.
+            user_id (int): The user the request is made for. Defaults to the user of the current update.
+
+        Raises:
+            SchedulerBusy: If the queue of the model is full.
+        """
+        queue = self._queue(model)
+        await self._acquire(queue, queue.cost(tokens), current_user.get() if user_id is None else user_id)
+        try:
+            yield
+        finally:
+            queue.in_flight -= 1
+            self._dispatch(queue)
+
+    async def _acquire(self, queue: _ModelQueue, cost: int, user_id: int) -> None:
+        queue.refill()
+        if not queue.waiters and queue.in_flight < queue.budget.concurrency and queue.tokens >= cost:
+            queue.tokens -= cost
+            queue.in_flight += 1
+            queue.served += 1
+            return
+
+        if queue.queued >= self.max_queue:
+            queue.shed += 1
+            logger.warning("Shedding request of user %s: %s queue holds %s requests", user_id, queue.model, queue.queued)
+            raise SchedulerBusy(queue.model)
+
+        future = asyncio.get_running_loop().create_future()
+        queue.waiters.setdefault(user_id, deque()).append((future, cost))
+        queue.queued += 1
+        # Nothing in flight may release a slot later, so the request is served or the refill timer armed right away
+        self._dispatch(queue)
+        started = time.monotonic()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was granted just before the cancellation, hand it to the next waiter
+                queue.in_flight -= 1
+                self._dispatch(queue)
+            else:
+                self._forget(queue, user_id, future)
+            raise
+        waited = time.monotonic() - started
+        queue.wait_total += waited
+        queue.wait_max = max(queue.wait_max, waited)
+
+    def _forget(self, queue: _ModelQueue, user_id: int, future: asyncio.Future) -> None:
+        waiters = queue.waiters.get(user_id)
+        if not waiters:
+            return
+        for entry in waiters:
+            if entry[0] is future:
+                waiters.remove(entry)
+                queue.queued -= 1
+                break
+        if not waiters:
+            del queue.waiters[user_id]
+
+    def _dispatch(self, queue: _ModelQueue) -> None:
+        queue.refill()
+        while queue.waiters and queue.in_flight < queue.budget.concurrency:
+            user_id, waiters = next(iter(queue.waiters.items()))
+            future, cost = waiters[0]
+            if future.done():
+                # Cancelled while waiting, its task has not cleaned up yet
+                self._forget(queue, user_id, future)
+                continue
+            if queue.tokens < cost:
+                # Come back when the bucket holds enough tokens for the next request in line
+                if queue.timer is None:
+                    delay = (cost - queue.tokens) / (queue.budget.tokens_per_minute / 60)
+                    queue.timer = asyncio.get_running_loop().call_later(delay, self._on_timer, queue)
+                return
+            waiters.popleft()
+            queue.queued -= 1
+            # Move the user to the back of the line so the others get their turn
+            del queue.waiters[user_id]
+            if waiters:
+                queue.waiters[user_id] = waiters
+            queue.tokens -= cost
+            queue.in_flight += 1
+            queue.served += 1
+            future.set_result(None)
+
+    def _on_timer(self, queue: _ModelQueue) -> None:
+        queue.timer = None
+        self._dispatch(queue)
+
+    def stats(self) -> dict[str, dict]:
+        """
+        This method reports the queue state of every model seen so far.
+
+        Returns:
+            dict[str, dict]: For each model the queue length, in-flight requests, served and shed request counts,
+            and the average and maximum wait time in seconds.
+        """
+        return {
+            model: {
+                "queued": queue.queued,
+                "in_flight": queue.in_flight,
+                "served": queue.served,
+                "shed": queue.shed,
+                "wait_avg": queue.wait_total / queue.served if queue.served else 0.0,
+                "wait_max": queue.wait_max,
+            }
+            for model, queue in self._queues.items()
+        }
@@ -0,0 +1,75 @@
+import re
+from typing import Optional
+
+# The end of a sentence: closing punctuation followed by whitespace, or a line break
+_SENTENCE_END = re.compile(r"(?<=[.!?…。！？])\s+|\n+")
+# A period that ends a title or an initial (Dr., e.g., J.) rather than the sentence
+_ABBREVIATION = re.compile(r"(?:\b(?:Mr|Mrs|Ms|Dr|Prof|Sr|Jr|St|vs|etc|e\.g|i\.e|[A-Z])\.)$")
+# Where a sentence too long for one chunk is cut instead, from the best place to the worst
+_CLAUSE_ENDS = (re.compile(r"[,;:]\s+"), re.compile(r"\s+"))
+
+
+def _cut(sentence: str, limit: int) -> list[str]:
+    # Cuts a sentence longer than the limit at the last clause break (or space) that keeps a piece under it
+    pieces = []
+    while len(sentence) > limit:
+        cut = 0
+        for pattern in _CLAUSE_ENDS:
+            ends = [match.end() for match in pattern.finditer(sentence, 0, limit + 1)]
+            if ends and ends[-1] > limit // 2:
+                cut = ends[-1]
+                break
+        cut = cut or limit
+        pieces.append(sentence[:cut].strip())
+        sentence = sentence[cut:].strip()
+    if sentence:
+        pieces.append(sentence)
+    return pieces
+
+
+def _sentences(text: str) -> list[str]:
+    # Splits a text at the ends of its sentences, putting back together the ones split after an abbreviation
+    sentences = []
+    for part in filter(None, (part.strip() for part in _SENTENCE_END.split(text))):
+        if sentences and _ABBREVIATION.search(sentences[-1]):
+            sentences[-1] = f"{sentences[-1]} {part}"
+        else:
+            sentences.append(part)
+    return sentences
+
+
+def split_sentences(text: str, limit: int, first_limit: Optional[int] = None) -> list[str]:
+    """
+    This function splits a text into chunks of whole sentences, each at most ``limit`` characters long.
+
+    Sentences are packed into as few chunks as the limit allows; a single sentence longer than the limit is cut at
+    a clause break or a space. The first chunk can have a lower limit, so the first piece of work done on it (e.g.
+    the first audio of a long text) is ready sooner.
+
+    Parameters:
+    text (str): The text to split.
+    limit (int): The most characters in a chunk.
+    first_limit (Optional[int]): The most characters in the first chunk, ``limit`` when None.
+
+    Returns:
+    list[str]: The chunks in order, without the whitespace between them.
+    """
+    chunks = []
+    current = ""
+    for sentence in _sentences(text):
+        chunk_limit = first_limit if first_limit and not chunks else limit
+        if current and len(current) + 1 + len(sentence) <= chunk_limit:
+            current = f"{current} {sentence}"
+            continue
+        if current:
+            chunks.append(current)
+            chunk_limit = limit
+        pieces = _cut(sentence, chunk_limit)
+        if len(pieces) > 1 and chunk_limit != limit:
+            # Only the first piece goes into the shorter first chunk
+            pieces = pieces[:1] + _cut(" ".join(pieces[1:]), limit)
+        *full, current = pieces
+        chunks.extend(full)
+    if current:
+        chunks.append(current)
+    return chunks
@@ -0,0 +1,146 @@
+import asyncio
+from typing import Any, AsyncIterator, Awaitable, Callable, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class _Flight:
+    """
+    This class is one upstream call shared by every request that asked for the same thing while it was running.
+    """
+
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self.task: Optional[asyncio.Task] = None
+        self.waiters = 0
+        # Streamed chunks so far, replayed to requests that join late
+        self.chunks: list[Any] = []
+        self.updated = asyncio.Event()
+
+    def notify(self) -> None:
+        # Wake everyone waiting for the next chunk; later waiters wait on a fresh event
+        self.updated.set()
+        self.updated = asyncio.Event()
+
+
+class SingleFlight:
+    """
+    This class makes identical concurrent upstream requests share one call.
+
+    The first request for a key starts the call in its own task, and requests for the same key made while it runs
+    wait for that task instead of calling OpenAI again. Every request can be cancelled on its own; the shared call
+    is cancelled only when nobody waits for it any more. Once the call is done the key is forgotten, so this is not
+    a cache: a request made afterwards calls again.
+    """
+
+    def __init__(self, enabled: bool = True):
+        """
+        This method initializes the SingleFlight class.
+
+        Args:
+            enabled (bool): Whether requests are shared. When disabled, every request makes its own call.
+        """
+        self.enabled = enabled
+        self._flights: dict[str, _Flight] = {}
+        # endpoint -> {"calls": upstream calls made, "saved": requests that joined a running call}
+        self._counts: dict[str, dict[str, int]] = {}
+
+    async def do(self, key: str, endpoint: str, factory: Callable[[], Awaitable[T]]) -> T:
+        """
+        This method returns the result of the call for a key, making the call only if it is not already running.
+
+        Args:
+            key (str): What the call is for, e.g. built with asset_key.
+            endpoint (str): The endpoint the call goes to, to label the counts.
+            factory (Callable[[], Awaitable[T]]): Makes the call.
+
+        Returns:
+            T: The result of the call, or its exception raised.
+        """
+        if not self.enabled:
+            return await factory()
+        flight = self._join(key, endpoint, lambda _: factory())
+        try:
+            # The shield keeps a cancelled waiter from cancelling the call the others wait for
+            return await asyncio.shield(flight.task)
+        finally:
+            self._leave(key, flight)
+
+    async def stream(self, key: str, endpoint: str, factory: Callable[[], AsyncIterator[T]]) -> AsyncIterator[T]:
+        """
+        This method yields the chunks of the streamed call for a key, making the call only if it is not already
+        running. Requests that join a running stream first get the chunks streamed so far.
+
+        Args:
+            key (str): What the call is for, e.g. built with asset_key.
+            endpoint (str): The endpoint the call goes to, to label the counts.
+            factory (Callable[[], AsyncIterator[T]]): Makes the call.
+
+        Yields:
+            T: The next chunk of the call.
+        """
+        if not self.enabled:
+            async for chunk in factory():
+                yield chunk
+            return
+
+        async def pump(flight: _Flight) -> None:
+            try:
+                async for chunk in factory():
+                    flight.chunks.append(chunk)
+                    flight.notify()
+            finally:
+                flight.notify()
+
+        flight = self._join(key, endpoint, pump)
+        index = 0
+        try:
+            while True:
+                updated = flight.updated
+                while index < len(flight.chunks):
+                    yield flight.chunks[index]
+                    index += 1
+                if flight.task.done():
+                    # Raises the exception of the call, if any
+                    flight.task.result()
+                    return
+                await updated.wait()
+        finally:
+            self._leave(key, flight)
+
+    def _join(self, key: str, endpoint: str, start: Callable[[_Flight], Awaitable[Any]]) -> _Flight:
+        counts = self._counts.setdefault(endpoint, {"calls": 0, "saved": 0})
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = _Flight(endpoint)
+            flight.task = asyncio.ensure_future(start(flight))
+            flight.task.add_done_callback(lambda _: self._forget(key, flight))
+            counts["calls"] += 1
+        else:
+            counts["saved"] += 1
+        flight.waiters += 1
+        return flight
+
+    def _leave(self, key: str, flight: _Flight) -> None:
+        flight.waiters -= 1
+        if flight.waiters == 0 and not flight.task.done():
+            # The last waiter is gone, nobody needs the answer any more
+            flight.task.cancel()
+            self._forget(key, flight)
+
+    def _forget(self, key: str, flight: _Flight) -> None:
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    def stats(self) -> dict[str, dict[str, int]]:
+        """
+        This method reports how many upstream calls were made and saved.
+
+        Returns:
+            dict[str, dict[str, int]]: Per endpoint, the calls made, the requests that joined a running call
+            instead of making their own, and the calls running now.
+        """
+        stats = {endpoint: {**counts, "in_flight": 0} for endpoint, counts in self._counts.items()}
+        for flight in self._flights.values():
+            stats[flight.endpoint]["in_flight"] += 1
+        return stats
@@ -0,0 +1,372 @@
+import asyncio
+import contextlib
+import itertools
+import json
+import logging
+import os
+import random
+import time
+from contextvars import ContextVar
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+logger = logging.getLogger(__name__)
+
+# The trace of the update being handled, None when the update is not traced; child tasks inherit it
+current_trace: ContextVar[Optional["Trace"]] = ContextVar("current_trace", default=None)
+# The span the next span is a child of
+_parent: ContextVar[int] = ContextVar("span_parent", default=0)
+
+
+class _NullSpan:
+    # What span() returns outside a traced update: a shared object whose enter and exit do nothing
+    __slots__ = ()
+
+    def __enter__(self) -> "_NullSpan":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        pass
+
+    async def __aenter__(self) -> "_NullSpan":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        pass
+
+    def set(self, **args: Any) -> None:
+        pass
+
+
+NULL_SPAN = _NullSpan()
+
+
+class Trace:
+    """
+    This class collects the spans of one update until it is handled, and whether they are kept.
+    """
+
+    def __init__(self, tracer: "Tracer", track: str, sampled: bool):
+        self.tracer = tracer
+        self.track = track
+        self.sampled = sampled
+        self.finished = False
+        # (name, category, track id, start, end, span id, parent id, args)
+        self.spans: list[tuple] = []
+        self.tracks: dict[asyncio.Task, int] = {}
+        self._ids = itertools.count(1)
+
+    def track_id(self) -> int:
+        # Every task of the update gets a track of its own, so spans running at once are never drawn overlapping
+        task = asyncio.current_task()
+        tid = self.tracks.get(task)
+        if tid is None:
+            tid = self.tracks[task] = next(self.tracer.track_ids)
+        return tid
+
+    def add(self, span: tuple) -> None:
+        # Spans of tasks that outlive the update are not kept
+        if self.finished:
+            return
+        # The root span (the one without a parent) ends last and is kept even when the others filled the trace
+        if len(self.spans) >= self.tracer.max_spans and span[6]:
+            self.tracer.counts["spans_dropped"] += 1
+            return
+        self.spans.append(span)
+
+
+class Span:
+    """
+    This class times one step of a traced update, e.g. a middleware, an OpenAI call or a Telegram send.
+
+    It is used as a context manager, sync or async, and may be given more args with set() while it runs.
+    """
+    __slots__ = ("trace", "name", "category", "args", "span_id", "parent", "tid", "started", "_token")
+
+    def __init__(self, trace: Trace, name: str, category: str, args: dict):
+        self.trace = trace
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def set(self, **args: Any) -> None:
+        self.args.update(args)
+
+    def __enter__(self) -> "Span":
+        self.span_id = next(self.trace._ids)
+        self.parent = _parent.get()
+        self.tid = self.trace.track_id()
+        self._token = _parent.set(self.span_id)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        ended = time.perf_counter()
+        _parent.reset(self._token)
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        self.trace.add((self.name, self.category, self.tid, self.started, ended, self.span_id, self.parent,
+                        self.args))
+
+    async def __aenter__(self) -> "Span":
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        self.__exit__(exc_type, exc, tb)
+
+
+class _RootSpan(Span):
+    # The span of the whole update: it makes the trace current for everything below it and hands the trace to the
+    # tracer when it ends
+    __slots__ = ("_trace_token",)
+
+    def __enter__(self) -> "Span":
+        self._trace_token = current_trace.set(self.trace)
+        return super().__enter__()
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        super().__exit__(exc_type, exc, tb)
+        current_trace.reset(self._trace_token)
+        self.trace.tracer.finish(self.trace, time.perf_counter() - self.started)
+
+
+def span(name: str, category: str = "bot", **args: Any):
+    """
+    This function starts a span of the current update, or does nothing at all when the update is not traced.
+
+    Parameters:
+    name (str): The name shown for the span, e.g. "telegram sendMessage".
+    category (str): The category of the span, e.g. "telegram" or "openai".
+    **args: Values shown with the span, e.g. the chat id.
+
+    Returns:
+    Span: A context manager timing the span; the shared NULL_SPAN outside a traced update.
+    """
+    trace = current_trace.get()
+    if trace is None:
+        return NULL_SPAN
+    return Span(trace, name, category, args)
+
+
+class Tracer:
+    """
+    This class decides which updates are traced and writes their spans to ``path`` in the Chrome trace event format,
+    which Perfetto (ui.perfetto.dev) and chrome://tracing open.
+
+    A share ``sample_rate`` of the updates is traced. When ``slow_threshold`` is set, every update is traced and
+    the spans of those quicker than it and not sampled are thrown away at the end, so every slow update is kept.
+    With both off no update is traced, and span() costs one context variable lookup.
+
+    Kept traces are written by a background task, in a thread. Every process writes a file of its own, its pid added
+    to the name (traces/bot.json -> traces/bot.1234.json); a file larger than ``max_bytes`` is rotated, keeping
+    ``backups`` older ones (traces/bot.1234.1.json, ...).
+    """
+
+    def __init__(self, path: Optional[str], sample_rate: float = 0.0, slow_threshold: float = 0.0,
+                 max_bytes: int = 100 * 1024 * 1024, backups: int = 3, flush_interval: float = 1.0,
+                 max_spans: int = 1000, max_pending: int = 10000):
+        """
+        This method initializes the Tracer class.
+
+        Args:
+            path (Optional[str]): The trace file, before the pid is added. None traces nothing.
+            sample_rate (float): The share of updates traced, from 0 to 1.
+            slow_threshold (float): The seconds above which an update is always traced, 0 for none.
+            max_bytes (int): The size a trace file is rotated at.
+            backups (int): The rotated files kept.
+            flush_interval (float): The seconds between two writes of the kept traces.
+            max_spans (int): The most spans kept for one update.
+            max_pending (int): The most kept traces waiting to be written; when the disk falls behind, newer traces
+                are dropped.
+        """
+        self.path = path
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.flush_interval = flush_interval
+        self.max_spans = max_spans
+        self.max_pending = max_pending
+        self.track_ids = itertools.count(1)
+        # perf_counter() + offset is the wall clock, in the microseconds trace events use
+        self._offset = time.time() - time.perf_counter()
+        self._pending: list[Trace] = []
+        self._task: Optional[asyncio.Task] = None
+        self._file: Optional[str] = None
+        self.counts = {"traced": 0, "kept": 0, "slow": 0, "dropped": 0, "spans_dropped": 0, "bytes_written": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.path is not None and (self.sample_rate > 0 or self.slow_threshold > 0)
+
+    def trace(self, name: str, track: str, category: str = "update", **args: Any):
+        """
+        This method starts the trace of an update, if it is sampled or may turn out slow.
+
+        Parameters:
+        name (str): The name of the root span, e.g. "update message".
+        track (str): The name of the track the update is drawn on, e.g. "update 1234".
+        category (str): The category of the root span.
+        **args: Values shown with the root span, e.g. the user id.
+
+        Returns:
+        Span: A context manager spanning the update; the shared NULL_SPAN when it is not traced.
+        """
+        if not self.enabled:
+            return NULL_SPAN
+        sampled = random.random() < self.sample_rate
+        if not sampled and not self.slow_threshold:
+            return NULL_SPAN
+        self.counts["traced"] += 1
+        return _RootSpan(Trace(self, track, sampled), name, category, args)
+
+    def finish(self, trace: Trace, duration: float) -> None:
+        """
+        This method ends a trace, and queues it for writing if it was sampled or slow.
+
+        Parameters:
+        trace (Trace): The trace of the update.
+        duration (float): The seconds the update took.
+        """
+        trace.finished = True
+        slow = bool(self.slow_threshold) and duration >= self.slow_threshold
+        if not trace.sampled and not slow:
+            return
+        if len(self._pending) >= self.max_pending:
+            self.counts["dropped"] += 1
+            return
+        self.counts["kept"] += 1
+        self.counts["slow"] += slow
+        self._pending.append(trace)
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self) -> None:
+        while self._pending:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self) -> None:
+        """
+        This method writes the kept traces to the trace file.
+        """
+        if not self._pending:
+            return
+        traces, self._pending = self._pending, []
+        try:
+            await asyncio.to_thread(self._write, traces)
+        except OSError as e:
+            self.counts["dropped"] += len(traces)
+            logger.warning("Failed to write %s traces: %s", len(traces), e)
+
+    def _events(self, trace: Trace) -> list[str]:
+        pid = os.getpid()
+        events = []
+        # Tracks are named after the update, extra tasks of the update after the order they started in
+        for index, tid in enumerate(sorted(trace.tracks.values())):
+            name = trace.track if index == 0 else f"{trace.track} task {index}"
+            events.append(json.dumps({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid,
+                                      "args": {"name": name}}))
+        for name, category, tid, started, ended, span_id, parent, args in trace.spans:
+            events.append(json.dumps({
+                "name": name, "cat": category, "ph": "X", "pid": pid, "tid": tid,
+                "ts": round((started + self._offset) * 1e6), "dur": round((ended - started) * 1e6),
+                "args": {**args, "span": span_id, "parent": parent},
+            }, default=str))
+        return events
+
+    def _write(self, traces: list[Trace]) -> None:
+        # The file is a JSON array of events, closed when the file is rotated or the tracer is closed; viewers also
+        # open an array that is not closed yet, e.g. after a crash
+        data = ",\n".join(event for trace in traces for event in self._events(trace)).encode()
+        if self._file is None:
+            root, ext = os.path.splitext(self.path)
+            self._file = f"{root}.{os.getpid()}{ext}"
+            # A file left by an earlier process with the same pid is moved aside rather than appended to
+            if os.path.exists(self._file):
+                self._rotate()
+        size = os.path.getsize(self._file) if os.path.exists(self._file) else 0
+        if size and size + len(data) > self.max_bytes:
+            self._close_file()
+            self._rotate()
+            size = 0
+        with open(self._file, "ab") as file:
+            file.write((b"[\n" if not size else b",\n") + data)
+        self.counts["bytes_written"] += len(data)
+
+    def _close_file(self) -> None:
+        if self._file is not None and os.path.exists(self._file):
+            with open(self._file, "ab") as file:
+                file.write(b"\n]\n")
+
+    def _rotate(self) -> None:
+        root, ext = os.path.splitext(self._file)
+        for index in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{root}.{index}{ext}"):
+                os.replace(f"{root}.{index}{ext}", f"{root}.{index + 1}{ext}")
+        if self.backups:
+            os.replace(self._file, f"{root}.1{ext}")
+        else:
+            os.remove(self._file)
+
+    async def close(self) -> None:
+        """
+        This method stops the background writer, writes the traces still kept and closes the trace file.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        await self.flush()
+        try:
+            await asyncio.to_thread(self._close_file)
+        except OSError as e:
+            logger.warning("Failed to close the trace file: %s", e)
+        self._file = None
+
+    def stats(self) -> dict[str, float]:
+        """
+        This method reports how many updates were traced, kept and dropped.
+
+        Returns:
+            dict[str, float]: The counts and the traces waiting to be written.
+        """
+        return {**self.counts, "pending": len(self._pending)}
+
+
+class TracedStorage(BaseStorage):
+    """
+    This class wraps an FSM storage and times its calls as spans of the traced updates.
+    """
+
+    def __init__(self, storage: BaseStorage):
+        self.storage = storage
+
+    def __getattr__(self, name: str) -> Any:
+        # Everything else, e.g. the stats of CachedStorage, comes from the wrapped storage
+        return getattr(self.storage, name)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        with span("fsm set_state", "fsm"):
+            await self.storage.set_state(key, state)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        with span("fsm get_state", "fsm"):
+            return await self.storage.get_state(key)
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        with span("fsm set_data", "fsm"):
+            await self.storage.set_data(key, data)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        with span("fsm get_data", "fsm"):
+            return await self.storage.get_data(key)
+
+    async def update_data(self, key: StorageKey, data: Dict[str, Any]) -> Dict[str, Any]:
+        with span("fsm update_data", "fsm"):
+            return await self.storage.update_data(key, data)
+
+    async def close(self) -> None:
+        await self.storage.close()
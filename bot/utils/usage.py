@@ -0,0 +1,337 @@
+import asyncio
+import contextlib
+import glob
+import logging
+import os
+import struct
+import time
+from collections import defaultdict
+from typing import Iterable, Iterator, Optional
+
+try:
+    import fcntl
+except ImportError:
+    # Without file locks (Windows), only one process may write the ledger
+    fcntl = None
+
+from bot.utils.scheduler import current_user
+
+logger = logging.getLogger(__name__)
+
+# One usage record: time (unix seconds, the start of the day once compacted), user id, model, requests, images,
+# prompt tokens, completion tokens, characters spoken, seconds of audio transcribed
+RECORD = struct.Struct("<Iq16sIIIIIf")
+# The fields of a record that are summed when records are aggregated
+COUNTERS = ("requests", "images", "prompt_tokens", "completion_tokens", "characters", "audio_seconds")
+# The fields records can be grouped by
+GROUPS = ("user", "model", "day")
+DAY = 86400
+
+
+@contextlib.contextmanager
+def _locked(path: str, exclusive: bool, blocking: bool = True) -> Iterator[bool]:
+    # Holds a lock on the lock file of the ledger; yields False when a non-blocking lock is taken by another process
+    if fcntl is None:
+        yield True
+        return
+    with open(f"{path}.lock", "a") as lock:
+        mode = (fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH) | (0 if blocking else fcntl.LOCK_NB)
+        try:
+            fcntl.flock(lock, mode)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+class UsageLedger:
+    """
+    This class keeps an append-only ledger of what every user spends on OpenAI: tokens, images, characters spoken
+    and seconds of audio, per model.
+
+    record() packs a fixed-width record into a memory buffer and returns at once; a background task appends the
+    buffer to ``path`` every ``flush_interval`` seconds, in a thread, so handlers never wait on the disk. Every
+    ``compact_interval`` seconds the raw records are folded into ``path``.daily, one record per user, model and
+    day, which keeps the ledger small and the queries fast. Several processes may write the same ledger.
+    """
+
+    def __init__(self, path: Optional[str], flush_interval: float = 1.0, compact_interval: float = 3600.0,
+                 max_buffer: int = 1024 * 1024):
+        """
+        This method initializes the UsageLedger class.
+
+        Args:
+            path (Optional[str]): The file the raw records are appended to. None records nothing.
+            flush_interval (float): The seconds between two writes of the buffered records.
+            compact_interval (float): The seconds between two compactions, 0 for none.
+            max_buffer (int): The bytes of records kept in memory; when the disk falls behind, newer records are
+                dropped instead of growing the buffer.
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+        self.compact_interval = compact_interval
+        self.max_buffer = max_buffer
+        self._buffer = bytearray()
+        self._task: Optional[asyncio.Task] = None
+        self._next_compaction = time.monotonic() + compact_interval
+        self.counts = {"records": 0, "flushes": 0, "dropped": 0, "compactions": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.path is not None
+
+    def record(self, model: str, requests: int = 1, images: int = 0, prompt_tokens: int = 0,
+               completion_tokens: int = 0, characters: int = 0, audio_seconds: float = 0.0,
+               user_id: Optional[int] = None) -> None:
+        """
+        This method records the usage of one OpenAI call, without waiting for the disk.
+
+        Args:
+            model (str): The model called.
+            requests (int): The calls made.
+            images (int): The images generated.
+            prompt_tokens (int): The tokens of the prompt.
+            completion_tokens (int): The tokens of the answer.
+            characters (int): The characters turned into speech.
+            audio_seconds (float): The seconds of audio transcribed.
+            user_id (Optional[int]): The user the call was made for, the user of the current update or job when None.
+        """
+        if self.path is None:
+            return
+        if len(self._buffer) >= self.max_buffer:
+            self.counts["dropped"] += 1
+            return
+        self._buffer += RECORD.pack(int(time.time()), current_user.get() if user_id is None else user_id,
+                                    model.encode()[:16], requests, images, prompt_tokens, completion_tokens,
+                                    characters, audio_seconds)
+        self.counts["records"] += 1
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self) -> None:
+        # Writes the buffer while there is something to write, and compacts now and then
+        while self._buffer:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+            if self.compact_interval and time.monotonic() >= self._next_compaction:
+                self._next_compaction = time.monotonic() + self.compact_interval
+                try:
+                    await asyncio.to_thread(compact, self.path)
+                    self.counts["compactions"] += 1
+                except OSError as e:
+                    logger.warning("Failed to compact the usage ledger: %s", e)
+
+    async def flush(self) -> None:
+        """
+        This method appends the buffered records to the ledger file.
+        """
+        if not self._buffer:
+            return
+        data, self._buffer = bytes(self._buffer), bytearray()
+        try:
+            await asyncio.to_thread(self._append, data)
+            self.counts["flushes"] += 1
+        except OSError as e:
+            self.counts["dropped"] += len(data) // RECORD.size
+            logger.warning("Failed to write %s usage records: %s", len(data) // RECORD.size, e)
+
+    def _append(self, data: bytes) -> None:
+        # Whole records in one write of an O_APPEND file, so writers of several processes do not mix
+        with _locked(self.path, exclusive=False):
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+
+    async def close(self) -> None:
+        """
+        This method stops the background writer and writes what is still buffered.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        await self.flush()
+
+    def stats(self) -> dict[str, float]:
+        """
+        This method reports how many records were taken, written and dropped.
+
+        Returns:
+            dict[str, float]: The counts and the bytes waiting to be written.
+        """
+        return {**self.counts, "buffered_bytes": len(self._buffer)}
+
+
+def _read(names: Iterable[str]) -> Iterator[bytes]:
+    # The contents of the files that exist, in chunks of whole records
+    for name in names:
+        try:
+            with open(name, "rb") as file:
+                while chunk := file.read(RECORD.size * 65536):
+                    # A record cut short by a crash mid-write is skipped
+                    yield chunk[:len(chunk) - len(chunk) % RECORD.size]
+        except FileNotFoundError:
+            continue
+
+
+def read_records(path: str) -> Iterator[bytes]:
+    """
+    This function yields the contents of every file of a ledger (daily records, raw records and raw records of an
+    unfinished compaction), in chunks of whole records.
+
+    Parameters:
+    path (str): The raw ledger file.
+
+    Yields:
+    bytes: Packed records.
+    """
+    consumed = _consumed(path)
+    raw = [name for name in sorted(glob.glob(f"{glob.escape(path)}.*.compacting")) if name not in consumed]
+    yield from _read([f"{path}.daily", *raw, path])
+
+
+def _consumed(path: str) -> set[str]:
+    # Raw files already folded into the daily file by a compaction that stopped before removing them. The marker
+    # lists them from before the daily file is replaced; while the new daily file is still a .tmp file, they are not
+    # in the daily file yet and still count
+    try:
+        with open(f"{path}.daily.consumed") as file:
+            names = file.read().split()
+    except FileNotFoundError:
+        return set()
+    if os.path.exists(f"{path}.daily.tmp"):
+        return set()
+    directory = os.path.dirname(path)
+    return {os.path.join(directory, name) for name in names}
+
+
+def _sum(chunks: Iterable[bytes], by_day: bool, by_user: bool, by_model: bool, since: Optional[float] = None,
+         until: Optional[float] = None, users: Optional[set[int]] = None,
+         models: Optional[set[bytes]] = None) -> dict[tuple, list]:
+    # Sums the records on the raw (day, user, model) values asked for, the others left at 0; the key is built the
+    # same way for every record, since this loop is what a query over millions of records spends its time on
+    filtered = since is not None or until is not None or users or models
+    since = since or 0
+    until = until or float("inf")
+    days: dict[tuple, list] = {}
+    for chunk in chunks:
+        for at, user, model, requests, images, prompt, completion, characters, seconds in RECORD.iter_unpack(chunk):
+            if filtered and (at < since or at >= until or (users and user not in users) or
+                             (models and model not in models)):
+                continue
+            key = (at // DAY if by_day else 0, user if by_user else 0, model if by_model else b"")
+            row = days.get(key)
+            if row is None:
+                days[key] = [requests, images, prompt, completion, characters, seconds]
+            else:
+                row[0] += requests
+                row[1] += images
+                row[2] += prompt
+                row[3] += completion
+                row[4] += characters
+                row[5] += seconds
+    return days
+
+
+def aggregate(chunks: Iterable[bytes], by: Iterable[str] = GROUPS, since: Optional[float] = None,
+              until: Optional[float] = None, users: Optional[set[int]] = None,
+              models: Optional[set[str]] = None) -> dict[tuple, list]:
+    """
+    This function sums usage records by any of user, model and day.
+
+    Parameters:
+    chunks (Iterable[bytes]): Packed records, e.g. from read_records.
+    by (Iterable[str]): The fields to group by, out of GROUPS; none sums everything into one row.
+    since (Optional[float]): Only records from this unix time on.
+    until (Optional[float]): Only records before this unix time.
+    users (Optional[set[int]]): Only records of these users.
+    models (Optional[set[str]]): Only records of these models.
+
+    Returns:
+    dict[tuple, list]: The sums of COUNTERS for every group, keyed by the values of the ``by`` fields in order.
+    """
+    by = tuple(by)
+    if any(field not in GROUPS for field in by):
+        raise ValueError(f"Records can only be grouped by {', '.join(GROUPS)}")
+    wanted_models = {model.encode()[:16].ljust(16, b"\0") for model in models} if models else None
+    days = _sum(chunks, "day" in by, "user" in by, "model" in by, since, until, users, wanted_models)
+
+    positions = [GROUPS.index(field) for field in by]
+    names: dict[bytes, str] = {}
+    dates: dict[int, str] = {}
+    sums: dict[tuple, list] = defaultdict(lambda: [0, 0, 0, 0, 0, 0.0])
+    for (day, user, model), counters in days.items():
+        values = (user, model, day)
+        key = []
+        for position in positions:
+            value = values[position]
+            if position == 1:
+                value = names.get(value) or names.setdefault(value, value.rstrip(b"\0").decode())
+            elif position == 2:
+                value = dates.get(value) or dates.setdefault(value, time.strftime("%Y-%m-%d",
+                                                                                  time.gmtime(value * DAY)))
+            key.append(value)
+        row = sums[tuple(key)]
+        for index, value in enumerate(counters):
+            row[index] += value
+    return dict(sums)
+
+
+def compact(path: str) -> int:
+    """
+    This function folds the raw records of a ledger into its daily file, one record per user, model and day.
+
+    The raw file is moved aside under the lock writers take, so records written meanwhile go to a new raw file, and
+    the daily file is replaced in one rename. A marker file lists the raw files folded into the new daily file until
+    they are removed, so a crash at any point neither loses records nor counts them twice. Only one process compacts
+    at a time; the others skip.
+
+    Parameters:
+    path (str): The raw ledger file.
+
+    Returns:
+    int: The raw records folded in, 0 if another process is compacting.
+    """
+    with _locked(f"{path}.compact", exclusive=True, blocking=False) as acquired:
+        if not acquired:
+            return 0
+        marker = f"{path}.daily.consumed"
+        # Finish what an interrupted compaction left: remove the raw files it folded in, or forget its daily file
+        for name in _consumed(path):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(name)
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(marker)
+        pending = f"{path}.{os.getpid()}.{time.time_ns()}.compacting"
+        with _locked(path, exclusive=True):
+            try:
+                os.replace(path, pending)
+            except FileNotFoundError:
+                pass
+        # Raw files left by an interrupted compaction are folded in with this one
+        raw = sorted(glob.glob(f"{glob.escape(path)}.*.compacting"))
+        if not raw:
+            return 0
+        days = _sum(_read([f"{path}.daily", *raw]), by_day=True, by_user=True, by_model=True)
+        folded = sum(os.path.getsize(name) // RECORD.size for name in raw)
+        with open(f"{path}.daily.tmp", "wb") as file:
+            file.write(b"".join(RECORD.pack(day * DAY, user, model, *row)
+                                for (day, user, model), row in sorted(days.items())))
+            file.flush()
+            os.fsync(file.fileno())
+        with open(f"{marker}.tmp", "w") as file:
+            file.write("\n".join(os.path.basename(name) for name in raw))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(f"{marker}.tmp", marker)
+        os.replace(f"{path}.daily.tmp", f"{path}.daily")
+        for name in raw:
+            os.remove(name)
+        os.remove(marker)
+        return folded
@@ -0,0 +1,143 @@
+import base64
+import io
+import logging
+import math
+from dataclasses import dataclass
+from typing import BinaryIO, Optional, Sequence
+
+from aiogram.types import PhotoSize
+
+from bot.utils.metrics import vision_image_bytes, vision_image_tokens
+
+try:
+    from PIL import Image
+except ImportError:
+    # Pillow is optional, without it photos are sent at the Telegram size picked for them
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+# Image tokens the vision model charges for a low detail image, and for each 512px tile of a high detail one
+BASE_TOKENS = 85
+TILE_TOKENS = 170
+
+
+def model_size(width: int, height: int, detail: str) -> tuple[int, int]:
+    """
+    This function returns the size the vision model shrinks an image to before looking at it.
+
+    A low detail image is fitted into 512x512. A high detail image is fitted into 2048x2048 and then its shortest
+    side is shrunk to 768. Images are never enlarged.
+    """
+    if detail == "low":
+        scale = min(1.0, 512 / max(width, height))
+    else:
+        scale = min(1.0, 2048 / max(width, height), 768 / min(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def image_tokens(width: int, height: int, detail: str) -> int:
+    """
+    This function returns the image tokens the vision model charges for an image of this size.
+    """
+    if detail == "low":
+        return BASE_TOKENS
+    width, height = model_size(width, height, detail)
+    return BASE_TOKENS + TILE_TOKENS * math.ceil(width / 512) * math.ceil(height / 512)
+
+
+def pick_photo_size(sizes: Sequence[PhotoSize], detail: str) -> PhotoSize:
+    """
+    This function picks the smallest size of a Telegram photo the vision model sees in the same resolution as the
+    largest one.
+
+    Parameters:
+    sizes (Sequence[PhotoSize]): The sizes of the photo, as in Message.photo.
+    detail (str): The detail the photo is sent with, "low" or "high".
+
+    Returns:
+    PhotoSize: The size to download.
+    """
+    largest = max(sizes, key=lambda size: size.width * size.height)
+    width, height = model_size(largest.width, largest.height, detail)
+    # A pixel of slack for the rounding of the sizes Telegram makes
+    enough = [size for size in sizes if size.width >= width - 1 and size.height >= height - 1]
+    return min(enough, key=lambda size: size.width * size.height)
+
+
+@dataclass
+class VisionImage:
+    """
+    This class is a photo ready for the vision model, together with what it saves against the largest size.
+    """
+    data_url: str
+    width: int
+    height: int
+    detail: str
+    sent_bytes: int
+    largest_bytes: Optional[int] = None
+    largest_tokens: Optional[int] = None
+
+    @property
+    def tokens(self) -> int:
+        return image_tokens(self.width, self.height, self.detail)
+
+    def report(self) -> None:
+        """
+        This method logs and counts the upload bytes and image tokens of the photo against its largest size.
+        """
+        vision_image_bytes.inc(("sent",), self.sent_bytes)
+        vision_image_tokens.inc(("sent",), self.tokens)
+        if self.largest_bytes is not None:
+            vision_image_bytes.inc(("largest",), self.largest_bytes)
+        if self.largest_tokens is not None:
+            vision_image_tokens.inc(("largest",), self.largest_tokens)
+        logger.info("Vision photo %sx%s (%s detail): %s bytes and %s tokens, the largest size %s bytes and %s tokens",
+                    self.width, self.height, self.detail, self.sent_bytes, self.tokens, self.largest_bytes,
+                    self.largest_tokens)
+
+
+def _downscale(data: bytes, size: tuple[int, int], quality: int) -> Optional[bytes]:
+    output = io.BytesIO()
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            image.convert("RGB").resize(size, Image.LANCZOS).save(output, format="JPEG", quality=quality,
+                                                                   optimize=True)
+    except (OSError, ValueError) as e:
+        # Not an image Pillow can read, send it as it is
+        logger.warning("Failed to downscale a vision photo: %s", e)
+        return None
+    encoded = output.getbuffer()
+    # Re-encoding an already small JPEG can make it larger
+    return bytes(encoded) if encoded.nbytes < len(data) else None
+
+
+def prepare_image(image: BinaryIO, width: int, height: int, detail: str, downscale: bool = True,
+                  quality: int = 85) -> VisionImage:
+    """
+    This function turns a downloaded photo into the data URL sent to the vision model, shrinking it to the
+    resolution the model works at first when Pillow is installed. It is CPU bound, run it in a thread.
+
+    Parameters:
+    image (BinaryIO): The photo, positioned at the start.
+    width (int): The width of the photo.
+    height (int): The height of the photo.
+    detail (str): The detail the photo is sent with, "low" or "high".
+    downscale (bool): Whether to shrink and re-encode the photo.
+    quality (int): The JPEG quality of a re-encoded photo.
+
+    Returns:
+    VisionImage: The photo ready to send.
+    """
+    data = image.read()
+    target = model_size(width, height, detail)
+    if downscale and Image is not None and target != (width, height):
+        smaller = _downscale(data, target, quality)
+        if smaller is not None:
+            data = smaller
+            width, height = target
+    # The photo is base64 encoded once; joining the prefix and decoding to the str the OpenAI client takes copy the
+    # encoded photo twice more, as any way of building a str URL from bytes does
+    data_url = b"data:image/jpeg;base64," + base64.b64encode(data)
+    return VisionImage(data_url=data_url.decode("ascii"), width=width, height=height, detail=detail,
+                       sent_bytes=len(data))
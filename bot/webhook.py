@@ -0,0 +1,182 @@
+import asyncio
+import logging
+import multiprocessing
+import queue as queue_errors
+import time
+from typing import Any, Optional
+
+from aiogram.fsm.storage.memory import SimpleEventIsolation
+from aiohttp import web
+
+from bot import setup_routers
+from bot.config import (WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_SECRET, WEBHOOK_QUEUE_SIZE,
+                        WEBHOOK_WORKER_UPDATES, WEBHOOK_SHUTDOWN_TIMEOUT, METRICS_HOST, METRICS_PORT, runtime)
+from bot.dispatcher import create_bot, create_dispatcher
+from bot.utils.metrics import start_metrics_server
+
+logger = logging.getLogger(__name__)
+
+
+def update_chat_id(update: dict[str, Any]) -> int:
+    """
+    This function finds the chat an update belongs to, falling back to the user for updates without a chat.
+
+    Parameters:
+    update (dict[str, Any]): The raw update as sent by Telegram.
+
+    Returns:
+    int: The chat (or user) id, 0 if the update has neither.
+    """
+    for kind, event in update.items():
+        if kind == "update_id" or not isinstance(event, dict):
+            continue
+        chat = event.get("chat") or (event.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+        user = event.get("from") or event.get("user")
+        if user:
+            return user["id"]
+    return 0
+
+
+async def _serve_worker(index: int, queue: multiprocessing.Queue) -> None:
+    bot = create_bot()
+    # Updates of one chat are handled one after another, in the order they arrived
+    dp = create_dispatcher(events_isolation=SimpleEventIsolation())
+    loop = asyncio.get_running_loop()
+    tasks = set()
+    # The worker stops taking updates off its queue while it handles as many as it may, so the queue fills up
+    # and the front turns Telegram away instead of the worker piling up tasks
+    updates = asyncio.Semaphore(WEBHOOK_WORKER_UPDATES)
+
+    # Every worker has its own metrics, served on its own port: METRICS_PORT + worker index
+    metrics = None
+    if METRICS_PORT:
+        metrics = await start_metrics_server(METRICS_HOST, METRICS_PORT + index)
+
+    await dp.emit_startup(bot=bot, dispatcher=dp)
+    logger.info("Webhook worker %s started", index)
+    try:
+        while True:
+            await updates.acquire()
+            update = await loop.run_in_executor(None, queue.get)
+            if update is None:
+                break
+            task = asyncio.create_task(dp.feed_raw_update(bot, update))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            task.add_done_callback(lambda _: updates.release())
+        await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        await dp.emit_shutdown(bot=bot, dispatcher=dp)
+        await bot.session.close()
+        if metrics is not None:
+            await metrics.cleanup()
+
+
+def _run_worker(index: int, queue: multiprocessing.Queue) -> None:
+    logging.basicConfig(
+        level=logging.INFO,
+        format=f"%(asctime)s - %(levelname)s - worker {index} - %(name)s - %(message)s",
+    )
+    # Workers are spawned, so they set up the event loop of the runtime profile themselves
+    runtime.install()
+    try:
+        asyncio.run(_serve_worker(index, queue))
+    except KeyboardInterrupt:
+        pass
+
+
+def create_front_app(queues: list[multiprocessing.Queue], secret: Optional[str] = WEBHOOK_SECRET,
+                     path: str = WEBHOOK_PATH) -> web.Application:
+    """
+    This function creates the aiohttp application that receives webhook updates and routes them to the workers.
+
+    Every update of a chat goes to the same worker (chat id modulo the number of workers), so the FSM cache and
+    the order of updates of a chat stay consistent. Telegram gets its answer as soon as the update is queued, or a
+    503 when the queue of the worker is full, and sends the update again later.
+
+    Parameters:
+    queues (list[multiprocessing.Queue]): The update queue of each worker.
+    secret (Optional[str]): The secret token Telegram must send with every update.
+    path (str): The path Telegram posts updates to.
+
+    Returns:
+    web.Application: The application.
+    """
+    async def receive(request: web.Request) -> web.Response:
+        if secret and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != secret:
+            return web.Response(status=401)
+        update = runtime.json_loads(await request.read())
+        try:
+            queues[update_chat_id(update) % len(queues)].put_nowait(update)
+        except queue_errors.Full:
+            logger.warning("Worker queue is full, asking Telegram to send update %s again", update.get("update_id"))
+            return web.Response(status=503, headers={"Retry-After": "1"})
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(path, receive)
+    return app
+
+
+def stop_workers(queues: list[multiprocessing.Queue], processes: list[multiprocessing.Process],
+                 timeout: float = WEBHOOK_SHUTDOWN_TIMEOUT) -> None:
+    """
+    This function asks the workers to stop once they have handled the updates already queued for them, and
+    terminates those still running after ``timeout`` seconds.
+
+    Parameters:
+    queues (list[multiprocessing.Queue]): The update queue of each worker.
+    processes (list[multiprocessing.Process]): The worker processes.
+    timeout (float): The seconds the workers get, all together, to stop on their own.
+    """
+    deadline = time.monotonic() + timeout
+    for queue in queues:
+        try:
+            queue.put(None, timeout=max(0.0, deadline - time.monotonic()))
+        except queue_errors.Full:
+            # The worker is stuck with a full queue, it is terminated below
+            pass
+    for process in processes:
+        process.join(max(0.0, deadline - time.monotonic()))
+    for process in processes:
+        if process.is_alive():
+            logger.warning("Webhook worker %s did not stop in time, terminating it", process.name)
+            process.terminate()
+            process.join()
+
+
+def run_webhook(workers: int) -> None:
+    """
+    This function runs the bot in webhook mode: one front process listening on WEBHOOK_HOST:WEBHOOK_PORT and
+    ``workers`` processes that handle the updates.
+
+    Parameters:
+    workers (int): The number of worker processes.
+    """
+    context = multiprocessing.get_context("spawn")
+    queues = [context.Queue(maxsize=WEBHOOK_QUEUE_SIZE) for _ in range(workers)]
+    processes = [context.Process(target=_run_worker, args=(index, queue), daemon=True)
+                 for index, queue in enumerate(queues)]
+    for process in processes:
+        process.start()
+
+    app = create_front_app(queues)
+
+    async def on_startup(_: web.Application) -> None:
+        if not WEBHOOK_URL:
+            return
+        bot = create_bot()
+        try:
+            await bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET, drop_pending_updates=True,
+                                  allowed_updates=setup_routers().resolve_used_update_types())
+        finally:
+            await bot.session.close()
+
+    app.on_startup.append(on_startup)
+    try:
+        web.run_app(app, host=WEBHOOK_HOST, port=WEBHOOK_PORT)
+    finally:
+        # Let every worker finish the updates it already received
+        stop_workers(queues, processes)
@@ -0,0 +1,8 @@
+import os
+import sys
+from pathlib import Path
+
+# The tests import the bot package, whose configuration is read from the environment at import time
+os.environ.setdefault("OPENAI_API", "fake")
+os.environ.setdefault("TOKEN_TELEGRAM", "123456:fake")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
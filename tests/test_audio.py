@@ -0,0 +1,27 @@
+import io
+
+from benchmarks.transcription import voice_message
+from bot.utils.audio import split_audio
+
+
+def test_voice_message_is_split_from_the_file_into_decodable_parts():
+    data = voice_message(60)
+    audio = io.BytesIO(data)
+
+    parts = split_audio(audio, "audio/ogg", 4)
+
+    assert len(parts) == 4
+    chunks = [part.read(audio) for part in parts]
+    # Every part repeats the header pages, and together they hold every audio page once
+    header = parts[0].ranges[0][1]
+    assert all(chunk.startswith(data[:header]) for chunk in chunks)
+    assert b"".join(chunk[header:] for chunk in chunks) == data[header:]
+    assert sum(part.size for part in parts) == len(data) + 3 * header
+
+
+def test_unknown_format_is_one_part_of_the_whole_file():
+    audio = io.BytesIO(b"\x00\x00\x00\x18ftypmp42" + bytes(1000))
+
+    parts = split_audio(audio, "video/mp4", 4)
+
+    assert [part.ranges for part in parts] == [((0, 1012),)]
@@ -0,0 +1,53 @@
+import asyncio
+
+from bot.utils.completion_cache import CompletionCache, SqliteCompletionBackend
+
+SYSTEM_PROMPT = "Answer briefly."
+
+
+def test_answer_survives_a_restart_through_the_backend(tmp_path):
+    path = str(tmp_path / "completions.sqlite")
+
+    async def run() -> tuple:
+        cache = CompletionCache(backend=SqliteCompletionBackend(path))
+        await cache.put("gpt-4o", SYSTEM_PROMPT, "What is 2 + 2?", "4")
+        from_memory = await cache.get("gpt-4o", SYSTEM_PROMPT, "What is 2 + 2?")
+        cache.backend.close()
+
+        # A new process starts with an empty memory and reads through to the file
+        restarted = CompletionCache(backend=SqliteCompletionBackend(path))
+        from_backend = await restarted.get("gpt-4o", SYSTEM_PROMPT, "What is 2 + 2?")
+        assert len(restarted._memory) == 1
+        return from_memory, from_backend, await restarted.get("gpt-4o", SYSTEM_PROMPT, "What is 3 + 3?")
+
+    assert asyncio.run(run()) == ("4", "4", None)
+
+
+def test_expired_answer_is_not_reused(tmp_path):
+    async def run() -> tuple:
+        cache = CompletionCache(ttl=0.05, backend=SqliteCompletionBackend(str(tmp_path / "completions.sqlite")))
+        await cache.put("gpt-4o", SYSTEM_PROMPT, "What is 2 + 2?", "4")
+        fresh = await cache.get("gpt-4o", SYSTEM_PROMPT, "What is 2 + 2?")
+        await asyncio.sleep(0.1)
+        # Expired in memory and in the file alike
+        return fresh, await cache.get("gpt-4o", SYSTEM_PROMPT, "What is 2 + 2?")
+
+    assert asyncio.run(run()) == ("4", None)
+
+
+def test_prompts_differing_in_case_and_spacing_share_an_answer():
+    cache = CompletionCache(disabled_models=["gpt-4"])
+
+    async def run() -> list:
+        await cache.put("gpt-4o", SYSTEM_PROMPT, "What is  the capital of France?", "Paris")
+        await cache.put("gpt-4", SYSTEM_PROMPT, "What is the capital of France?", "Paris")
+        return [
+            await cache.get("gpt-4o", SYSTEM_PROMPT, "  what is the Capital\nof france? "),
+            # The same question to another model, with another system prompt or not cached at all is a miss
+            await cache.get("gpt-4o-mini", SYSTEM_PROMPT, "What is the capital of France?"),
+            await cache.get("gpt-4o", "Answer in French.", "What is the capital of France?"),
+            await cache.get("gpt-4", SYSTEM_PROMPT, "What is the capital of France?"),
+        ]
+
+    assert asyncio.run(run()) == ["Paris", None, None, None]
+    assert (cache.stats()["hits"], cache.stats()["misses"]) == (1, 2)
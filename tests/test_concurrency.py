@@ -0,0 +1,40 @@
+import asyncio
+import time
+
+import openai
+
+from benchmarks.fake_openai import FakeOpenAI
+from bot.handlers.api import text
+from bot.utils.scheduler import ModelBudget, UpstreamScheduler
+
+USERS = 50
+LATENCY = 0.5
+
+
+def test_concurrent_users_take_about_one_round_trip(monkeypatch):
+    # Every user gets a slot at once, so only the client could make the users wait for each other
+    monkeypatch.setattr(text, "scheduler", UpstreamScheduler(
+        budgets={"gpt-4o": ModelBudget(concurrency=USERS, tokens_per_minute=10 ** 9)}))
+
+    async def run() -> tuple[float, float, list[str]]:
+        server = FakeOpenAI(latency=LATENCY)
+        await server.start()
+        client = openai.AsyncOpenAI(api_key="fake", base_url=server.base_url, max_retries=0)
+        monkeypatch.setattr(text, "client", client)
+        try:
+            started = time.perf_counter()
+            await text.generate_text(prompt="warm up", model="gpt-4o")
+            single = time.perf_counter() - started
+
+            started = time.perf_counter()
+            answers = await asyncio.gather(*(text.generate_text(prompt=f"user {index}", model="gpt-4o")
+                                             for index in range(USERS)))
+            return single, time.perf_counter() - started, answers
+        finally:
+            await client.close()
+            await server.stop()
+
+    single, concurrent, answers = asyncio.run(run())
+    assert not [answer for answer in answers if answer.startswith("Error:")]
+    assert single >= LATENCY
+    assert concurrent < 2 * single
@@ -0,0 +1,103 @@
+import asyncio
+from types import SimpleNamespace
+
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from bot.handlers.api import text
+from bot.utils.conversation import Conversation, count_tokens
+
+
+def _conversation(pairs: int) -> Conversation:
+    conversation = Conversation()
+    for index in range(pairs):
+        conversation.add("user", f"question {index} " * 10)
+        conversation.add("assistant", f"answer {index} " * 30)
+    return conversation
+
+
+def test_history_over_the_budget_is_cut_down_in_pairs():
+    conversation = _conversation(10)
+    budget = conversation.tokens - 1
+
+    dropped = conversation.trim(budget)
+    assert conversation.tokens <= budget * conversation.trim_to
+    assert conversation.tokens == sum(turn[2] for turn in conversation.turns)
+    # Whole pairs are dropped, oldest first, so the history still starts with a question
+    assert len(dropped) % 2 == 0
+    assert dropped[0][1].startswith("question 0")
+    assert conversation.turns[0][0] == "u"
+    # A history that fits is left alone
+    assert conversation.trim(budget) == []
+
+
+def test_history_read_from_the_fsm_data_is_not_changed_in_place():
+    data = _conversation(1).to_data()
+    turns = [list(turn) for turn in data["turns"]]
+
+    conversation = Conversation.from_data(data)
+    conversation.add("user", "one more question")
+    conversation.set_summary("what was said")
+    assert data == {"turns": turns, "summary": None}
+
+
+def test_dropped_turns_are_summarized(monkeypatch):
+    summarized = []
+
+    async def summarize_turns(turns: list[list], summary) -> str:
+        summarized.append((turns, summary))
+        return "they talked"
+
+    monkeypatch.setattr(text, "HISTORY_SUMMARY", True)
+    monkeypatch.setattr(text, "summarize_turns", summarize_turns)
+    monkeypatch.setattr(text, "CONTEXT_BUDGETS", {"gpt-4o": text.estimate_tokens("hi") + 600})
+    conversation = _conversation(10)
+    conversation.set_summary("they met")
+
+    asyncio.run(text.fit_conversation(conversation, "gpt-4o", "hi"))
+    (turns, summary), = summarized
+    assert summary == "they met"
+    assert turns[0][1].startswith("question 0")
+    assert conversation.summary == ["they talked", count_tokens("they talked")]
+    assert conversation.tokens <= 600
+
+
+class FakeMessage:
+    """
+    This class stands in for the message of the user, keeping the answers sent to the chat.
+    """
+
+    def __init__(self, prompt: str):
+        self.text = prompt
+        self.from_user = SimpleNamespace(id=1)
+        self.answers = []
+        self.bot = SimpleNamespace(send_message=self._send_message)
+
+    async def answer(self, text: str) -> None:
+        self.answers.append(text)
+
+    async def _send_message(self, chat_id: int, text: str) -> None:
+        self.answers.append(text)
+
+
+def test_history_is_not_saved_after_a_failed_answer(monkeypatch):
+    answers = iter(["Paris", "Error: gpt-4o did not answer in time, please try again later"])
+
+    async def generate_text(prompt: str, model: str, conversation: Conversation) -> str:
+        return next(answers)
+
+    monkeypatch.setattr(text, "TEXT_STREAMING", False)
+    monkeypatch.setattr(text, "CONVERSATION_MEMORY", True)
+    monkeypatch.setattr(text, "generate_text", generate_text)
+    state = FSMContext(storage=MemoryStorage(), key=StorageKey(bot_id=1, chat_id=1, user_id=1))
+    menus = SimpleNamespace(text=lambda msg_id: msg_id)
+
+    async def run() -> dict:
+        await state.update_data(model="gpt-4o")
+        await text.text(FakeMessage("Capital of France?"), menus, state)
+        await text.text(FakeMessage("And of Spain?"), menus, state)
+        return await state.get_data()
+
+    history = Conversation.from_data(asyncio.run(run())["history"])
+    assert [turn[1] for turn in history.turns] == ["Capital of France?", "Paris"]
@@ -0,0 +1,32 @@
+from pathlib import Path
+
+from bot.handlers.start import start_keyboard
+from bot.utils.fluent_helper import FluentDispenser
+
+LOCALES = Path("bot/locales")
+
+
+def test_keyboard_of_a_language_is_built_once():
+    dispenser = FluentDispenser(LOCALES)
+    builds = []
+
+    def keyboard(l10n):
+        builds.append(l10n)
+        return start_keyboard(l10n)
+
+    first = dispenser.get_menus("ru")(keyboard)
+    # Every later update in the language gets the same object, without rendering it again
+    assert dispenser.get_menus("ru")(keyboard) is first
+    assert dispenser.get_menus("ru").text("text_wait") is dispenser.get_menus("ru").text("text_wait")
+    assert len(builds) == 1
+
+
+def test_languages_do_not_share_a_keyboard():
+    dispenser = FluentDispenser(LOCALES)
+
+    english = dispenser.get_menus("en")(start_keyboard)
+    russian = dispenser.get_menus("ru")(start_keyboard)
+    assert russian is not english
+    assert russian.inline_keyboard[0][0].text != english.inline_keyboard[0][0].text
+    # Unknown languages fall back to the menus of the default one
+    assert dispenser.get_menus("xx")(start_keyboard) is english
@@ -0,0 +1,106 @@
+import asyncio
+
+from aiogram.fsm.storage.base import StorageKey
+
+from bot.utils.fsm_storage import CachedStorage, MemoryBackend
+
+KEY = StorageKey(bot_id=1, chat_id=2, user_id=3)
+
+
+class FlakyBackend(MemoryBackend):
+    """
+    This class is a MemoryBackend whose first saves fail.
+    """
+
+    def __init__(self, failures: int):
+        super().__init__()
+        self.failures = failures
+
+    async def save(self, key: str, record: dict) -> None:
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("MongoDB is unreachable")
+        await super().save(key, record)
+
+
+def test_writes_of_a_handler_are_saved_once_and_read_from_the_cache():
+    backend = MemoryBackend()
+    storage = CachedStorage(backend)
+
+    async def run() -> tuple[str, dict]:
+        await storage.update_data(KEY, {"model": "gpt-4o"})
+        await storage.set_state(KEY, "StateText:text")
+        # Nothing is saved before the flush task runs
+        assert backend.saves == 0
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        return await storage.get_state(KEY), await storage.get_data(KEY)
+
+    assert asyncio.run(run()) == ("StateText:text", {"model": "gpt-4o"})
+    assert (backend.loads, backend.saves) == (1, 1)
+    assert backend.records == {"fsm:2:3": {"state": "StateText:text", "data": {"model": "gpt-4o"}}}
+
+
+def test_close_saves_writes_held_back():
+    backend = MemoryBackend()
+    storage = CachedStorage(backend, flush_delay=0.05)
+
+    async def run() -> None:
+        await storage.set_data(KEY, {"voice_model": "alloy"})
+        await asyncio.sleep(0)
+        assert backend.saves == 0
+        await storage.close()
+
+    asyncio.run(run())
+    assert backend.records["fsm:2:3"]["data"] == {"voice_model": "alloy"}
+
+
+def test_failed_save_is_retried():
+    backend = FlakyBackend(failures=2)
+    storage = CachedStorage(backend, retry_delay=0.01)
+
+    async def run() -> None:
+        await storage.set_state(KEY, "StateImage:image")
+        await storage.close()
+
+    asyncio.run(asyncio.wait_for(run(), timeout=5))
+    assert backend.records["fsm:2:3"]["state"] == "StateImage:image"
+
+
+def test_save_failing_every_time_is_given_up():
+    backend = FlakyBackend(failures=100)
+    storage = CachedStorage(backend, max_retries=2, retry_delay=0.01)
+
+    async def run() -> None:
+        await storage.set_state(KEY, "StateImage:image")
+        await storage.close()
+
+    asyncio.run(asyncio.wait_for(run(), timeout=5))
+    assert backend.failures == 97
+    assert backend.records == {}
+
+
+def test_flush_is_restarted_after_it_crashed():
+    backend = MemoryBackend()
+    save = backend.save
+    crashes = [TypeError("document cannot be encoded")]
+
+    def crashing_save(key: str, record: dict):
+        # Raised before the save even starts, which the flush does not expect
+        if crashes:
+            raise crashes.pop()
+        return save(key, record)
+
+    backend.save = crashing_save
+    storage = CachedStorage(backend)
+
+    async def run() -> None:
+        await storage.set_state(KEY, "StateText:text")
+        await asyncio.sleep(0.01)
+        assert backend.saves == 0
+        await storage.update_data(KEY, {"model": "gpt-4o"})
+        await asyncio.sleep(0.01)
+        assert backend.saves == 1
+
+    asyncio.run(asyncio.wait_for(run(), timeout=5))
+    assert backend.records == {"fsm:2:3": {"state": "StateText:text", "data": {"model": "gpt-4o"}}}
@@ -0,0 +1,63 @@
+import asyncio
+
+import pytest
+
+from bot.handlers.api import image
+from bot.utils.jobs import Job, JobError
+
+
+class FakeBot:
+    """
+    This class stands in for the bot, keeping the progress edits and the albums sent.
+    """
+
+    def __init__(self):
+        self.edits = []
+        self.albums = []
+
+    async def edit_message_text(self, text: str, chat_id: int, message_id: int) -> None:
+        self.edits.append(text)
+
+    async def delete_message(self, chat_id: int, message_id: int) -> None:
+        pass
+
+    async def send_media_group(self, chat_id: int, media: list) -> None:
+        self.albums.append(media)
+
+
+def test_failed_batch_cancels_the_others_and_fails_the_job(monkeypatch):
+    calls = []
+    cancelled = []
+
+    async def generate_images(prompt: str, model: str, n: int):
+        index = len(calls)
+        calls.append(index)
+        if index == 0:
+            return ["https://images.example/0.png"]
+        if index == 1:
+            await asyncio.sleep(0.01)
+            return "Error: Your request was rejected by the safety system"
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(index)
+            raise
+
+    monkeypatch.setattr(image, "IMAGES_PER_REQUEST", {})
+    monkeypatch.setattr(image, "_generate_images", generate_images)
+    job = Job(id=1, kind="variation", chat_id=1, attempts=1,
+              payload={"prompt": "a cat", "model": "dall-e-3", "count": 4, "wait_message_id": 2})
+
+    async def run() -> FakeBot:
+        bot = FakeBot()
+        with pytest.raises(JobError, match="safety system"):
+            await asyncio.wait_for(image.variation_job(bot, job), timeout=5)
+        # Let the cancellations reach the requests
+        await asyncio.sleep(0.01)
+        return bot
+
+    bot = asyncio.run(run())
+    assert calls == [0, 1, 2, 3]
+    assert sorted(cancelled) == [2, 3]
+    assert bot.edits == ["⏳ 1/4 🖼️"]
+    assert bot.albums == []
@@ -0,0 +1,163 @@
+import asyncio
+import sqlite3
+from pathlib import Path
+
+from bot.utils.fluent_helper import FluentDispenser
+from bot.utils.jobs import Job, JobError, JobQueue, SqliteJobBackend
+from bot.utils.scheduler import SchedulerBusy
+
+
+class FakeBot:
+    """
+    This class stands in for the bot, keeping the messages sent to each chat.
+    """
+
+    def __init__(self):
+        self.messages = []
+
+    async def send_message(self, chat_id: int, text: str) -> None:
+        self.messages.append((chat_id, text))
+
+
+def _queue(tmp_path, **kwargs) -> JobQueue:
+    return JobQueue(backend=SqliteJobBackend(str(tmp_path / "jobs.sqlite")), backoff=0.01, poll_interval=0.01,
+                    **kwargs)
+
+
+def test_failed_job_is_retried_until_it_succeeds(tmp_path):
+    queue = _queue(tmp_path, max_attempts=3)
+    attempts = []
+
+    @queue.job("flaky")
+    async def flaky(bot, job: Job) -> None:
+        attempts.append(job.attempts)
+        if job.attempts < 3:
+            raise JobError("Error: try again")
+
+    async def run() -> FakeBot:
+        bot = FakeBot()
+        await queue.start(bot)
+        await queue.enqueue(bot, "flaky", 1, {})
+        while queue.stats()["flaky"]["completed"] < 1:
+            await asyncio.sleep(0.01)
+        await queue.stop()
+        return bot
+
+    bot = asyncio.run(asyncio.wait_for(run(), timeout=5))
+    assert attempts == [1, 2, 3]
+    assert queue.stats()["flaky"]["retried"] == 2
+    # The user hears about the error only when the job is given up
+    assert bot.messages == []
+
+
+def test_job_is_dead_lettered_after_the_last_attempt(tmp_path):
+    queue = _queue(tmp_path, max_attempts=2)
+
+    @queue.job("broken")
+    async def broken(bot, job: Job) -> None:
+        raise JobError("Error: it does not work")
+
+    async def run() -> FakeBot:
+        bot = FakeBot()
+        await queue.start(bot)
+        await queue.enqueue(bot, "broken", 7, {})
+        while queue.stats()["broken"]["failed"] < 1:
+            await asyncio.sleep(0.01)
+        await queue.stop()
+        return bot
+
+    bot = asyncio.run(asyncio.wait_for(run(), timeout=5))
+    assert bot.messages == [(7, "Error: it does not work")]
+    # The failed job is kept for inspection and never claimed again
+    failed, error = queue.backend._db.execute("SELECT failed, error FROM jobs").fetchone()
+    assert (failed, error) == (1, "Error: it does not work")
+    assert asyncio.run(queue.backend.claim("broken", 1, lease=60)) == []
+
+
+def test_job_of_a_dead_worker_is_claimed_again_when_its_lease_expires(tmp_path):
+    backend = SqliteJobBackend(str(tmp_path / "jobs.sqlite"))
+
+    async def run() -> tuple[list[Job], list[Job], list[Job]]:
+        await backend.add("slow", 1, {"n": 1})
+        first = await backend.claim("slow", 1, lease=0.2)
+        # Leased to the worker that claimed it, which then dies without completing it
+        during = await backend.claim("slow", 1, lease=0.2)
+        await asyncio.sleep(0.3)
+        return first, during, await backend.claim("slow", 1, lease=60)
+
+    first, during, after = asyncio.run(run())
+    assert [job.attempts for job in first] == [1]
+    assert during == []
+    assert [(job.id, job.payload, job.attempts) for job in after] == [(first[0].id, {"n": 1}, 2)]
+
+
+def test_interrupted_job_is_handed_back_without_counting_the_attempt(tmp_path):
+    queue = _queue(tmp_path)
+    started = asyncio.Event()
+
+    @queue.job("long")
+    async def long(bot, job: Job) -> None:
+        started.set()
+        await asyncio.sleep(60)
+
+    async def run() -> list[Job]:
+        bot = FakeBot()
+        await queue.start(bot)
+        await queue.enqueue(bot, "long", 1, {})
+        await started.wait()
+        await queue.stop(timeout=0.01)
+        return await queue.backend.claim("long", 1, lease=60)
+
+    jobs = asyncio.run(asyncio.wait_for(run(), timeout=5))
+    assert [job.attempts for job in jobs] == [1]
+
+
+def test_running_job_keeps_its_lease(tmp_path):
+    queue = _queue(tmp_path, lease=0.3)
+    claimed = []
+
+    @queue.job("slow")
+    async def slow(bot, job: Job) -> None:
+        # Runs for several leases, long enough for a worker without heartbeat to lose the job
+        for _ in range(3):
+            claimed.extend(await queue.backend.claim("slow", 1, lease=60))
+            await asyncio.sleep(0.3)
+
+    async def run() -> None:
+        bot = FakeBot()
+        await queue.start(bot)
+        await queue.enqueue(bot, "slow", 1, {})
+        while queue.stats()["slow"]["completed"] < 1:
+            await asyncio.sleep(0.01)
+        await queue.stop()
+
+    asyncio.run(asyncio.wait_for(run(), timeout=5))
+    assert claimed == []
+
+
+def test_unexpected_error_is_reported_in_the_language_of_the_user(tmp_path):
+    queue = _queue(tmp_path, max_attempts=1, dispenser=FluentDispenser(Path("bot/locales")))
+
+    @queue.job("busy")
+    async def busy(bot, job: Job) -> None:
+        raise SchedulerBusy("dall-e-3")
+
+    @queue.job("broken")
+    async def broken(bot, job: Job) -> None:
+        raise sqlite3.OperationalError("database is locked")
+
+    async def run() -> FakeBot:
+        bot = FakeBot()
+        await queue.start(bot)
+        await queue.enqueue(bot, "busy", 1, {}, language="ru")
+        await queue.enqueue(bot, "broken", 2, {}, language="xx")
+        while sum(counts["failed"] for counts in queue.stats().values()) < 2:
+            await asyncio.sleep(0.01)
+        await queue.stop()
+        return bot
+
+    bot = asyncio.run(asyncio.wait_for(run(), timeout=5))
+    dispenser = FluentDispenser(Path("bot/locales"))
+    # Unknown languages get the default one, and nothing of the error itself reaches the user
+    assert sorted(bot.messages) == [(1, dispenser.get_language("ru").format_value("text_busy")),
+                                    (2, dispenser.get_language("en").format_value("text_job_failed"))]
@@ -0,0 +1,62 @@
+import asyncio
+import importlib
+import sys
+
+from aiogram import Bot, Dispatcher, Router
+from aiogram.types import CallbackQuery, Chat, Message, Update, User
+
+import bot
+from bot.utils.lazy import LazyRouter
+
+FEATURE = '''
+from aiogram import F, Router
+
+router_demo = Router()
+answered = []
+
+
+@router_demo.callback_query(F.data == "demo")
+async def demo(call) -> None:
+    answered.append(call.data)
+'''
+
+USER = User(id=1, is_bot=False, first_name="Ada")
+
+
+def _message(update_id: int, text: str) -> Update:
+    return Update(update_id=update_id, message=Message(message_id=update_id, date=0, text=text, from_user=USER,
+                                                       chat=Chat(id=1, type="private")))
+
+
+def _callback(update_id: int, data: str) -> Update:
+    return Update(update_id=update_id, callback_query=CallbackQuery(id=str(update_id), from_user=USER,
+                                                                    chat_instance="1", data=data))
+
+
+def test_feature_is_imported_when_an_update_leads_into_it(monkeypatch, tmp_path):
+    (tmp_path / "lazy_feature_demo.py").write_text(FEATURE)
+    monkeypatch.syspath_prepend(str(tmp_path))
+    monkeypatch.delitem(sys.modules, "lazy_feature_demo", raising=False)
+    dp = Dispatcher()
+    dp.include_router(LazyRouter("lazy_feature_demo", "router_demo", callbacks=["demo"]))
+
+    async def run() -> None:
+        async with Bot("42:TEST") as telegram:
+            for update in [_message(1, "/start"), _message(2, "demo"), _callback(3, "other")]:
+                await dp.feed_update(telegram, update)
+            assert "lazy_feature_demo" not in sys.modules
+            await dp.feed_update(telegram, _callback(4, "demo"))
+
+    asyncio.run(run())
+    assert importlib.import_module("lazy_feature_demo").answered == ["demo"]
+
+
+def test_update_types_are_the_same_before_the_features_are_loaded(monkeypatch):
+    monkeypatch.setattr(bot, "LAZY_LOADING", True)
+    lazy = bot.setup_routers()
+    lazy_types = set(lazy.resolve_used_update_types())
+
+    eager = Router()
+    for feature in lazy.sub_routers:
+        eager.include_router(getattr(importlib.import_module(feature.module), feature.attribute))
+    assert lazy_types == set(eager.resolve_used_update_types())
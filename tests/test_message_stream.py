@@ -0,0 +1,83 @@
+import asyncio
+from types import SimpleNamespace
+
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import EditMessageText
+
+from bot.utils import message_stream
+from bot.utils.message_stream import MessageStreamer
+
+
+class FakeMessage:
+    """
+    This class stands in for a message of the chat, keeping the messages answered to it and the edits made to them.
+    """
+
+    def __init__(self, chat: "FakeMessage" = None, text: str = ""):
+        self.chat = chat or self
+        self.edits = [text] if text else []
+        self.sent = []
+        # Flood control errors the next edits raise
+        self.flood = []
+
+    async def answer(self, text: str) -> "FakeMessage":
+        message = FakeMessage(self.chat, text)
+        self.chat.sent.append(message)
+        return message
+
+    async def edit_text(self, text: str) -> None:
+        if self.flood:
+            raise TelegramRetryAfter(method=EditMessageText(text=text), message="Flood", retry_after=self.flood.pop())
+        self.edits.append(text)
+
+
+def test_long_answer_rolls_over_into_new_messages():
+    chat = FakeMessage()
+    streamer = MessageStreamer(None, interval=0, chat_message=chat)
+    paragraph = "word " * 300 + "\n"
+
+    async def run() -> None:
+        for _ in range(4):
+            await streamer.feed(paragraph)
+        await streamer.feed("x" * 5000)
+        await streamer.finish()
+
+    asyncio.run(run())
+    texts = [message.edits[-1] for message in chat.sent]
+    # Split on the last line break that fits, so no paragraph is cut in half, and at the limit when there is none
+    assert texts == [(paragraph * 2).rstrip("\n"), (paragraph * 2).rstrip("\n"), "x" * 4096, "x" * 904]
+
+
+def test_chunks_within_the_interval_are_merged_into_one_edit():
+    placeholder = FakeMessage(text="wait")
+    streamer = MessageStreamer(placeholder, interval=60)
+
+    async def run() -> None:
+        for chunk in ["The ", "answer ", "is ", "42."]:
+            await streamer.feed(chunk)
+        await streamer.finish()
+
+    asyncio.run(run())
+    assert placeholder.edits == ["wait", "The ", "The answer is 42."]
+
+
+def test_flood_control_is_waited_out_on_finish(monkeypatch):
+    placeholder = FakeMessage(text="wait")
+    # The edit of the first chunk and the first try of the final edit hit flood control
+    placeholder.flood = [3, 5]
+    waited = []
+
+    async def sleep(seconds: float) -> None:
+        waited.append(seconds)
+
+    monkeypatch.setattr(message_stream, "asyncio", SimpleNamespace(sleep=sleep))
+    streamer = MessageStreamer(placeholder, interval=0)
+
+    async def run() -> None:
+        await streamer.feed("Hello")
+        assert placeholder.edits == ["wait"]
+        await streamer.finish()
+
+    asyncio.run(run())
+    assert waited == [3]
+    assert placeholder.edits == ["wait", "Hello"]
@@ -0,0 +1,58 @@
+import asyncio
+import io
+
+import httpx
+from aiogram import Bot
+from aiogram.client.telegram import TelegramAPIServer
+
+from benchmarks.fake_openai import FakeOpenAI
+from benchmarks.fake_telegram import FAKE_TOKEN, FakeTelegram
+from bot.utils import metrics
+from bot.utils.metrics import MetricsSession, MetricsTransport
+
+
+def test_bytes_of_a_streamed_openai_answer_are_counted(monkeypatch):
+    counter = metrics.Counter("bytes", "")
+    monkeypatch.setattr(metrics, "openai_bytes", counter)
+    body = {"model": "gpt-4o", "messages": [{"role": "user", "content": "Hi"}], "stream": True}
+
+    async def run() -> tuple[int, int]:
+        server = FakeOpenAI(latency=0.01, tokens=50)
+        await server.start()
+        client = httpx.AsyncClient(transport=MetricsTransport(httpx.AsyncHTTPTransport()))
+        try:
+            # A streamed answer is chunked, it has no content-length
+            async with client.stream("POST", f"{server.base_url}/chat/completions", json=body) as response:
+                assert "content-length" not in response.headers
+                received = sum([len(chunk) async for chunk in response.aiter_raw()])
+            return len(response.request.content), received
+        finally:
+            await client.aclose()
+            await server.stop()
+
+    sent, received = asyncio.run(run())
+    assert received > 0
+    assert counter.values == {("chat/completions", "sent"): sent, ("chat/completions", "received"): received}
+
+
+def test_bytes_of_telegram_calls_and_downloads_are_counted(monkeypatch):
+    counter = metrics.Counter("bytes", "")
+    monkeypatch.setattr(metrics, "telegram_bytes", counter)
+
+    async def run() -> bytes:
+        telegram = FakeTelegram()
+        await telegram.start()
+        bot = Bot(token=FAKE_TOKEN, session=MetricsSession(api=TelegramAPIServer.from_base(telegram.base_url)))
+        try:
+            await bot.send_message(chat_id=1, text="Hello")
+            file = io.BytesIO()
+            await bot.download("file", destination=file)
+            return file.getvalue()
+        finally:
+            await bot.session.close()
+            await telegram.stop()
+
+    downloaded = asyncio.run(run())
+    assert counter.values[("sendMessage", "sent")] > 0
+    assert counter.values[("sendMessage", "received")] > 0
+    assert counter.values[("download", "received")] == len(downloaded) > 0
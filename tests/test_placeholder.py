@@ -0,0 +1,61 @@
+import asyncio
+
+import pytest
+
+from bot.utils.outbound import Placeholder
+
+
+class FakeMessage:
+    """
+    This class stands in for the message of the user, keeping the placeholders answered to it.
+    """
+
+    def __init__(self):
+        self.sent = []
+        self.deleted = []
+
+    async def answer(self, text: str) -> "FakeMessage":
+        answer = FakeMessage()
+        answer.parent = self
+        self.sent.append(answer)
+        return answer
+
+    async def delete(self) -> None:
+        self.parent.deleted.append(self)
+
+
+def test_placeholder_is_deleted_when_the_handler_raises():
+    message = FakeMessage()
+
+    async def run() -> None:
+        async with Placeholder(message, "wait"):
+            await asyncio.sleep(0.01)
+            raise ConnectionError("download failed")
+
+    with pytest.raises(ConnectionError):
+        asyncio.run(run())
+    assert len(message.sent) == 1
+    assert message.deleted == message.sent
+
+
+def test_placeholder_of_a_quick_answer_is_never_sent():
+    message = FakeMessage()
+
+    async def run() -> None:
+        async with Placeholder(message, "wait", delay=1):
+            pass
+
+    asyncio.run(run())
+    assert message.sent == []
+
+
+def test_taken_placeholder_is_kept():
+    message = FakeMessage()
+
+    async def run() -> None:
+        async with Placeholder(message, "wait") as placeholder:
+            await asyncio.sleep(0.01)
+            assert await placeholder.take() is message.sent[0]
+
+    asyncio.run(run())
+    assert message.deleted == []
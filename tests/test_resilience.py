@@ -0,0 +1,178 @@
+import asyncio
+import time
+
+import openai
+import pytest
+
+from benchmarks.fake_openai import FakeOpenAI
+from bot.utils.resilience import CLOSED, OPEN, Resilience, UpstreamUnavailable
+
+MODEL = "gpt-4o"
+
+
+def _run(server: FakeOpenAI, test) -> None:
+    # Runs a test coroutine against the fake server, with a client that leaves retries to Resilience
+    async def run() -> None:
+        await server.start()
+        client = openai.AsyncOpenAI(api_key="fake", base_url=server.base_url, max_retries=0)
+        try:
+            await asyncio.wait_for(test(client), timeout=10)
+        finally:
+            await client.close()
+            await server.stop()
+
+    asyncio.run(run())
+
+
+def _complete(client: openai.AsyncOpenAI):
+    return client.chat.completions.create(model=MODEL, messages=[{"role": "user", "content": "Hi"}])
+
+
+def test_server_error_is_retried_until_the_call_succeeds():
+    server = FakeOpenAI(latency=0.01, error_rate=1.0)
+    resilience = Resilience(backoff=0.01)
+
+    async def test(client: openai.AsyncOpenAI) -> None:
+        async def attempt():
+            try:
+                return await _complete(client)
+            finally:
+                # Only the first attempt fails
+                server.error_rate = 0.0
+
+        completion = await resilience.call(MODEL, attempt)
+        assert completion.choices[0].message.content
+
+    _run(server, test)
+    assert (server.requests, server.errors) == (2, 1)
+    assert resilience.stats()[MODEL]["retries"] == 1
+
+
+def test_call_gives_up_after_the_last_attempt():
+    server = FakeOpenAI(latency=0.01, error_rate=1.0)
+    resilience = Resilience(max_attempts=3, backoff=0.01)
+
+    async def test(client: openai.AsyncOpenAI) -> None:
+        with pytest.raises(openai.InternalServerError):
+            await resilience.call(MODEL, lambda: _complete(client))
+
+    _run(server, test)
+    assert server.requests == 3
+
+
+def test_error_of_the_request_itself_is_not_retried():
+    server = FakeOpenAI(latency=0.01, error_rate=1.0, error_status=400)
+    resilience = Resilience(backoff=0.01)
+
+    async def test(client: openai.AsyncOpenAI) -> None:
+        with pytest.raises(openai.BadRequestError):
+            await resilience.call(MODEL, lambda: _complete(client))
+
+    _run(server, test)
+    assert server.requests == 1
+    assert resilience.stats()[MODEL]["circuit"] == CLOSED
+
+
+def test_retries_stop_when_the_budget_is_spent():
+    server = FakeOpenAI(latency=0.01, error_rate=1.0)
+    # No tokens are earned back, so only the one left can pay for a retry
+    resilience = Resilience(max_attempts=5, backoff=0.01, retry_ratio=0, retry_min_per_second=0)
+    resilience._guard(MODEL).budget.tokens = 1
+
+    async def test(client: openai.AsyncOpenAI) -> None:
+        with pytest.raises(openai.InternalServerError):
+            await resilience.call(MODEL, lambda: _complete(client))
+
+    _run(server, test)
+    assert server.requests == 2
+    stats = resilience.stats()[MODEL]
+    assert (stats["retries"], stats["budget_exhausted"]) == (1, 1)
+
+
+def test_circuit_opens_after_failures_and_closes_after_a_probe():
+    server = FakeOpenAI(latency=0.01, error_rate=1.0)
+    resilience = Resilience(max_attempts=1, failure_threshold=2, reset_timeout=0.2)
+
+    async def test(client: openai.AsyncOpenAI) -> None:
+        for _ in range(2):
+            with pytest.raises(openai.InternalServerError):
+                await resilience.call(MODEL, lambda: _complete(client))
+        # Refused without a request while the circuit is open
+        with pytest.raises(UpstreamUnavailable):
+            await resilience.call(MODEL, lambda: _complete(client))
+        assert resilience.stats()[MODEL]["circuit"] == OPEN
+        assert server.requests == 2
+
+        server.error_rate = 0.0
+        await asyncio.sleep(0.3)
+        await resilience.call(MODEL, lambda: _complete(client))
+        assert resilience.stats()[MODEL]["circuit"] == CLOSED
+
+    _run(server, test)
+    assert resilience.stats()[MODEL]["rejected"] == 1
+
+
+def test_slow_call_is_raced_against_a_hedge():
+    server = FakeOpenAI(latency=0.01, slow_rate=1.0, slow_latency=5)
+    resilience = Resilience(hedge_after={MODEL: 0.1})
+
+    async def test(client: openai.AsyncOpenAI) -> None:
+        attempts = 0
+
+        async def attempt():
+            nonlocal attempts
+            attempts += 1
+            if attempts == 2:
+                # The hedge finds the server quick again
+                server.slow_rate = 0.0
+            return await _complete(client)
+
+        started = time.monotonic()
+        await resilience.call(MODEL, attempt)
+        assert time.monotonic() - started < 1
+
+    _run(server, test)
+    stats = resilience.stats()[MODEL]
+    assert (stats["hedges"], stats["hedges_won"]) == (1, 1)
+
+
+def test_rate_limits_do_not_open_the_circuit():
+    server = FakeOpenAI(latency=0.01, error_rate=1.0, error_status=429)
+    resilience = Resilience(max_attempts=1, failure_threshold=2)
+
+    async def test(client: openai.AsyncOpenAI) -> None:
+        for _ in range(3):
+            with pytest.raises(openai.RateLimitError):
+                await resilience.call(MODEL, lambda: _complete(client))
+
+    _run(server, test)
+    assert server.requests == 3
+    assert resilience.stats()[MODEL]["circuit"] == CLOSED
+
+
+def test_stalled_stream_is_given_up():
+    resilience = Resilience(stream_idle_timeout=0.1)
+    closed = []
+
+    class Stream:
+        """
+        This class stands in for an OpenAI stream that sends one chunk and then stalls.
+        """
+
+        async def __aiter__(self):
+            yield "first"
+            await asyncio.sleep(10)
+            yield "never"
+
+        async def close(self) -> None:
+            closed.append(True)
+
+    async def test() -> list[str]:
+        chunks = []
+        with pytest.raises(UpstreamUnavailable):
+            async for chunk in resilience.stream(MODEL, Stream()):
+                chunks.append(chunk)
+        return chunks
+
+    assert asyncio.run(asyncio.wait_for(test(), timeout=5)) == ["first"]
+    assert closed == [True]
@@ -0,0 +1,24 @@
+import asyncio
+
+import pytest
+
+from bot.utils.runtime import Runtime
+
+
+@pytest.mark.parametrize("profile, limit", [("default", 100), ("fast", 7)])
+def test_telegram_session_gets_the_connection_pool_of_the_profile(profile, limit):
+    runtime = Runtime(profile, telegram_connections=7, dns_cache_ttl=120, keepalive_timeout=42)
+
+    async def run():
+        session = runtime.telegram_session()
+        try:
+            return (await session.create_session()).connector.limit
+        finally:
+            await session.close()
+
+    assert asyncio.run(run()) == limit
+
+
+def test_unknown_profile_is_refused():
+    with pytest.raises(ValueError, match="^Unknown runtime profile"):
+        Runtime("turbo")
@@ -0,0 +1,54 @@
+import asyncio
+import time
+
+from bot.utils.scheduler import ModelBudget, UpstreamScheduler
+
+
+def test_request_held_back_by_tokens_alone_wakes_up_on_refill():
+    # 60 tokens a minute refill one token a second, and nothing is in flight to release a slot
+    scheduler = UpstreamScheduler(budgets={"m": ModelBudget(concurrency=4, tokens_per_minute=60)})
+
+    async def run() -> float:
+        async with scheduler.slot("m", tokens=60, user_id=1):
+            pass
+        started = time.monotonic()
+        async with scheduler.slot("m", tokens=1, user_id=2):
+            pass
+        return time.monotonic() - started
+
+    waited = asyncio.run(asyncio.wait_for(run(), timeout=5))
+    assert 0.5 < waited < 2
+    assert scheduler.stats()["m"]["queued"] == 0
+
+
+def test_requests_of_users_are_served_round_robin():
+    scheduler = UpstreamScheduler(budgets={"m": ModelBudget(concurrency=1, tokens_per_minute=10_000)})
+    order = []
+
+    async def request(user_id: int, index: int) -> None:
+        async with scheduler.slot("m", user_id=user_id):
+            order.append((user_id, index))
+            await asyncio.sleep(0.01)
+
+    async def run() -> None:
+        await asyncio.gather(*(request(1, index) for index in range(3)), request(2, 0))
+
+    asyncio.run(run())
+    # User 2 does not wait for all the requests user 1 queued first
+    assert order.index((2, 0)) < order.index((1, 2))
+
+
+def test_processes_share_the_budget_of_a_model():
+    scheduler = UpstreamScheduler(budgets={"m": ModelBudget(concurrency=8, tokens_per_minute=1000)}, processes=3)
+    running = []
+
+    async def request() -> None:
+        async with scheduler.slot("m", user_id=1):
+            running.append(scheduler.stats()["m"]["in_flight"])
+            await asyncio.sleep(0.01)
+
+    async def run() -> None:
+        await asyncio.gather(*(request() for _ in range(8)))
+
+    asyncio.run(run())
+    assert max(running) == 2
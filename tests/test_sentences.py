@@ -0,0 +1,25 @@
+from bot.utils.sentences import split_sentences
+
+
+def test_abbreviations_and_decimals_do_not_end_a_sentence():
+    text = "Seats are limited. The talk by Dr. Watson starts at 9.30 today."
+    assert split_sentences(text, 45) == ["Seats are limited.", "The talk by Dr. Watson starts at 9.30 today."]
+
+
+def test_sentences_are_packed_up_to_the_limit():
+    text = "One. Two. Three.\nFour. Five."
+    assert split_sentences(text, 11) == ["One. Two.", "Three.", "Four. Five."]
+    # The first chunk can be shorter than the others
+    assert split_sentences(text, 20, first_limit=4) == ["One.", "Two. Three. Four.", "Five."]
+
+
+def test_text_without_a_sentence_end_is_cut_at_spaces():
+    text = "just some words without any punctuation at all in this text"
+    chunks = split_sentences(text, 20)
+    assert all(len(chunk) <= 20 for chunk in chunks)
+    assert " ".join(chunks) == text
+
+
+def test_sentence_longer_than_the_limit_is_cut_at_a_clause_break():
+    text = "We need eggs, milk, flour and sugar, then we bake the cake. Done."
+    assert split_sentences(text, 30) == ["We need eggs, milk,", "flour and sugar,", "then we bake the cake. Done."]
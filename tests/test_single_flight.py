@@ -0,0 +1,106 @@
+import asyncio
+
+import pytest
+
+from bot.utils.single_flight import SingleFlight
+
+
+def test_cancelled_caller_leaves_the_call_to_the_others():
+    flight = SingleFlight()
+    calls = []
+
+    async def call() -> str:
+        calls.append(True)
+        await asyncio.sleep(0.05)
+        return "answer"
+
+    async def run() -> list[str]:
+        first = asyncio.create_task(flight.do("key", "images", call))
+        others = [asyncio.create_task(flight.do("key", "images", call)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await asyncio.gather(*others)
+
+    assert asyncio.run(run()) == ["answer", "answer"]
+    assert len(calls) == 1
+    assert flight.stats()["images"] == {"calls": 1, "saved": 2, "in_flight": 0}
+
+
+def test_call_is_cancelled_when_every_caller_is_gone():
+    flight = SingleFlight()
+    cancelled = []
+
+    async def call() -> str:
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    async def run() -> None:
+        callers = [asyncio.create_task(flight.do("key", "images", call)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        for caller in callers:
+            caller.cancel()
+        await asyncio.gather(*callers, return_exceptions=True)
+        await asyncio.sleep(0)
+
+    asyncio.run(run())
+    assert cancelled == [True]
+    assert flight.stats()["images"]["in_flight"] == 0
+
+
+def test_error_of_the_call_reaches_every_caller():
+    flight = SingleFlight()
+
+    async def call() -> str:
+        await asyncio.sleep(0.01)
+        raise ConnectionError("OpenAI is unreachable")
+
+    async def run() -> list:
+        return await asyncio.gather(*(flight.do("key", "images", call) for _ in range(3)), return_exceptions=True)
+
+    errors = asyncio.run(run())
+    assert [type(error) for error in errors] == [ConnectionError] * 3
+    assert flight.stats()["images"]["calls"] == 1
+
+
+def test_late_joiner_of_a_stream_gets_the_chunks_streamed_so_far():
+    flight = SingleFlight()
+    streamed = asyncio.Event()
+
+    async def call():
+        yield "Hello"
+        yield ", "
+        streamed.set()
+        await asyncio.sleep(0.01)
+        yield "world"
+
+    async def read() -> str:
+        return "".join([chunk async for chunk in flight.stream("key", "chat/completions", call)])
+
+    async def run() -> list[str]:
+        first = asyncio.create_task(read())
+        await streamed.wait()
+        return [await read(), await first]
+
+    assert asyncio.run(run()) == ["Hello, world", "Hello, world"]
+    assert flight.stats()["chat/completions"] == {"calls": 1, "saved": 1, "in_flight": 0}
+
+
+def test_key_is_called_again_once_the_call_is_done():
+    flight = SingleFlight()
+    calls = []
+
+    async def call() -> int:
+        calls.append(True)
+        return len(calls)
+
+    async def run() -> list[int]:
+        first = await flight.do("key", "images", call)
+        assert flight.stats()["images"]["in_flight"] == 0
+        return [first, await flight.do("key", "images", call)]
+
+    assert asyncio.run(run()) == [1, 2]
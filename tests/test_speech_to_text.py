@@ -0,0 +1,28 @@
+import asyncio
+from types import SimpleNamespace
+
+from bot.handlers.api import speech_to_text
+from bot.utils.resilience import Resilience
+
+AUDIO = b"0123456789abcdef"
+
+
+def test_hedge_uploads_from_a_file_of_its_own(monkeypatch):
+    attempts = []
+
+    async def create(model: str, file: tuple, response_format: str) -> str:
+        # The first attempt is slow in the middle of its upload, the hedge reads while it waits
+        index = len(attempts)
+        attempts.append(index)
+        _, upload = file
+        first = upload.read(4 if index == 0 else 2)
+        await asyncio.sleep(0.1 if index == 0 else 0.3)
+        return (first + upload.read()).decode()
+
+    fake = SimpleNamespace(audio=SimpleNamespace(translations=SimpleNamespace(create=create)))
+    monkeypatch.setattr(speech_to_text, "client", fake)
+    monkeypatch.setattr(speech_to_text, "resilience", Resilience(hedge_after={"whisper-1": 0.05}))
+
+    text = asyncio.run(speech_to_text.generate_speech_to_text("whisper-1", AUDIO, "voice.ogg"))
+    assert attempts == [0, 1]
+    assert text == AUDIO.decode()
@@ -0,0 +1,93 @@
+import asyncio
+from types import SimpleNamespace
+
+from bot.handlers.api import text_to_speech
+from bot.utils.asset_cache import AssetCache
+from bot.utils.jobs import JobQueue, SqliteJobBackend
+
+
+class FakeBot:
+    """
+    This class stands in for the bot, sending voice messages until it is told to fail.
+    """
+
+    def __init__(self, fail_at: int):
+        self.fail_at = fail_at
+        self.voices = []
+
+    async def delete_message(self, chat_id: int, message_id: int) -> None:
+        pass
+
+    async def send_voice(self, chat_id: int, voice) -> SimpleNamespace:
+        if len(self.voices) == self.fail_at:
+            raise ConnectionError("Telegram is unreachable")
+        self.voices.append(voice.data)
+        return SimpleNamespace(voice=SimpleNamespace(file_id=f"file {len(self.voices)}"))
+
+
+def test_retried_job_goes_on_after_the_chunks_already_sent(monkeypatch, tmp_path):
+    queue = JobQueue(backend=SqliteJobBackend(str(tmp_path / "jobs.sqlite")))
+    monkeypatch.setattr(text_to_speech, "job_queue", queue)
+    monkeypatch.setattr(text_to_speech, "asset_cache", AssetCache())
+    monkeypatch.setattr(text_to_speech, "TTS_PIPELINE", True)
+    monkeypatch.setattr(text_to_speech, "TTS_CHUNK_CHARS", 20)
+    monkeypatch.setattr(text_to_speech, "TTS_FIRST_CHUNK_CHARS", 20)
+
+    async def generate(prompt: str, model: str, voice: str) -> bytes:
+        return prompt.encode()
+
+    monkeypatch.setattr(text_to_speech, "generate_text_to_speech", generate)
+    prompt = "First sentence. Second sentence. Third sentence."
+
+    async def run() -> list[bytes]:
+        await queue.backend.add("text_to_speech", 1, {"prompt": prompt, "model": "tts-1", "voice": "alloy",
+                                                      "key": "key", "wait_message_id": 2})
+        bot = FakeBot(fail_at=1)
+        job, = await queue.backend.claim("text_to_speech", 1, lease=60)
+        try:
+            await text_to_speech.text_to_speech_job(bot, job)
+        except ConnectionError:
+            await queue.backend.retry(job.id, 0, "Telegram is unreachable")
+
+        bot.fail_at = None
+        job, = await queue.backend.claim("text_to_speech", 1, lease=60)
+        assert job.payload["delivered"] == 1
+        await text_to_speech.text_to_speech_job(bot, job)
+        return bot.voices
+
+    assert asyncio.run(run()) == [b"First sentence.", b"Second sentence.", b"Third sentence."]
+
+
+def test_chunks_generated_at_once_are_sent_in_order(monkeypatch, tmp_path):
+    queue = JobQueue(backend=SqliteJobBackend(str(tmp_path / "jobs.sqlite")))
+    monkeypatch.setattr(text_to_speech, "job_queue", queue)
+    monkeypatch.setattr(text_to_speech, "asset_cache", AssetCache())
+    monkeypatch.setattr(text_to_speech, "TTS_PIPELINE", True)
+    monkeypatch.setattr(text_to_speech, "TTS_PARALLEL", 3)
+    monkeypatch.setattr(text_to_speech, "TTS_CHUNK_CHARS", 20)
+    monkeypatch.setattr(text_to_speech, "TTS_FIRST_CHUNK_CHARS", 20)
+    running = []
+    most_running = 0
+
+    async def generate(prompt: str, model: str, voice: str) -> bytes:
+        nonlocal most_running
+        running.append(prompt)
+        most_running = max(most_running, len(running))
+        # Earlier chunks take longer, so they finish after the ones behind them
+        await asyncio.sleep(0.05 if prompt.startswith("First") else 0.01)
+        running.remove(prompt)
+        return prompt.encode()
+
+    monkeypatch.setattr(text_to_speech, "generate_text_to_speech", generate)
+    prompt = "First sentence. Second sentence. Third sentence. Fourth sentence."
+
+    async def run() -> list[bytes]:
+        await queue.backend.add("text_to_speech", 1, {"prompt": prompt, "model": "tts-1", "voice": "alloy",
+                                                      "key": "key", "wait_message_id": 2})
+        bot = FakeBot(fail_at=None)
+        job, = await queue.backend.claim("text_to_speech", 1, lease=60)
+        await text_to_speech.text_to_speech_job(bot, job)
+        return bot.voices
+
+    assert asyncio.run(run()) == [b"First sentence.", b"Second sentence.", b"Third sentence.", b"Fourth sentence."]
+    assert most_running == 3
@@ -0,0 +1,32 @@
+from aiogram import types
+
+from bot.config import CALLBACK_FEATURES, STATE_FEATURES
+from bot.middlewares.throttling import ThrottlingMiddleware
+from bot.utils.rate_limiter import RateLimit, RateLimiter
+
+USER = types.User(id=1, is_bot=False, first_name="User")
+
+
+def _callback(data: str) -> types.Update:
+    return types.Update(update_id=1, callback_query=types.CallbackQuery(id="1", from_user=USER, chat_instance="1",
+                                                                         data=data))
+
+
+def test_buttons_of_each_feature_have_a_bucket_of_their_own():
+    middleware = ThrottlingMiddleware(RateLimiter({}), STATE_FEATURES, CALLBACK_FEATURES)
+
+    assert middleware.feature(_callback("dall-e-3"), {}) == "callback:image"
+    assert middleware.feature(_callback("text_to_speech"), {}) == "callback:tts"
+    assert middleware.feature(_callback("text"), {}) == "callback:text"
+    # A voice picked in the text to speech menu counts against the feature of its state group
+    assert middleware.feature(_callback("alloy"), {"raw_state": "StateTextToSpeech:text_to_speech"}) == "callback:tts"
+    assert middleware.feature(_callback("back"), {}) == "callback"
+
+
+def test_part_of_a_feature_takes_the_limit_of_the_feature_unless_it_has_one():
+    limiter = RateLimiter({"callback": RateLimit(limit=2, period=60), "callback:image": RateLimit(limit=1, period=60)})
+
+    assert [limiter.hit(1, "callback:text")[0] for _ in range(3)] == [True, True, False]
+    # The text buttons used up their own bucket only
+    assert [limiter.hit(1, "callback:image")[0] for _ in range(2)] == [True, False]
+    assert limiter.hit(1, "callback")[0]
@@ -0,0 +1,85 @@
+import asyncio
+import glob
+import json
+import os
+
+from bot.utils import tracing
+from bot.utils.tracing import NULL_SPAN, Tracer, span
+
+
+async def _update(tracer: Tracer, name: str = "update message", seconds: float = 0.0, spans: int = 1) -> None:
+    # Handles one update, with a span for every step
+    with tracer.trace(name, track="update 1"):
+        for index in range(spans):
+            with span(f"step {index}"):
+                await asyncio.sleep(seconds / spans)
+
+
+def _events(path: str) -> list[dict]:
+    with open(path) as file:
+        return [event for event in json.load(file) if event["ph"] == "X"]
+
+
+def test_only_sampled_updates_are_traced(monkeypatch, tmp_path):
+    assert Tracer(str(tmp_path / "bot.json")).trace("update message", track="update 1") is NULL_SPAN
+    tracer = Tracer(str(tmp_path / "bot.json"), sample_rate=0.5, flush_interval=60)
+    draws = iter([0.7, 0.2])
+    monkeypatch.setattr(tracing.random, "random", lambda: next(draws))
+
+    async def run() -> None:
+        await _update(tracer, "update skipped")
+        await _update(tracer, "update sampled")
+        await tracer.close()
+
+    asyncio.run(run())
+    assert tracer.stats()["traced"] == 1
+    file, = glob.glob(str(tmp_path / "bot.*.json"))
+    assert [event["name"] for event in _events(file)] == ["step 0", "update sampled"]
+
+
+def test_slow_updates_are_kept_and_quick_ones_dropped(tmp_path):
+    tracer = Tracer(str(tmp_path / "bot.json"), slow_threshold=0.05, flush_interval=60)
+
+    async def run() -> None:
+        await _update(tracer, "update quick")
+        await _update(tracer, "update slow", seconds=0.06)
+        await tracer.close()
+
+    asyncio.run(run())
+    stats = tracer.stats()
+    assert (stats["traced"], stats["kept"], stats["slow"]) == (2, 1, 1)
+    file, = glob.glob(str(tmp_path / "bot.*.json"))
+    assert "update slow" in [event["name"] for event in _events(file)]
+    assert "update quick" not in [event["name"] for event in _events(file)]
+
+
+def test_spans_over_the_cap_are_dropped_but_the_update_is_kept(tmp_path):
+    tracer = Tracer(str(tmp_path / "bot.json"), sample_rate=1, max_spans=3, flush_interval=60)
+
+    async def run() -> None:
+        await _update(tracer, spans=5)
+        await tracer.close()
+
+    asyncio.run(run())
+    assert tracer.stats()["spans_dropped"] == 2
+    file, = glob.glob(str(tmp_path / "bot.*.json"))
+    assert [event["name"] for event in _events(file)] == ["step 0", "step 1", "step 2", "update message"]
+
+
+def test_rotated_and_closed_files_are_valid_json(tmp_path):
+    tracer = Tracer(str(tmp_path / "bot.json"), sample_rate=1, max_bytes=2000, backups=2, flush_interval=60)
+
+    async def run() -> None:
+        for _ in range(20):
+            await _update(tracer, spans=3)
+            await tracer.flush()
+        await tracer.close()
+
+    asyncio.run(run())
+    root = str(tmp_path / f"bot.{os.getpid()}")
+    # The current file and as many older ones as kept
+    assert sorted(glob.glob(str(tmp_path / "bot.*.json"))) == [f"{root}.1.json", f"{root}.2.json", f"{root}.json"]
+    for file in glob.glob(str(tmp_path / "bot.*.json")):
+        # Rotated before a write would take it past max_bytes, the closing bracket aside
+        assert os.path.getsize(file) <= 2000 + len("\n]\n")
+        assert {event["name"] for event in _events(file)} >= {"update message"}
@@ -0,0 +1,70 @@
+import os
+
+import pytest
+
+from bot.utils import usage
+from bot.utils.usage import RECORD, aggregate, compact, read_records
+
+DAY = 1_700_000_000
+
+
+def _append(path: str, count: int) -> None:
+    with open(path, "ab") as file:
+        file.write(b"".join(RECORD.pack(DAY + index, 1, b"gpt-4o", 1, 0, 10, 20, 0, 0.0) for index in range(count)))
+
+
+def _requests(path: str) -> int:
+    return aggregate(read_records(path), by=())[()][0]
+
+
+class Crash(Exception):
+    """
+    This exception stands in for the process dying at a given point of a compaction.
+    """
+
+
+def test_compaction_keeps_the_totals(tmp_path):
+    path = str(tmp_path / "usage.bin")
+    _append(path, 5)
+    assert compact(path) == 5
+    _append(path, 3)
+    assert _requests(path) == 8
+    assert compact(path) == 3
+    assert _requests(path) == 8
+    assert os.path.getsize(f"{path}.daily") == RECORD.size
+
+
+@pytest.mark.parametrize("crash_on", ["replace daily", "remove raw"])
+def test_interrupted_compaction_neither_loses_nor_double_counts(tmp_path, monkeypatch, crash_on):
+    path = str(tmp_path / "usage.bin")
+    _append(path, 5)
+    compact(path)
+    _append(path, 4)
+    replace, remove = os.replace, os.remove
+
+    def crashing_replace(source: str, target: str) -> None:
+        if crash_on == "replace daily" and target.endswith(".daily"):
+            raise Crash()
+        replace(source, target)
+
+    def crashing_remove(name: str) -> None:
+        if crash_on == "remove raw" and name.endswith(".compacting"):
+            raise Crash()
+        remove(name)
+
+    monkeypatch.setattr(usage.os, "replace", crashing_replace)
+    monkeypatch.setattr(usage.os, "remove", crashing_remove)
+    with pytest.raises(Crash):
+        compact(path)
+    monkeypatch.undo()
+
+    assert _requests(path) == 9
+    _append(path, 1)
+    compact(path)
+    assert _requests(path) == 10
+    assert sorted(os.listdir(tmp_path)) == ["usage.bin.compact.lock", "usage.bin.daily", "usage.bin.lock"]
+
+
+def test_unknown_group_is_refused():
+    with pytest.raises(ValueError, match="^Records can only be grouped by"):
+        aggregate([], by=("country",))
@@ -0,0 +1,53 @@
+import base64
+import io
+
+import pytest
+from aiogram.types import PhotoSize
+
+from bot.utils import vision_image
+from bot.utils.vision_image import image_tokens, pick_photo_size, prepare_image
+
+# The sizes Telegram keeps of a 16:9 photo
+SIZES = [PhotoSize(file_id=f"{width}", file_unique_id=f"{width}", width=width, height=height)
+         for width, height in [(90, 51), (320, 180), (800, 450), (1280, 720), (2560, 1440)]]
+
+
+def test_smallest_size_the_model_sees_as_the_largest_is_picked():
+    # At high detail the model shrinks the shortest side to 768, which only the largest size covers
+    assert pick_photo_size(SIZES, "high").width == 2560
+    assert pick_photo_size(SIZES[:4], "high").width == 1280
+    # At low detail it fits the photo into 512x512
+    assert pick_photo_size(SIZES, "low").width == 800
+
+
+def test_photo_is_sent_as_it_is_without_pillow(monkeypatch):
+    monkeypatch.setattr(vision_image, "Image", None)
+    data = b"\xff\xd8 a photo as Telegram sent it"
+
+    image = prepare_image(io.BytesIO(data), 2560, 1440, "high")
+    assert image.data_url == "data:image/jpeg;base64," + base64.b64encode(data).decode()
+    assert (image.width, image.height, image.sent_bytes) == (2560, 1440, len(data))
+    assert image.tokens == image_tokens(2560, 1440, "high")
+
+
+def test_photo_is_shrunk_to_the_size_the_model_works_at():
+    pytest.importorskip("PIL")
+    from PIL import Image
+
+    photo = io.BytesIO()
+    Image.effect_noise((2560, 1440), 64).convert("RGB").save(photo, format="JPEG", quality=95)
+    photo.seek(0)
+
+    image = prepare_image(photo, 2560, 1440, "high")
+    assert (image.width, image.height) == (1365, 768)
+    assert image.sent_bytes < len(photo.getvalue())
+    with Image.open(io.BytesIO(base64.b64decode(image.data_url.split(",", 1)[1]))) as sent:
+        assert sent.size == (1365, 768)
+
+
+def test_data_pillow_cannot_read_is_sent_as_it_is():
+    pytest.importorskip("PIL")
+    data = b"not an image at all"
+
+    image = prepare_image(io.BytesIO(data), 2560, 1440, "high")
+    assert (image.width, image.sent_bytes) == (2560, len(data))
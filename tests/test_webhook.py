@@ -0,0 +1,37 @@
+import asyncio
+import multiprocessing
+import queue
+import time
+
+from aiohttp.test_utils import TestClient, TestServer
+
+from bot.webhook import create_front_app, stop_workers
+
+
+def test_full_worker_queue_turns_telegram_away():
+    queues = [queue.Queue(maxsize=1)]
+
+    async def run() -> list[int]:
+        async with TestClient(TestServer(create_front_app(queues, secret=None, path="/webhook"))) as client:
+            statuses = []
+            for update_id in range(2):
+                response = await client.post("/webhook", json={"update_id": update_id, "message": {
+                    "message_id": 1, "date": 0, "chat": {"id": 1, "type": "private"}}})
+                statuses.append(response.status)
+            return statuses
+
+    assert asyncio.run(run()) == [200, 503]
+    assert queues[0].get_nowait()["update_id"] == 0
+
+
+def test_stuck_worker_is_terminated_on_shutdown():
+    # The worker never takes anything off its full queue, so the stop request cannot be queued either
+    queues = [multiprocessing.Queue(maxsize=1)]
+    queues[0].put({"update_id": 0})
+    processes = [multiprocessing.Process(target=time.sleep, args=(60,), daemon=True)]
+    processes[0].start()
+
+    started = time.monotonic()
+    stop_workers(queues, processes, timeout=0.5)
+    assert time.monotonic() - started < 5
+    assert not processes[0].is_alive()